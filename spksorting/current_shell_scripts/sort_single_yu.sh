@@ -4,25 +4,22 @@ ouput_dir=$2
 samplerate=$3
 geom_file=$4
 
-# Run bandpass filter stage of Mountainsort
-ml-run-process ephys.bandpass_filter \
-    --inputs timeseries:$input_dir/converted_data.mda \
-    --outputs timeseries_out:$ouput_dir/filt.mda \
-    --parameters samplerate:$samplerate freq_min:250 freq_max:5000
+code_dir=$(cd "$(dirname "$0")/.." && pwd)
 
-ml-run-process ephys.whiten \
-    --inputs timeseries:$ouput_dir/filt.mda \
-    --outputs timeseries_out:$ouput_dir/pre1.mda.prv
-
-ml-run-process ephys.mask_out_artifacts \
-    --inputs timeseries:$ouput_dir/pre1.mda.prv \
-    --outputs timeseries_out:$ouput_dir/pre.mda.prv
+# Bandpass filter, whitening and artifact masking stages (same as ephys.bandpass_filter, ephys.whiten
+# and ephys.mask_out_artifacts of Mountainsort) in one in-process pass: writes filt.mda, pre.mda,
+# whitening_matrix.mda and artifact_intervals.json directly without going through $ML_TEMPORARY_DIRECTORY
+PYTHONPATH=$code_dir/preprocess_rhd python -m utils.whiten_mda \
+    $input_dir/converted_data.mda $ouput_dir/pre.mda \
+    --filt_out $ouput_dir/filt.mda \
+    --samplerate $samplerate --freq_min 250 --freq_max 5000 \
+    --mask_artifacts --artifact_threshold 6 --artifact_interval_size 2000
 
 # Spike sorting
 # Specify the detect threshold in standard deviations
 ml-run-process ms4alg.sort \
     --inputs \
-        timeseries:$ouput_dir/pre.mda.prv \
+        timeseries:$ouput_dir/pre.mda \
         geom:$geom_file \
     --outputs \
         firings_out:$ouput_dir/firings.mda \
@@ -35,7 +32,7 @@ ml-run-process ms4alg.sort \
 # Compute cluster metrics
 ml-run-process ephys.compute_cluster_metrics \
     --inputs \
-        timeseries:$ouput_dir/pre.mda.prv firings:$ouput_dir/firings.mda \
+        timeseries:$ouput_dir/pre.mda firings:$ouput_dir/firings.mda \
     --outputs \
         metrics_out:$ouput_dir/cluster_metrics.json \
     --parameters \
@@ -55,7 +52,7 @@ ml-run-process ephys.compute_templates \
 # Some more cluster metrics
 ml-run-process ms3.isolation_metrics \
     --inputs \
-        timeseries:$ouput_dir/pre.mda.prv firings:$ouput_dir/firings.mda \
+        timeseries:$ouput_dir/pre.mda firings:$ouput_dir/firings.mda \
     --outputs \
         metrics_out:$ouput_dir/isolation_metrics_out.json \
         pair_metrics_out:$ouput_dir/pair_metrics_out.json \
@@ -15,6 +15,7 @@ from preprocess_rhd.preprocess_rhd import preprocess_one_session
 from utils_here import clear_folder
 
 BAD_SESSIONS_RHD = []
+N_PREPROC_WORKERS = 8 # processes decoding rhd files of one session in parallel
 def procfunc_prepdata(
     list_of_rhd_folders : list, 
     list_of_mda_folders : list, 
@@ -30,7 +31,7 @@ def procfunc_prepdata(
                 info_dict = json.load(f)
 
         try:
-            info_dict = preprocess_one_session(rhdfoldername, mdafoldername)
+            info_dict = preprocess_one_session(rhdfoldername, mdafoldername, n_workers=N_PREPROC_WORKERS)
         except Exception:
             traceback.print_exc()
             BAD_SESSIONS_RHD.append(rhdfoldername)
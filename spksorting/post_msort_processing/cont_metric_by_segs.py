@@ -16,6 +16,8 @@ from mountainlab_pytools import mlproc as mlp
 from utils.misc import recursively_empty_dir
 from utils import mdaio
 from utils.read_mda import readmda
+from utils.prv import resolve_prv
+from utils.artifact_mask import load_artifact_intervals, mask_chunk
 
 # temporary directory is usually fixed to this path
 ML_TEMP_DIR = "/media/hanlin/Liuyang_10T_backup/jiaaoZ/ml_temp"
@@ -31,16 +33,23 @@ SEG_LEN_SECONDS = 3600 # 1 hour
 # END USER SETTINGS
 
 
-def eval_single_segment(filt_file_obj, firings_arr, seg_start_sample, seg_n_samples, target_folder, f_sample):
+def eval_single_segment(filt_file_obj, firings_arr, seg_start_sample, seg_n_samples, target_folder, f_sample, pre_file_obj=None, empty_ml_temp=True, whitening_matrix=None, artifact_intervals=None):
     """
     Evaluate one segment: 
     First excerpt filtered mda and firing
     Then go through the Mountainlab stuff
     * target_folder is the direct parent folder of the .mda and metric files *
     * seg_start_sample is 0-based *
+    * pre_file_obj: reader of the whitened (and artifact-masked) data of the whole session;
+      if given it is excerpted like filt.mda instead of re-running whitening on the segment *
+    * whitening_matrix: whitening matrix of the whole session (whitening_matrix.mda of the sorting);
+      if given (and pre_file_obj is not) the segment is whitened with it instead of its own covariance *
+    * artifact_intervals: artifact intervals of the whole session (artifact_intervals.json of the sorting);
+      used with whitening_matrix to mask the segment instead of re-detecting artifacts on it *
     """
     # file path strings
     seg_filt_mda_path = os.path.join(target_folder, "filt_seg.mda")
+    seg_pre_mda_path = os.path.join(target_folder, "pre_seg.mda")
     seg_firings_mda_path = os.path.join(target_folder, "firings_seg.mda")
     seg_templates_mda_path = os.path.join(target_folder, "templates.mda")
     
@@ -53,10 +62,29 @@ def eval_single_segment(filt_file_obj, firings_arr, seg_start_sample, seg_n_samp
     print("  Reading done in %.2f seconds. Writing chunk to filt_seg.mda" % (t_read-ts_ovr))
     writer = mdaio.DiskWriteMda(seg_filt_mda_path, (n_chs, seg_n_samples), dt="int16")
     writer.writeChunk(tmp_filtdata, i1=0, i2=0)
+    writer.close()
     t_write = time()
     print("  Written. Done in %.2f seconds" % (t_write-t_read))
+    if pre_file_obj is None and whitening_matrix is not None:
+        tmp_predata = (whitening_matrix @ tmp_filtdata.astype(np.float64)).astype(np.float32)
+        if artifact_intervals is not None:
+            mask_chunk(tmp_predata, seg_start_sample, artifact_intervals)
+        writer = mdaio.DiskWriteMda(os.path.join(target_folder, "pre1_seg.mda"), (n_chs, seg_n_samples), dt="float32")
+        writer.writeChunk(tmp_predata, i1=0, i2=0)
+        writer.close()
+        del(tmp_predata)
+        print("  Whitened with the session's whitening matrix")
     del(tmp_filtdata)
     gc.collect()
+    if pre_file_obj is not None:
+        print("  Reading chunk from whitened data")
+        tmp_predata = pre_file_obj.readChunk(i1=0, N1=n_chs, i2=seg_start_sample, N2=seg_n_samples)
+        writer = mdaio.DiskWriteMda(seg_pre_mda_path, (n_chs, seg_n_samples), dt=pre_file_obj.dt())
+        writer.writeChunk(tmp_predata, i1=0, i2=0)
+        writer.close()
+        print("  Written to pre_seg.mda. Done in %.2f seconds" % (time()-t_write))
+        del(tmp_predata)
+        gc.collect()
 
     # prepare firings_seg.mda
     print("  Preparing firings_seg.mda")
@@ -76,26 +104,38 @@ def eval_single_segment(filt_file_obj, firings_arr, seg_start_sample, seg_n_samp
         {}, {}
     )
 
-    # Now, to compute metrics we gotta re-do the whitening and mask_out_artifacts,
-    # However since the sorting was done on the complete continuous data, 
-    # and we are computing metrics on this segmented data,
-    # I am not sure how much the results hold up
-    # phuc me
-    mlp.runProcess(
-        "ephys.whiten",
-        dict(timeseries=seg_filt_mda_path),
-        dict(timeseries_out=os.path.join(target_folder, "pre1.mda.prv")),
-        {}, {}
-    )
-    mlp.runProcess(
-        "ephys.mask_out_artifacts",
-        dict(timeseries=os.path.join(target_folder, "pre1.mda.prv")),
-        dict(timeseries_out=os.path.join(target_folder, "pre.mda.prv"))
-    )
+    if pre_file_obj is not None:
+        # whitened data of the whole session, i.e. what the sorting itself used
+        seg_pre_path = seg_pre_mda_path
+    else:
+        # Now, to compute metrics we gotta re-do the whitening and mask_out_artifacts,
+        # However since the sorting was done on the complete continuous data, 
+        # and we are computing metrics on this segmented data,
+        # I am not sure how much the results hold up
+        # phuc me
+        if whitening_matrix is not None:
+            seg_pre1_path = os.path.join(target_folder, "pre1_seg.mda")
+        else:
+            seg_pre1_path = os.path.join(target_folder, "pre1.mda.prv")
+            mlp.runProcess(
+                "ephys.whiten",
+                dict(timeseries=seg_filt_mda_path),
+                dict(timeseries_out=seg_pre1_path),
+                {}, {}
+            )
+        if whitening_matrix is not None and artifact_intervals is not None:
+            seg_pre_path = seg_pre1_path # already masked with the session's artifact intervals
+        else:
+            seg_pre_path = os.path.join(target_folder, "pre.mda.prv")
+            mlp.runProcess(
+                "ephys.mask_out_artifacts",
+                dict(timeseries=seg_pre1_path),
+                dict(timeseries_out=seg_pre_path)
+            )
     mlp.runProcess(
         "ephys.compute_cluster_metrics",
         {
-            "timeseries": os.path.join(target_folder, "pre.mda.prv"), 
+            "timeseries": seg_pre_path, 
             "firings": seg_firings_mda_path
         },
         {"metrics_out": os.path.join(target_folder, "cluster_metrics.json")},
@@ -109,7 +149,7 @@ def eval_single_segment(filt_file_obj, firings_arr, seg_start_sample, seg_n_samp
     mlp.runProcess(
         "ms3.isolation_metrics",
         {
-            "timeseries": os.path.join(target_folder, "pre.mda.prv"), 
+            "timeseries": seg_pre_path, 
             "firings": seg_firings_mda_path
         },
         {
@@ -128,8 +168,9 @@ def eval_single_segment(filt_file_obj, firings_arr, seg_start_sample, seg_n_samp
         {"metrics_out": os.path.join(target_folder, "combine_metrics_new.json")}
     )
     
-    print("  Emptying $ML_TEMPORARY_DIRECTORY :", os.environ['ML_TEMPORARY_DIRECTORY'])
-    recursively_empty_dir(os.environ['ML_TEMPORARY_DIRECTORY'])
+    if empty_ml_temp:
+        print("  Emptying $ML_TEMPORARY_DIRECTORY :", os.environ['ML_TEMPORARY_DIRECTORY'])
+        recursively_empty_dir(os.environ['ML_TEMPORARY_DIRECTORY'])
     print("--Segment finished. Elapsed time: %.2f seconds" % (time()-ts_ovr))
     
 
@@ -139,7 +180,34 @@ def eval_session_in_segs(session_srcdata_path, session_segs_path, seg_len_second
     raw_filt_path = os.path.join(session_srcdata_path, "filt.mda") # large file we can only read by chunk
     firings_path = os.path.join(session_srcdata_path, "firings.mda") # firings.mda is usually several hundred MB, can afford to read all into RAM
     
+    pre_prv_path = os.path.join(session_srcdata_path, "pre.mda.prv") # whitened data of the whole session, pointing into $ML_TEMPORARY_DIRECTORY
+    pre_plain_path = os.path.join(session_srcdata_path, "pre.mda") # same, written by the in-process whitening stage
+    artifact_intervals_path = os.path.join(session_srcdata_path, "artifact_intervals.json") # saved by the in-process masking stage
+    whitening_matrix_path = os.path.join(session_srcdata_path, "whitening_matrix.mda") # saved by the in-process whitening stage
+    
     filt_mda_reader = mdaio.DiskReadMda(raw_filt_path)
+    pre_mda_reader = None
+    empty_ml_temp = True
+    if os.path.exists(pre_plain_path):
+        pre_mda_reader = mdaio.DiskReadMda(pre_plain_path)
+        print("Reading whitened data from: %s" % (pre_plain_path))
+    elif os.path.exists(pre_prv_path):
+        try:
+            pre_mda_path = resolve_prv(pre_prv_path)
+            pre_mda_reader = mdaio.DiskReadMda(pre_mda_path)
+            print("Reading whitened data from: %s" % (pre_mda_path))
+            # do not delete the whitened data we are reading from
+            empty_ml_temp = not os.path.abspath(pre_mda_path).startswith(os.path.abspath(os.environ['ML_TEMPORARY_DIRECTORY'])+os.sep)
+        except IOError as e:
+            print("Whitened data not available, whitening each segment instead:", e)
+    whitening_matrix = None
+    if pre_mda_reader is None and os.path.exists(whitening_matrix_path):
+        whitening_matrix = readmda(whitening_matrix_path)
+        print("Whitening segments with the session's whitening matrix: %s" % (whitening_matrix_path))
+    artifact_intervals = None
+    if os.path.exists(artifact_intervals_path):
+        artifact_intervals = load_artifact_intervals(artifact_intervals_path)
+        print("Masking %d artifact intervals of the session" % (len(artifact_intervals)))
     total_n_samples = filt_mda_reader.N2()
     print("Total duration of data: %.2f seconds" % (total_n_samples/f_sample))
     seg_n_samples = int(seg_len_seconds*f_sample)
@@ -156,12 +224,12 @@ def eval_session_in_segs(session_srcdata_path, session_segs_path, seg_len_second
             os.makedirs(target_folder)
             print("  CREATED FOLDER: %s" % (target_folder))
         if seg_start_sample+seg_n_samples <= total_n_samples:
-            eval_single_segment(filt_mda_reader, firings_arr, seg_start_sample, seg_n_samples, target_folder, f_sample)
+            eval_single_segment(filt_mda_reader, firings_arr, seg_start_sample, seg_n_samples, target_folder, f_sample, pre_mda_reader, empty_ml_temp, whitening_matrix, artifact_intervals)
             seg_start_sample += seg_n_samples
         else:
             # last shortened segment
             this_seg_n_samples = total_n_samples - seg_start_sample
-            eval_single_segment(filt_mda_reader, firings_arr, seg_start_sample, this_seg_n_samples, target_folder, f_sample)
+            eval_single_segment(filt_mda_reader, firings_arr, seg_start_sample, this_seg_n_samples, target_folder, f_sample, pre_mda_reader, empty_ml_temp, whitening_matrix, artifact_intervals)
     print("Entire session done. Elapsed time: %.2f seconds." % (time()-ts_session))
 
 
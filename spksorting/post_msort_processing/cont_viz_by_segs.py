@@ -25,6 +25,9 @@ import scipy.signal as signal
 
 
 from utils.mdaio import readmda
+from utils.mda_tiles import open_mda_tiles
+from utils.common_reference import open_referenced
+from utils.spike_table import SpikeTrainStore
 from utils.triangulation import compute_monopolar_triangulation
 from utils.misc import plt3d_set_axes_equal
 
@@ -32,6 +35,8 @@ from utils.misc import plt3d_set_axes_equal
 FIGDIRNAME = "postproc_figs"
 MAP_PATH="../geom_channel_maps/map.csv"
 NO_READING_FILTMDA = False
+REFERENCE_METHOD = None # subtracted across channels from the waveforms: None, "mean" (CAR) or "median" (CMR)
+MATERIALIZE_REFERENCE = False # write the referenced filt_seg.mda once per segment and read waveforms from it
 N_PROCESSES = 8 # multiprocessing option
 
 # rejection parameters
@@ -263,15 +268,8 @@ def process_one_segment(segment_folder_msort, segment_folder_custom, curation_pa
     # peak_amplitudes = np.max(template_p2ps, axis=0)
 
     # get spike stamp for all clusters (in SAMPLEs not seconds)
-    spike_times_all = firings[1,:]
-    spike_labels = firings[2,:]
-    spike_times_by_clus =[[] for _ in range(n_clus)]
-    spike_count_by_clus = np.zeros((n_clus,))
-    for spk_time, spk_lbl in zip(spike_times_all, spike_labels):
-        spike_times_by_clus[spk_lbl-1].append(spk_time-1)
-    for i in range(n_clus):
-        spike_times_by_clus[i] = np.array(spike_times_by_clus[i])
-        spike_count_by_clus[i] = spike_times_by_clus[i].shape[0]
+    spike_times_by_clus = SpikeTrainStore.from_firings(firings, n_clus, time_offset=-1) # spike_times_by_clus[i]: 0-based times of label i+1
+    spike_count_by_clus = spike_times_by_clus.counts()
     firing_rates = spike_count_by_clus/const_SEGMENT_LEN
 
     # get primayr channel; channel index starts from 0 here
@@ -281,7 +279,7 @@ def process_one_segment(segment_folder_msort, segment_folder_custom, curation_pa
     # # get primary channel for each label; safely assumes each cluster has only one primary channel
     # pri_ch_lut = -1 * np.ones(n_clus, dtype=int)
     # n_pri_ch_known = 0
-    # for (spk_ch, spk_lbl) in zip(firings[0,:], spike_labels):
+    # for (spk_ch, spk_lbl) in zip(firings[0,:], firings[2,:]):
     #     if pri_ch_lut[spk_lbl-1]==-1:
     #         pri_ch_lut[spk_lbl-1] = spk_ch-1
     #         n_pri_ch_known += 1
@@ -482,7 +480,13 @@ def process_one_segment(segment_folder_msort, segment_folder_custom, curation_pa
         spk_amp_series = []
         waveforms_all = [] # only store the real-time waveforms at primary channel for each cluster
         proper_spike_times_by_clus = []
-        filt_signal = readmda(os.path.join(segment_folder_msort, "filt_seg.mda")) # heck of a big file
+        filt_signal = readmda(os.path.join(segment_folder_msort, "filt_seg.mda"), mmap=True) # heck of a big file; only the spike windows are read
+        # channel-major sidecar (if built) reads primary-channel windows without strided access
+        filt_tiles = open_mda_tiles(os.path.join(segment_folder_msort, "filt_seg.mda")) if REFERENCE_METHOD is None else None
+        # referenced signal read lazily around the spikes (or from its materialized copy)
+        filt_ref = None
+        if REFERENCE_METHOD is not None:
+            filt_ref = open_referenced(os.path.join(segment_folder_msort, "filt_seg.mda"), REFERENCE_METHOD, materialize=MATERIALIZE_REFERENCE)
         
         for i_clus in range(n_clus):
             prim_ch = pri_ch_lut[i_clus]
@@ -490,7 +494,12 @@ def process_one_segment(segment_folder_msort, segment_folder_custom, curation_pa
             tmp_spk_stamp = spike_times_by_clus[i_clus].astype(int)
             tmp_spk_stamp = tmp_spk_stamp[(tmp_spk_stamp>=int((waveform_len-1)/2)) & (tmp_spk_stamp<=filt_signal.shape[1]-1-int(waveform_len/2))]
             tmp_spk_start = tmp_spk_stamp - int((waveform_len-1)/2)
-            waveforms_this_cluster = deepcopy(filt_signal[prim_ch, tmp_spk_start[:,None]+np.arange(waveform_len)]) # (n_events, n_sample)
+            if filt_ref is not None:
+                waveforms_this_cluster = filt_ref.readWindows(prim_ch, tmp_spk_start, waveform_len) # (n_events, n_sample)
+            elif filt_tiles is not None:
+                waveforms_this_cluster = filt_tiles.readWindows(prim_ch, tmp_spk_start, waveform_len) # (n_events, n_sample)
+            else:
+                waveforms_this_cluster = deepcopy(filt_signal[prim_ch, tmp_spk_start[:,None]+np.arange(waveform_len)]) # (n_events, n_sample)
             waveforms_all.append(waveforms_this_cluster)
             waveform_peaks = np.max(waveforms_this_cluster, axis=1) 
             waveform_troughs = np.min(waveforms_this_cluster, axis=1)
@@ -501,6 +510,10 @@ def process_one_segment(segment_folder_msort, segment_folder_custom, curation_pa
         n_samples_in_signal = filt_signal.shape[1]
         final_stamp_time = n_samples_in_signal / F_SAMPLE
         del(filt_signal)
+        if filt_tiles is not None:
+            filt_tiles.close()
+        if filt_ref is not None:
+            filt_ref.close()
         gc.collect()
         print("Saving all waveforms across time for all clusters...")
         waveforms_all_dict = OrderedDict()
@@ -12,6 +12,7 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
 from utils.read_mda import readmda
+from utils.spike_table import SpikeTrainStore
 
 plt.rcParams["font.weight"] = "bold"
 plt.rcParams["axes.labelweight"] = "bold"
@@ -82,15 +83,8 @@ def read_postproc_data(msort_path: str, postproc_path: str, read_connec: bool) -
     # peak_amplitudes = np.max(template_p2ps, axis=0)
 
     # get spike stamp for all clusters (in SAMPLEs not seconds)
-    spike_times_all = firings[1,:]
-    spike_labels = firings[2,:]
-    spike_times_by_clus =[[] for _ in range(n_clus)]
-    spike_count_by_clus = np.zeros((n_clus,))
-    for spk_time, spk_lbl in zip(spike_times_all, spike_labels):
-        spike_times_by_clus[spk_lbl-1].append(spk_time-1)
-    for i in range(n_clus):
-        spike_times_by_clus[i] = np.array(spike_times_by_clus[i])
-        spike_count_by_clus[i] = spike_times_by_clus[i].shape[0]
+    spike_times_by_clus = SpikeTrainStore.from_firings(firings, n_clus, time_offset=-1) # spike_times_by_clus[i]: 0-based times of label i+1
+    spike_count_by_clus = spike_times_by_clus.counts()
     firing_rates = spike_count_by_clus/const_SEGMENT_LEN
     ret['firing_rates'] = firing_rates
 
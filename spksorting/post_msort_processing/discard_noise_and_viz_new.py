@@ -3,7 +3,6 @@
 import json
 import os
 from time import time
-from copy import deepcopy
 import gc
 from collections import OrderedDict
 import multiprocessing
@@ -20,6 +19,9 @@ import scipy.signal as signal
 
 
 from utils.read_mda import readmda
+from utils.mda_tiles import open_mda_tiles
+from utils.common_reference import open_referenced
+from utils.spike_table import SpikeTrainStore
 
 # settings
 ADJACENCY_RADIUS_SQUARED = 140**2 # um^2, consistent with mountainsort shell script
@@ -34,6 +36,8 @@ MAP_PATH0="../geom_channel_maps/ChannelMap_Ben.csv"
 WINDOW_LEN_IN_SEC = 10 # 30e-3
 SMOOTHING_SIZE = 1
 NO_READING_FILTMDA = False
+REFERENCE_METHOD = "mean" # subtracted across channels from the waveforms: "mean" (CAR) or "median" (CMR)
+MATERIALIZE_REFERENCE = False # write the referenced filt.mda once (filt_car.mda/filt_cmr.mda) and read waveforms from it
 N_PROCESSES = 8
 
 PARAMS = {}
@@ -122,25 +126,11 @@ def postprocess_one_session(session_folder):
     # peak_amplitudes = np.max(template_p2ps, axis=0)
 
     # get spike stamp for all clusters (in SAMPLEs not seconds)
-    spike_times_all = firings[1,:]
-    spike_labels = firings[2,:]
-    spike_times_by_clus =[[] for i in range(n_clus)]
-    spike_count_by_clus = np.zeros((n_clus,))
-    for spk_time, spk_lbl in zip(spike_times_all, spike_labels):
-        spike_times_by_clus[spk_lbl-1].append(spk_time-1)
-    for i in range(n_clus):
-        spike_times_by_clus[i] = np.array(spike_times_by_clus[i])
-        spike_count_by_clus[i] = spike_times_by_clus[i].shape[0]
+    spike_times_by_clus = SpikeTrainStore.from_firings(firings, n_clus, time_offset=-1) # spike_times_by_clus[i]: 0-based times of label i+1
+    spike_count_by_clus = spike_times_by_clus.counts()
 
     # get primary channel for each label; safely assumes each cluster has only one primary channel
-    pri_ch_lut = -1 * np.ones(n_clus, dtype=int)
-    n_pri_ch_known = 0
-    for (spk_ch, spk_lbl) in zip(firings[0,:], spike_labels):
-        if pri_ch_lut[spk_lbl-1]==-1:
-            pri_ch_lut[spk_lbl-1] = spk_ch-1
-            n_pri_ch_known += 1
-            if n_pri_ch_known==n_clus:
-                break
+    pri_ch_lut = spike_times_by_clus.primary_channels()
     
     peak_amplitudes = template_p2ps[pri_ch_lut, np.arange(n_clus)] # (n_clus,)
     # get the ranking of clusters by peak amplitude
@@ -228,11 +218,14 @@ def postprocess_one_session(session_folder):
         spk_amp_series = []
         waveforms_all = [] # only store the real-time waveforms at primary channel for each cluster
         proper_spike_times_by_clus = []
-        print("Reading filt.mda ... ", end="")
-        filt_signal = readmda(os.path.join(session_folder, "filt.mda")) # heck of a big file
-        print("Done")
-        filt_signal = filt_signal - np.mean(filt_signal, axis=0) # common average
-        print("Subtracted common average potential")
+        # heck of a big file: the referenced signal is read lazily around the spikes only
+        # (or from its materialized copy), never as a whole
+        filt_ref = open_referenced(os.path.join(session_folder, "filt.mda"), REFERENCE_METHOD, materialize=MATERIALIZE_REFERENCE)
+        # a channel-major sidecar built with the common average track avoids reading the other channels
+        filt_tiles = open_mda_tiles(os.path.join(session_folder, "filt.mda")) if REFERENCE_METHOD=="mean" else None
+        if filt_tiles is not None and filt_tiles.car_track is None:
+            filt_tiles.close()
+            filt_tiles = None
         
         for i_clus in range(n_clus):
             # if cluster_accept_mask[i_clus]==False:
@@ -241,9 +234,13 @@ def postprocess_one_session(session_folder):
             prim_ch = pri_ch_lut[i_clus]
             # print(spike_times_by_clus[i_clus].shape)
             tmp_spk_stamp = spike_times_by_clus[i_clus].astype(int)
-            tmp_spk_stamp = tmp_spk_stamp[(tmp_spk_stamp>=int((waveform_len-1)/2)) & (tmp_spk_stamp<=filt_signal.shape[1]-1-int(waveform_len/2))]
+            tmp_spk_stamp = tmp_spk_stamp[(tmp_spk_stamp>=int((waveform_len-1)/2)) & (tmp_spk_stamp<=filt_ref.N2()-1-int(waveform_len/2))]
             tmp_spk_start = tmp_spk_stamp - int((waveform_len-1)/2)
-            waveforms_this_cluster = deepcopy(filt_signal[prim_ch, tmp_spk_start[:,None]+np.arange(waveform_len)]) # (n_events, n_sample)
+            if filt_tiles is not None:
+                waveforms_this_cluster = filt_tiles.readWindows(prim_ch, tmp_spk_start, waveform_len).astype(np.float32) \
+                    - filt_tiles.readWindows(filt_tiles.car_track, tmp_spk_start, waveform_len).astype(np.float32) # (n_events, n_sample)
+            else:
+                waveforms_this_cluster = filt_ref.readWindows(prim_ch, tmp_spk_start, waveform_len) # (n_events, n_sample)
             waveforms_all.append(waveforms_this_cluster)
             waveform_peaks = np.max(waveforms_this_cluster, axis=1) 
             waveform_troughs = np.min(waveforms_this_cluster, axis=1)
@@ -251,9 +248,11 @@ def postprocess_one_session(session_folder):
             # peak-to-peak value of each event
             spk_amp_series.append(tmp_amp_series)
             proper_spike_times_by_clus.append(tmp_spk_stamp)
-        n_samples_in_signal = filt_signal.shape[1]
+        n_samples_in_signal = filt_ref.N2()
         final_stamp_time = n_samples_in_signal / f_sample
-        del(filt_signal)
+        filt_ref.close()
+        if filt_tiles is not None:
+            filt_tiles.close()
         gc.collect()
         print("Saving all waveforms across time for all clusters...")
         waveforms_all_dict = OrderedDict()
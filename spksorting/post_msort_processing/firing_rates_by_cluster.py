@@ -8,6 +8,7 @@ import scipy.signal as signal
 import pandas as pd
 
 from utils.read_mda import readmda
+from utils.spike_table import SpikeTrainStore
 
 
 F_SAMPLE = 30e3
@@ -25,23 +26,16 @@ window_in_samples = int(WINDOW_LEN_IN_SEC*F_SAMPLE)
 
 # read firing.mda
 firings = readmda(os.path.join(session_folder, "firings.mda")).astype(np.int64)
-filt_mda = readmda(os.path.join(session_folder, "filt.mda"))
+filt_mda = readmda(os.path.join(session_folder, "filt.mda"), mmap=True) # only the header is read
 n_samples = filt_mda.shape[1]
 print("n_samples=",n_samples)
 del(filt_mda)
 gc.collect()
 # get spike stamp for all clusters (in SAMPLEs not seconds)
-spike_times_all = firings[1,:]
-spike_labels = firings[2,:]
-n_clus = np.max(spike_labels)
+spike_times_by_clus = SpikeTrainStore.from_firings(firings) # spike_times_by_clus[i]: times of label i+1
+n_clus = spike_times_by_clus.n_clus
 print(n_clus)
-spike_times_by_clus =[[] for i in range(n_clus)]
-spike_count_by_clus = np.zeros((n_clus,))
-for spk_time, spk_lbl in zip(spike_times_all, spike_labels):
-    spike_times_by_clus[spk_lbl-1].append(spk_time)
-for i in range(n_clus):
-    spike_times_by_clus[i] = np.array(spike_times_by_clus[i])
-    spike_count_by_clus[i] = spike_times_by_clus[i].shape[0]
+spike_count_by_clus = spike_times_by_clus.counts()
 
 final_firing_timesample = firings[1, -1]
 
@@ -11,6 +11,7 @@ import matplotlib.gridspec as gridspec
 from natsort import natsorted
 
 from utils.read_mda import readmda
+from utils.spike_table import SpikeTrainStore
 
 plt.rcParams["font.weight"] = "bold"
 plt.rcParams["axes.labelweight"] = "bold"
@@ -65,11 +66,7 @@ for i in range(len(session_folders)):
         chunkstamp = chunkstamp[:, chunk_mask]
         # re-order by #unit
         n_clus = unit_mask.shape[0]
-        spike_times_by_clus =[[] for i in range(n_clus)]
-        for spk_time, spk_lbl in zip(chunkstamp[1,:], chunkstamp[2,:]):
-            spike_times_by_clus[spk_lbl-1].append(spk_time-1)
-        for i_this_clus in range(n_clus):
-            spike_times_by_clus[i_this_clus] = np.array(spike_times_by_clus[i_this_clus])
+        spike_times_by_clus = SpikeTrainStore.from_firings(chunkstamp, n_clus, time_offset=-1)
         fig = plt.figure()
         ax = fig.add_subplot(111)
         cnt=0
@@ -0,0 +1,320 @@
+'''
+Chunk-compressed variant of the .mda format (.mdaz).
+
+The array is cut along its last dim (time) into chunks of `chunk_samples`;
+each chunk is stored in mda (column-major) order, delta-encoded along time
+for integer data, byte-shuffled and losslessly compressed with zlib, lzma or
+blosc (if installed). An index of the chunk offsets at the end of the file
+gives O(1) seeks, so MdazReader reads a time range by decompressing only the
+chunks it overlaps. Chunks are compressed/decompressed in a thread pool
+(zlib, lzma and blosc release the GIL).
+
+DiskReadMda(path) and readmda(path) open .mdaz files transparently.
+
+Layout: header (magic, version, codec, dt code, bytes per entry, num_dims,
+dims[int64], chunk_samples[int64]), compressed chunks, then the index
+(n_chunks+1 int64 offsets) and its position as the last 8 bytes.
+'''
+import os
+import struct
+import zlib
+import lzma
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+import numpy as np
+
+from .mdaio import DiskReadMda, _dt_from_dt_code, _dt_code_from_dt, get_num_bytes_per_entry_from_dt
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+MDAZ_MAGIC = b"MDAZ"
+MDAZ_VERSION = 1
+MDAZ_CODECS = {"zlib": 1, "lzma": 2, "blosc": 3}
+DEFAULT_CHUNK_SAMPLES = 30000 # 1 second at 30 kHz
+
+def get_default_codec():
+    return "blosc" if blosc is not None else "zlib"
+
+def is_mdaz(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) == MDAZ_MAGIC
+    except OSError:
+        return False
+
+def _encode_chunk(X, codec, level):
+    """X: (..., n) chunk in its final dtype -> compressed bytes"""
+    if np.issubdtype(X.dtype, np.integer):
+        # wrap-around difference along time is exactly invertible with cumsum in the same dtype
+        D = np.empty_like(X)
+        D[..., :1] = X[..., :1]
+        np.subtract(X[..., 1:], X[..., :-1], out=D[..., 1:])
+        X = D
+    raw = np.ascontiguousarray(np.reshape(X, X.size, order='F'))
+    if codec == "blosc":
+        return blosc.compress(raw.tobytes(), typesize=raw.dtype.itemsize, clevel=level, shuffle=blosc.SHUFFLE)
+    # byte shuffle: all low bytes, then all high bytes, ...
+    shuffled = raw.view(np.uint8).reshape(-1, raw.dtype.itemsize).T.tobytes()
+    if codec == "zlib":
+        return zlib.compress(shuffled, level)
+    if codec == "lzma":
+        return lzma.compress(shuffled, preset=level)
+    raise ValueError("Unknown codec: %s" % (codec))
+
+def _decode_chunk(buf, codec, dt, shape):
+    dt = np.dtype(dt)
+    if codec == "blosc":
+        raw = np.frombuffer(blosc.decompress(buf), dtype=dt)
+    else:
+        shuffled = zlib.decompress(buf) if codec == "zlib" else lzma.decompress(buf)
+        raw = np.frombuffer(shuffled, dtype=np.uint8).reshape(dt.itemsize, -1).T.copy().view(dt).reshape(-1)
+    X = np.reshape(raw, shape, order='F')
+    if np.issubdtype(dt, np.integer):
+        X = np.cumsum(X, axis=-1, dtype=dt)
+    return X
+
+def write_mdaz(source, mdaz_path, chunk_samples=DEFAULT_CHUNK_SAMPLES, codec=None, level=None, n_threads=None):
+    """
+    Write `source` (an ndarray, a DiskReadMda or a path to a .mda file) as .mdaz,
+    streaming chunk by chunk; at most 2*n_threads chunks are in memory.
+    `codec`: "zlib", "lzma" or "blosc" (default: blosc if installed, else zlib)
+    `level`: compression level (default 1: fastest, most of the gain for int16 data)
+    """
+    if codec is None:
+        codec = get_default_codec()
+    if codec not in MDAZ_CODECS:
+        raise ValueError("Unknown codec: %s" % (codec))
+    if codec == "blosc" and blosc is None:
+        raise ImportError("blosc is not installed")
+    if level is None:
+        level = 1
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    if isinstance(source, str):
+        source = DiskReadMda(source)
+    if isinstance(source, np.ndarray):
+        dims = list(source.shape)
+        dt = str(source.dtype)
+        def get_chunk(beg, n):
+            return source[..., beg:beg+n]
+    else:
+        dims = [int(d) for d in source.dims()]
+        dt = source.dt()
+        def get_chunk(beg, n):
+            return source.readSlab([0]*(len(dims)-1)+[beg], dims[:-1]+[n])
+    n_total = dims[-1]
+    chunk_begs = list(range(0, n_total, chunk_samples))
+    tmp_path = mdaz_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MDAZ_MAGIC)
+        f.write(struct.pack("<iiiii", MDAZ_VERSION, MDAZ_CODECS[codec], _dt_code_from_dt(dt), get_num_bytes_per_entry_from_dt(dt), len(dims)))
+        f.write(struct.pack("<%dq" % (len(dims)), *dims))
+        f.write(struct.pack("<q", chunk_samples))
+        offsets = [f.tell()]
+        def compress_one(beg):
+            return _encode_chunk(np.asarray(get_chunk(beg, min(chunk_samples, n_total-beg)), dtype=dt), codec, level)
+        with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+            # bounded window of in-flight chunks, written in order
+            for i_beg in range(0, len(chunk_begs), 2*max(1, n_threads)):
+                for buf in executor.map(compress_one, chunk_begs[i_beg:i_beg+2*max(1, n_threads)]):
+                    f.write(buf)
+                    offsets.append(f.tell())
+        index_pos = f.tell()
+        f.write(np.array(offsets, dtype="<i8").tobytes())
+        f.write(struct.pack("<q", index_pos))
+    os.replace(tmp_path, mdaz_path)
+    return mdaz_path
+
+class MdazReader:
+    """
+    Random access to a .mdaz file with the DiskReadMda interface
+    (dims/N1/N2/N3/dt/readChunk/readSlab/readWindows/close). Only the chunks overlapping
+    a read are decompressed (in parallel); the most recent ones are cached.
+    """
+    def __init__(self, path, n_threads=None, n_cached_chunks=8):
+        self._path = path
+        with open(path, "rb") as f:
+            if f.read(4) != MDAZ_MAGIC:
+                raise IOError("Not an .mdaz file: %s" % (path))
+            version, codec_id, dt_code, self._bytes_per_entry, num_dims = struct.unpack("<iiiii", f.read(20))
+            if version != MDAZ_VERSION:
+                raise IOError("Unsupported .mdaz version %d: %s" % (version, path))
+            self._dims = list(struct.unpack("<%dq" % (num_dims), f.read(8*num_dims)))
+            self._chunk_samples = struct.unpack("<q", f.read(8))[0]
+            f.seek(-8, os.SEEK_END)
+            index_pos = struct.unpack("<q", f.read(8))[0]
+            n_chunks = -(-self._dims[-1] // self._chunk_samples)
+            f.seek(index_pos)
+            self._offsets = np.frombuffer(f.read(8*(n_chunks+1)), dtype="<i8")
+        self._codec = {v: k for k, v in MDAZ_CODECS.items()}[codec_id]
+        if self._codec == "blosc" and blosc is None:
+            raise ImportError("blosc is needed to read %s" % (path))
+        self._dt = _dt_from_dt_code(dt_code)
+        self._fd = os.open(path, os.O_RDONLY)
+        self._n_threads = os.cpu_count() if n_threads is None else n_threads
+        self._executor = None
+        self._cache = OrderedDict()
+        self._n_cached_chunks = n_cached_chunks
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def __del__(self):
+        self.close()
+    def close(self):
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+            self._fd = None
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown()
+            self._executor = None
+    def dims(self):
+        return self._dims
+    def N1(self):
+        return int(self._dims[0])
+    def N2(self):
+        return int(self._dims[1])
+    def N3(self):
+        return int(self._dims[2])
+    def dt(self):
+        return self._dt
+    def _load_chunk(self, i_chunk):
+        beg = int(self._offsets[i_chunk])
+        buf = os.pread(self._fd, int(self._offsets[i_chunk+1])-beg, beg)
+        n = min(self._chunk_samples, self._dims[-1]-i_chunk*self._chunk_samples)
+        return _decode_chunk(buf, self._codec, self._dt, self._dims[:-1]+[n])
+    def _get_chunks(self, i_chunks):
+        missing = [i for i in i_chunks if i not in self._cache]
+        if len(missing) > 1 and self._n_threads > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._n_threads)
+            loaded = dict(zip(missing, self._executor.map(self._load_chunk, missing)))
+        else:
+            loaded = {i: self._load_chunk(i) for i in missing}
+        ret = [self._cache[i] if i in self._cache else loaded[i] for i in i_chunks]
+        for i, X in zip(i_chunks, ret):
+            self._cache[i] = X
+            self._cache.move_to_end(i)
+        while len(self._cache) > self._n_cached_chunks:
+            self._cache.popitem(last=False)
+        return ret
+    def readSlab(self, starts, counts, steps=None):
+        """Same as DiskReadMda.readSlab."""
+        nd = len(starts)
+        if steps is None:
+            steps = [1]*nd
+        starts = [int(s) for s in starts]+[0]*(len(self._dims)-nd)
+        counts = [int(c) for c in counts]+self._dims[nd:]
+        steps = [int(s) for s in steps]+[1]*(len(self._dims)-nd)
+        for j in range(len(self._dims)):
+            if counts[j]<0 or steps[j]<1 or starts[j]<0 or (counts[j]>0 and starts[j]+(counts[j]-1)*steps[j]>=self._dims[j]):
+                raise IndexError("Slab out of range in dim {}: start={} count={} step={} size={}".format(j,starts[j],counts[j],steps[j],self._dims[j]))
+        if any(c == 0 for c in counts):
+            return np.zeros(counts, dtype=self._dt, order='F')
+        t_beg = starts[-1]
+        t_end = starts[-1]+(counts[-1]-1)*steps[-1]+1
+        c_beg = t_beg // self._chunk_samples
+        c_end = (t_end-1) // self._chunk_samples + 1
+        X = np.concatenate(self._get_chunks(list(range(c_beg, c_end))), axis=-1)
+        local = t_beg - c_beg*self._chunk_samples
+        sel = tuple(slice(starts[j], starts[j]+(counts[j]-1)*steps[j]+1, steps[j]) for j in range(len(self._dims)-1))
+        return np.asfortranarray(X[sel+(slice(local, local+t_end-t_beg, steps[-1]),)])
+    def readChunk(self, i1=-1, i2=-1, i3=-1, N1=1, N2=1, N3=1):
+        """Same as DiskReadMda.readChunk."""
+        if (i2 < 0):
+            # entry range in column-major order
+            flat_beg, flat_end = i1, i1+N1
+            inner = int(np.prod(self._dims[:-1]))
+            X = self.readSlab([0]*(len(self._dims)-1)+[flat_beg//inner], self._dims[:-1]+[(flat_end-1)//inner-flat_beg//inner+1])
+            X = np.reshape(X, X.size, order='F')
+            return X[flat_beg%inner:flat_beg%inner+N1]
+        elif (i3 < 0):
+            return self.readSlab((i1, i2), (N1, N2))
+        else:
+            return self.readSlab((i1, i2, i3), (N1, N2, N3))
+    def readWindows(self, i2_starts, N2, i1=0, N1=None):
+        """
+        Same as DiskReadMda.readWindows for a 2D file: windows X[i1:i1+N1, t:t+N2]
+        for every t in `i2_starts`, shape (len(i2_starts), N1, N2). Windows are
+        cut from the (cached) decompressed chunks they overlap.
+        """
+        if len(self._dims) != 2:
+            raise ValueError("readWindows needs a 2D file: %s" % (self._path))
+        if N1 is None:
+            N1 = self.N1()-i1
+        i2_starts = np.asarray(i2_starts, dtype=np.int64)
+        ret = np.empty((i2_starts.shape[0], N1, N2), dtype=self._dt)
+        if i2_starts.shape[0] == 0:
+            return ret
+        if np.any(i2_starts < 0) or np.any(i2_starts+N2 > self.N2()):
+            raise IndexError("Window out of range [0, {})".format(self.N2()))
+        order = np.argsort(i2_starts, kind='stable')
+        sorted_starts = i2_starts[order]
+        c_begs = sorted_starts // self._chunk_samples
+        c_ends = (sorted_starts+max(N2, 1)-1) // self._chunk_samples + 1
+        # windows that need the same chunks are cut from them at once
+        breaks = np.flatnonzero((np.diff(c_begs) != 0) | (np.diff(c_ends) != 0)) + 1
+        for run in np.split(np.arange(sorted_starts.shape[0]), breaks):
+            c_beg, c_end = int(c_begs[run[0]]), int(c_ends[run[0]])
+            chunks = self._get_chunks(list(range(c_beg, c_end)))
+            X = chunks[0] if len(chunks) == 1 else np.concatenate(chunks, axis=-1)
+            local = sorted_starts[run] - c_beg*self._chunk_samples
+            ret[order[run]] = X[i1:i1+N1, local[:, None]+np.arange(N2)].transpose(1, 0, 2)
+        return ret
+    def readAll(self):
+        return self.readSlab([0]*len(self._dims), self._dims)
+
+def read_mdaz(path):
+    """Whole .mdaz file as an array of shape dims (like readmda)."""
+    with MdazReader(path) as reader:
+        return reader.readAll()
+
+def benchmark_mdaz(mda_path, mdaz_path=None, chunk_samples=DEFAULT_CHUNK_SAMPLES, codec=None, level=None, n_threads=None, n_read_samples=30000*60):
+    """
+    Compress `mda_path` and compare size and read throughput of raw .mda vs
+    .mdaz for the first `n_read_samples` samples. Run it on the target drive
+    (drop the page cache between runs for cold-read numbers).
+    """
+    if mdaz_path is None:
+        mdaz_path = mda_path + "z"
+    ts = time()
+    write_mdaz(mda_path, mdaz_path, chunk_samples=chunk_samples, codec=codec, level=level, n_threads=n_threads)
+    t_write = time()-ts
+    raw_size = os.path.getsize(mda_path)
+    z_size = os.path.getsize(mdaz_path)
+    raw_reader = DiskReadMda(mda_path)
+    n = min(n_read_samples, int(raw_reader.dims()[-1]))
+    n_rows = int(np.prod(raw_reader.dims()[:-1]))
+    ts = time()
+    X_raw = raw_reader.readSlab([0]*(len(raw_reader.dims())-1)+[0], raw_reader.dims()[:-1]+[n])
+    t_raw = time()-ts
+    raw_reader.close()
+    z_reader = MdazReader(mdaz_path, n_threads=n_threads)
+    ts = time()
+    X_z = z_reader.readSlab([0]*(len(z_reader.dims())-1)+[0], z_reader.dims()[:-1]+[n])
+    t_z = time()-ts
+    z_reader.close()
+    if not np.array_equal(X_raw, X_z):
+        raise AssertionError("Round trip mismatch between %s and %s" % (mda_path, mdaz_path))
+    mb_read = n*n_rows*get_num_bytes_per_entry_from_dt(X_raw.dtype.name)/1e6
+    print("compression ratio: %.2f (%.1f MB -> %.1f MB), compressed in %.1f sec" % (raw_size/z_size, raw_size/1e6, z_size/1e6, t_write))
+    print("read %.1f MB: raw .mda %.1f MB/s; .mdaz %.1f MB/s" % (mb_read, mb_read/max(t_raw, 1e-9), mb_read/max(t_z, 1e-9)))
+    return {"ratio": raw_size/z_size, "t_write": t_write, "t_read_raw": t_raw, "t_read_mdaz": t_z}
+
+
+if __name__ == '__main__':
+    # e.g. `python -m utils.mdaz /path/to/converted_data.mda --codec zlib`
+    import argparse
+    parser = argparse.ArgumentParser(description="Compress a .mda file to .mdaz and benchmark reads against the raw file")
+    parser.add_argument("mda_path")
+    parser.add_argument("--codec", default=None, choices=list(MDAZ_CODECS.keys()))
+    parser.add_argument("--level", type=int, default=None)
+    parser.add_argument("--chunk_samples", type=int, default=DEFAULT_CHUNK_SAMPLES)
+    parser.add_argument("--n_threads", type=int, default=None)
+    args = parser.parse_args()
+    benchmark_mdaz(args.mda_path, chunk_samples=args.chunk_samples, codec=args.codec, level=args.level, n_threads=args.n_threads)
@@ -0,0 +1,291 @@
+'''
+Compact columnar spike table, an alternative to the (3, n_spikes) firings.mda.
+
+firings.mda holds (primary channel, sample time, label) per spike, read as
+int64 that is 24 bytes per spike. The spike table keeps the same three
+columns in the smallest sufficient types (channel uint8/uint16, time uint64,
+label uint16/uint32; 11 to 14 bytes per spike), with spikes grouped by label
+and sorted by time within a label. A CSR index `label_offsets` gives the
+spikes of label L as the slice [label_offsets[L], label_offsets[L+1]), so
+per-cluster spike trains are views without copies or searches.
+
+Values are the same as in firings.mda (1-based channels, labels and sample
+times as written by MountainSort).
+
+Layout (.spk): 32-byte header (magic, n_spikes, channel dt code, label dt
+code, n_offsets) followed by the time, label_offsets, label and channel
+columns; 8-byte columns come first so every column can be memory-mapped.
+Use `mda_to_spike_table`/`spike_table_to_mda` to convert between the two.
+'''
+import os
+import struct
+
+import numpy as np
+
+from .mdaio import readmda, writemda64, _dt_from_dt_code, _dt_code_from_dt
+
+SPIKE_TABLE_MAGIC = b"SPKTABLE"
+SPIKE_TABLE_HEADER_FORMAT = "<8sqiiq"
+SPIKE_TABLE_HEADER_SIZE = struct.calcsize(SPIKE_TABLE_HEADER_FORMAT)
+
+def get_spike_table_path(firings_path):
+    return os.path.splitext(firings_path)[0] + ".spk"
+
+def _smallest_uint(max_value, candidates):
+    for dt in candidates:
+        if max_value <= np.iinfo(dt).max:
+            return np.dtype(dt)
+    raise ValueError("Value %d does not fit in %s" % (max_value, candidates[-1]))
+
+def _group_by_label(times, labels, n_labels):
+    """
+    Permutation that groups spikes by label (0..n_labels-1) keeping time order
+    within a label, and the CSR offsets of the groups.
+    """
+    # spikes are usually already in time order (as in firings.mda) so one stable
+    # sort of the labels is enough; numpy sorts <=16-bit integers stably by radix sort
+    if times.shape[0] > 1 and np.any(times[1:] < times[:-1]):
+        order = np.lexsort((times, labels))
+    else:
+        order = np.argsort(labels, kind='stable')
+    offsets = np.zeros(n_labels+1, dtype=np.int64)
+    if labels.shape[0] > 0:
+        np.cumsum(np.bincount(labels, minlength=n_labels), out=offsets[1:])
+    return order, offsets
+
+def make_spike_table(channels, times, labels):
+    """
+    Build a spike table (dict with keys "channel", "time", "label" and
+    "label_offsets") from per-spike columns in any order.
+    """
+    channels = np.asarray(channels)
+    times = np.asarray(times)
+    labels = np.asarray(labels)
+    n_spikes = times.shape[0]
+    if channels.shape[0] != n_spikes or labels.shape[0] != n_spikes:
+        raise ValueError("channels, times and labels must have the same length")
+    if n_spikes > 0 and (channels.min() < 0 or times.min() < 0 or labels.min() < 0):
+        raise ValueError("Spike table columns must be non-negative")
+    max_label = int(labels.max()) if n_spikes > 0 else 0
+    ch_dt = _smallest_uint(int(channels.max()) if n_spikes > 0 else 0, (np.uint8, np.uint16))
+    lbl_dt = _smallest_uint(max_label, (np.uint16, np.uint32))
+    order, label_offsets = _group_by_label(times, labels.astype(lbl_dt), max_label+1)
+    return {
+        "channel": channels[order].astype(ch_dt),
+        "time": times[order].astype(np.uint64),
+        "label": labels[order].astype(lbl_dt),
+        "label_offsets": label_offsets,
+    }
+
+def firings_to_spike_table(firings):
+    """(3, n_spikes) firings array (channel, time, label) -> spike table"""
+    firings = np.asarray(firings)
+    return make_spike_table(firings[0].astype(np.int64), firings[1].astype(np.int64), firings[2].astype(np.int64))
+
+def spike_table_to_firings(table, dtype=np.int64):
+    """Spike table -> (3, n_spikes) firings array in time order (ties by label), like firings.mda."""
+    order = np.lexsort((table["label"], table["time"]))
+    firings = np.empty((3, order.shape[0]), dtype=dtype)
+    firings[0] = table["channel"][order]
+    firings[1] = table["time"][order]
+    firings[2] = table["label"][order]
+    return firings
+
+def get_label_slice(table, label):
+    """Index range of the spikes of `label` in the table columns (empty for unknown labels)."""
+    offsets = table["label_offsets"]
+    if label < 0 or label+1 >= offsets.shape[0]:
+        return slice(0, 0)
+    return slice(int(offsets[label]), int(offsets[label+1]))
+
+def write_spike_table(path, table):
+    n_spikes = table["time"].shape[0]
+    with open(path, "wb") as f:
+        f.write(struct.pack(
+            SPIKE_TABLE_HEADER_FORMAT, SPIKE_TABLE_MAGIC, n_spikes,
+            _dt_code_from_dt(table["channel"].dtype.name), _dt_code_from_dt(table["label"].dtype.name),
+            table["label_offsets"].shape[0]
+        ))
+        np.asarray(table["time"], dtype="<u8").tofile(f)
+        np.asarray(table["label_offsets"], dtype="<i8").tofile(f)
+        np.asarray(table["label"]).tofile(f)
+        np.asarray(table["channel"]).tofile(f)
+
+def read_spike_table(path, mmap=False):
+    """
+    Read a .spk file written by `write_spike_table`.
+    `mmap`: if True the columns are read-only np.memmap views instead of in-memory arrays
+    """
+    with open(path, "rb") as f:
+        magic, n_spikes, ch_code, lbl_code, n_offsets = struct.unpack(
+            SPIKE_TABLE_HEADER_FORMAT, f.read(SPIKE_TABLE_HEADER_SIZE))
+    if magic != SPIKE_TABLE_MAGIC:
+        raise IOError("Not a spike table file: %s" % (path))
+    columns = [
+        ("time", np.dtype("<u8"), n_spikes),
+        ("label_offsets", np.dtype("<i8"), n_offsets),
+        ("label", np.dtype(_dt_from_dt_code(lbl_code)), n_spikes),
+        ("channel", np.dtype(_dt_from_dt_code(ch_code)), n_spikes),
+    ]
+    table = {}
+    offset = SPIKE_TABLE_HEADER_SIZE
+    with open(path, "rb") as f:
+        for name, dt, count in columns:
+            if mmap and count > 0:
+                table[name] = np.memmap(path, dtype=dt, mode='r', offset=offset, shape=(count,))
+            else:
+                f.seek(offset)
+                table[name] = np.fromfile(f, dtype=dt, count=count)
+            offset += dt.itemsize*count
+    return table
+
+def mda_to_spike_table(firings_path, spk_path=None):
+    """Convert a firings .mda file to a .spk spike table next to it (or at `spk_path`)."""
+    if spk_path is None:
+        spk_path = get_spike_table_path(firings_path)
+    firings = readmda(firings_path, mmap=True)
+    write_spike_table(spk_path, firings_to_spike_table(firings))
+    del firings
+    return spk_path
+
+def spike_table_to_mda(spk_path, firings_path):
+    """Convert a .spk spike table back to a (3, n_spikes) float64 firings .mda for MountainLab tools."""
+    writemda64(spike_table_to_firings(read_spike_table(spk_path, mmap=True)), firings_path)
+    return firings_path
+
+def read_firings(path):
+    """(3, n_spikes) int64 firings from either a firings .mda or a .spk spike table."""
+    if path.endswith(".spk"):
+        return spike_table_to_firings(read_spike_table(path, mmap=True))
+    return readmda(path).astype(np.int64)
+
+class SpikeTrainStore:
+    """
+    Spike trains of all clusters in one array: spike times grouped by cluster
+    (time order within a cluster) with CSR offsets, built with one stable sort.
+    Cluster index i holds label i+1 (labels are 1-based as in firings.mda);
+    store[i] is a view of the times of cluster i, so a store can be used where
+    a list of per-cluster spike time arrays was used before.
+    """
+    def __init__(self, times, labels, n_clus=None, channels=None, time_offset=0):
+        """
+        `times`, `labels`, `channels`: per-spike columns as in firings.mda (labels and channels 1-based)
+        `n_clus`: number of clusters (default: largest label)
+        `time_offset`: added to the times, e.g. -1 for 0-based sample indices
+        """
+        times = np.asarray(times)
+        clus = np.asarray(labels).astype(np.int64) - 1
+        if n_clus is None:
+            n_clus = int(clus.max())+1 if clus.shape[0] > 0 else 0
+        if clus.shape[0] > 0 and (clus.min() < 0 or clus.max() >= n_clus):
+            raise ValueError("Labels must be in [1, %d]" % (n_clus))
+        clus_dt = np.uint16 if n_clus <= np.iinfo(np.uint16).max else np.uint32
+        order, self._offsets = _group_by_label(times, clus.astype(clus_dt), n_clus)
+        self._times = times[order].astype(np.int64)
+        if time_offset != 0:
+            self._times += time_offset
+        self._channels = None if channels is None else np.asarray(channels)[order]
+    @classmethod
+    def from_firings(cls, firings, n_clus=None, time_offset=0):
+        """From a (3, n_spikes) firings array (channel, time, label)."""
+        return cls(firings[1], firings[2], n_clus=n_clus, channels=firings[0], time_offset=time_offset)
+    @classmethod
+    def from_spike_table(cls, table, n_clus=None, time_offset=0):
+        return cls(table["time"], table["label"], n_clus=n_clus, channels=table["channel"], time_offset=time_offset)
+    @classmethod
+    def _from_grouped(cls, times, offsets, channels):
+        store = cls.__new__(cls)
+        store._times, store._offsets, store._channels = times, offsets, channels
+        return store
+    @property
+    def n_clus(self):
+        return self._offsets.shape[0]-1
+    @property
+    def times(self):
+        """All spike times, grouped by cluster."""
+        return self._times
+    @property
+    def offsets(self):
+        """CSR offsets: cluster i is times[offsets[i]:offsets[i+1]]."""
+        return self._offsets
+    def __len__(self):
+        return self.n_clus
+    def __getitem__(self, i_clus):
+        if i_clus < 0:
+            i_clus += self.n_clus
+        if i_clus < 0 or i_clus >= self.n_clus:
+            raise IndexError("Cluster index %d out of range [0, %d)" % (i_clus, self.n_clus))
+        return self._times[self._offsets[i_clus]:self._offsets[i_clus+1]]
+    def __iter__(self):
+        for i_clus in range(self.n_clus):
+            yield self[i_clus]
+    def counts(self):
+        """Number of spikes of each cluster."""
+        return np.diff(self._offsets)
+    def channels(self, i_clus):
+        """View of the (1-based) channels of the spikes of cluster i_clus."""
+        if self._channels is None:
+            raise ValueError("Store was built without channels")
+        return self._channels[self._offsets[i_clus]:self._offsets[i_clus+1]]
+    def primary_channels(self):
+        """0-based channel of the first spike of each cluster (-1 for clusters without spikes)."""
+        if self._channels is None:
+            raise ValueError("Store was built without channels")
+        ret = np.full(self.n_clus, -1, dtype=np.int64)
+        has_spikes = self.counts() > 0
+        ret[has_spikes] = self._channels[self._offsets[:-1][has_spikes]].astype(np.int64) - 1
+        return ret
+    def _spike_clus(self):
+        """Cluster index of every spike in the grouped order."""
+        return np.repeat(np.arange(self.n_clus), self.counts())
+    def relabel(self, clus_map, n_clus=None):
+        """
+        New store where cluster i becomes cluster clus_map[i] (several clusters
+        may be merged into one); clusters mapped to -1 are dropped.
+        `n_clus`: number of clusters of the new store (default: largest target + 1)
+        """
+        clus_map = np.asarray(clus_map, dtype=np.int64)
+        if clus_map.shape[0] != self.n_clus:
+            raise ValueError("clus_map must have one entry per cluster (%d)" % (self.n_clus))
+        if n_clus is None:
+            n_clus = int(clus_map.max())+1 if clus_map.shape[0] > 0 else 0
+        new_clus = clus_map[self._spike_clus()]
+        keep = new_clus >= 0
+        new_clus = new_clus[keep]
+        times = self._times[keep]
+        if np.all(np.diff(clus_map[clus_map >= 0]) > 0):
+            # increasing one-to-one map: groups stay contiguous and sorted
+            order = np.arange(times.shape[0])
+        else:
+            order = np.lexsort((times, new_clus))
+        offsets = np.zeros(n_clus+1, dtype=np.int64)
+        np.cumsum(np.bincount(new_clus, minlength=n_clus), out=offsets[1:])
+        channels = None if self._channels is None else self._channels[keep][order]
+        return SpikeTrainStore._from_grouped(times[order], offsets, channels)
+    def mask(self, clus_mask):
+        """New store with the same cluster indices where clusters with clus_mask False have no spikes."""
+        clus_mask = np.asarray(clus_mask, dtype=bool)
+        return self.relabel(np.where(clus_mask, np.arange(self.n_clus), -1), n_clus=self.n_clus)
+    def select_time(self, t_beg, t_end):
+        """New store with only the spikes with t_beg <= time < t_end."""
+        keep = (self._times >= t_beg) & (self._times < t_end)
+        offsets = np.zeros(self.n_clus+1, dtype=np.int64)
+        np.cumsum(np.bincount(self._spike_clus()[keep], minlength=self.n_clus), out=offsets[1:])
+        channels = None if self._channels is None else self._channels[keep]
+        return SpikeTrainStore._from_grouped(self._times[keep], offsets, channels)
+
+
+if __name__ == '__main__':
+    # e.g. `python -m utils.spike_table /path/to/firings.mda`
+    #   or `python -m utils.spike_table /path/to/firings.spk --mda_out /path/to/firings.mda`
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert between firings .mda and .spk spike tables")
+    parser.add_argument("src_path")
+    parser.add_argument("--mda_out", default=None, help="with a .spk source: path of the firings .mda to write")
+    args = parser.parse_args()
+    if args.src_path.endswith(".spk"):
+        if args.mda_out is None:
+            parser.error("--mda_out is required to convert a .spk file")
+        print("Written:", spike_table_to_mda(args.src_path, args.mda_out))
+    else:
+        print("Written:", mda_to_spike_table(args.src_path))
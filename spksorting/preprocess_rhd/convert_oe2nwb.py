@@ -41,11 +41,13 @@ def convert_one_session(session_folder_raw, export_nwb_path, channel_map_full, m
         return None
     ts_session = time()
     print("  Starting session: %s" % (session_folder_raw))
-    data_dict, fs_dict = Binary.Load(session_folder_raw)#, Experiment=0, Recording=1)
-    data_float = get_data(data_dict) # in uV
-    data_ephys_short = data_float[:,:N_CH].astype(np.int16) # (n_samples, n_channels)
-    del data_float
-    data_float = None
+    # keep the int16 bits as recorded; the uV-per-bit factor goes into the NWB conversion
+    data_dict, fs_dict = Binary.Load(session_folder_raw, Unit='Bits')#, Experiment=0, Recording=1)
+    data_bits = get_data(data_dict) # int16 memmap
+    data_ephys_short = data_bits[:,:N_CH] # (n_samples, n_channels)
+    bit_volts = Binary.BitVolts(session_folder_raw)[:N_CH]
+    if not np.allclose(bit_volts, bit_volts[0]):
+        raise ValueError("Channels have different bit_volts: %s" % (bit_volts))
     gc.collect()
     sample_freq = get_data(fs_dict)
     print("    data.shape=", data_ephys_short.shape, "F_SAMPLE=", sample_freq)
@@ -67,7 +69,8 @@ def convert_one_session(session_folder_raw, export_nwb_path, channel_map_full, m
     recording_info = {
         "sample_rate": float(sample_freq)
     }
-    initiate_nwb(export_nwb_path, data_ephys_short, recording_info, channel_map_full, metadata)
+    data_conv = {"conversion": float(bit_volts[0]), "offset": 0.0}
+    initiate_nwb(export_nwb_path, data_ephys_short, recording_info, channel_map_full, metadata, data_conv=data_conv)
     # TODO create NWB file
     return info_struct
 
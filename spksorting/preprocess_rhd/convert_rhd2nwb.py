@@ -14,7 +14,7 @@ import pynwb
 from pynwb.file import Subject
 
 
-from utils.rhd_folder import read_rhd_folder, add_imp_to_nwb
+from utils.rhd_folder import read_rhd_folder, add_imp_to_nwb, add_ttl_events_to_nwb
 # from read_channel_info_script_oe import SESSION_XML_NAMING_PATTERN, DATETIME_STR_PATTERN, HEADSTAGE_NAME
 
 N_CH = 32
@@ -134,3 +134,6 @@ if __name__ == "__main__":
             add_imp_to_nwb(imp_csvpath, export_nwb_path, verbose=True)
         else:
             add_imp_to_nwb(info_["rhd_fullfilenames"][0], export_nwb_path, verbose=True)
+
+        # add digital input edges (sparse events instead of dense boolean arrays)
+        add_ttl_events_to_nwb(session_folder_raw, export_nwb_path, verbose=True, ttl_events=info_["ttl_events"])
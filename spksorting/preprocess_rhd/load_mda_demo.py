@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import scipy.signal
 
 from utils.mdaio import DiskReadMda, readmda
+from utils.mda_tiles import open_mda_tiles
 
 
 mdafile_path = "CombinedSessions.mda"
@@ -48,6 +49,15 @@ plt.title("MUA-band data on all channels\n(channels plotted in arbitrary order)"
 
 plt.show()
 
+# example: read one channel over a long time range; the channel-major sidecar
+# (build once with `python -m utils.mda_tiles CombinedSessions.mda`) only reads that channel's bytes
+tiles = open_mda_tiles(mdafile_path)
+if tiles is not None:
+    one_channel = tiles.readChannel(0, i2=0, N2=min(n_samples, 3600*fs)) # first hour of channel 0
+else:
+    one_channel = mda.readChunk(i1=0, i2=0, N1=1, N2=min(n_samples, 3600*fs))[0] # strided read
+print("Read %d samples of channel 0" % (one_channel.shape[0]))
+
 # load the spike stamps
 print("Loading spike timestamps from %s", firings_path)
 firings = readmda(firings_path)
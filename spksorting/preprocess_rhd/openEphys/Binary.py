@@ -103,6 +103,20 @@ def BitsToVolts(Data, ChInfo, Unit):
     return(Data)
 
 
+def BitVolts(Folder, Processor=None):
+    """Returns the bit_volts factor of every channel of the first continuous
+    stream (or of Processor) in the first structure.oebin found under Folder,
+    so that int16 data loaded with Unit='Bits' can be scaled later on."""
+    InfoFiles = sorted(glob(Folder+'/**/structure.oebin', recursive=True))
+    Info = literal_eval(open(InfoFiles[0]).read())
+    ProcIndex = 0
+    if Processor:
+        ProcIndex = [Info['continuous'].index(_) for _ in Info['continuous']
+                     if str(_['source_processor_id']) == Processor][0]
+    ChInfo = Info['continuous'][ProcIndex]['channels']
+    return np.array([Ch['bit_volts'] for Ch in ChInfo])
+
+
 def Load(Folder, Processor=None, Experiment=None, Recording=None, Unit='uV', ChannelMap=[]):
     Files = sorted(glob(Folder+'/**/*.dat', recursive=True))
     # InfoFiles = sorted(glob(Folder+'/*/*/structure.oebin'))
@@ -8,10 +8,13 @@ import numpy as np
 
 from .openEphys import Binary
 from .utils.mdaio import DiskWriteMda
+from .utils.filtering import make_notch_sos, StreamingSosFiltFilt
+from .utils.filter_engine import FilterEngine
 
 
 
 N_CH = 32
+N_SAMPLES_PER_CHUNK = 30000*60 # samples converted to uV at a time
 
 # def walk_dict(dict_node, depth=0):
 #     for k in dict_node.keys():
@@ -29,29 +32,53 @@ def get_data(dict_node):
         return get_data(first_value)
     return first_value
 
-def preprocess_one_session(session_folder_raw, session_folder_mda):
+def preprocess_one_session(session_folder_raw, session_folder_mda, notch_freq=0, n_filter_threads=None):
+    '''
+    `notch_freq`: if >0, notch filter (Q=20) applied over the session as one continuous stream
+    `n_filter_threads`: threads converting and filtering channels in parallel (default: all cores)
+    '''
     ts_session = time()
     print("  Starting session: %s" % (session_folder_raw))
     if not os.path.exists(session_folder_mda):
         os.makedirs(session_folder_mda)
-    # read data
-    data_dict, fs_dict = Binary.Load(session_folder_raw)#, Experiment=0, Recording=1)
-    data_float = get_data(data_dict)
-    data_ephys_short = data_float[:,:N_CH].T.astype(np.int16) # (N_channels, n_samples)
+    # read data as int16 bits (memmap); conversion to uV is done chunk by chunk in float32
+    data_dict, fs_dict = Binary.Load(session_folder_raw, Unit='Bits')#, Experiment=0, Recording=1)
+    data_bits = get_data(data_dict) # (n_samples, N_channels_all)
+    bit_volts = Binary.BitVolts(session_folder_raw)[:N_CH].astype(np.float32)
     sample_freq = get_data(fs_dict)
-    print("    data.shape=", data_ephys_short.shape, "F_SAMPLE=", sample_freq)
     # write to mda
-    n_ch= data_ephys_short.shape[0]
-    n_samples = data_ephys_short.shape[1]
+    n_ch = min(N_CH, data_bits.shape[1])
+    n_samples = data_bits.shape[0]
+    print("    data.shape=", (n_ch, n_samples), "F_SAMPLE=", sample_freq)
     mdapath = os.path.join(session_folder_mda, "converted_data.mda")
     writer = DiskWriteMda(mdapath, (n_ch, n_samples), dt="int16")
-    writer.writeChunk(data_ephys_short, i1=0, i2=0)
-    del data_ephys_short
+    filter_engine = FilterEngine(n_filter_threads)
+    stream_filter = None
+    if notch_freq>0:
+        stream_filter = StreamingSosFiltFilt(make_notch_sos(sample_freq, notch_freq, Q=20), n_ch, engine=filter_engine)
+    for beg_sample in range(0, n_samples, N_SAMPLES_PER_CHUNK):
+        end_sample = min(beg_sample+N_SAMPLES_PER_CHUNK, n_samples)
+        chunk_bits = data_bits[beg_sample:end_sample, :n_ch].T # (N_channels, n_samples) view of the memmap
+        if stream_filter is None:
+            writer.writeChunk(filter_engine.scale(chunk_bits, bit_volts[:n_ch], dtype=np.int16), i1=0, i2=beg_sample)
+        else:
+            out_beg, chunk_uv = stream_filter.process(filter_engine.scale(chunk_bits, bit_volts[:n_ch], dtype=np.float32))
+            if chunk_uv.shape[1] > 0:
+                writer.writeChunk(chunk_uv.astype(np.int16), i1=0, i2=out_beg)
+        del chunk_bits
+    if stream_filter is not None:
+        out_beg, chunk_uv = stream_filter.flush()
+        if chunk_uv.shape[1] > 0:
+            writer.writeChunk(chunk_uv.astype(np.int16), i1=0, i2=out_beg)
+    writer.close()
+    print("    Conversion throughput:", filter_engine.report(sample_freq))
+    filter_engine.close()
+    del data_bits
     gc.collect()
     print("  Session preprocessed in %.2f sec" % (time()-ts_session))
     info_struct = {}
     info_struct['sample_freq'] = sample_freq
-    info_struct['notch_freq'] = None
+    info_struct['notch_freq'] = notch_freq if notch_freq>0 else None
     info_struct['chs_info'] = {"OpenEphys": "O"}
     info_struct['n_samples'] = n_samples
     info_struct['tmp_mda_path'] = mdapath
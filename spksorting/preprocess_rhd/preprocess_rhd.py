@@ -8,16 +8,25 @@ import os
 import gc
 import warnings
 from copy import deepcopy
+from functools import partial
 from time import time
 
 import numpy as np
 # import pandas as pd
 # from scipy.io import loadmat, savemat
 
-from .load_intan_rhd_format import read_data, read_header, get_n_samples_in_data
+from .utils.load_intan_rhd_format_updated import read_data
 # from .utils.write_mda import writemda16i
-from .utils.filtering import notch_filter
-from .utils.mdaio import DiskWriteMda
+from .utils.filtering import scale_and_notch_int16, make_notch_sos, StreamingSosFiltFilt
+from .utils.filter_engine import FilterEngine
+from .utils.mdaio import StreamingMdaWriter
+from .utils.rhd_index import get_rhd_folder_index
+from .utils.rhd_parallel import decode_session_to_writer, decode_rhd_file_int16
+from .utils.rhd_stream import RHD_AMPLIFIER_UV_PER_BIT
+from .utils.rhd_events import get_session_dig_in_native_orders, extract_block_ttl_edges, TtlEventCollector, \
+    save_ttl_events, TTL_EVENTS_FILENAME
+from .utils.rhd_timestamps import get_session_timestamp_segments, save_timestamp_segments, describe_timestamp_gaps, \
+    TIMESTAMP_SEGMENTS_FILENAME
 
 def get_datetimestr_from_filename(filename):
     """
@@ -39,18 +48,53 @@ def check_header_consistency(hA, hB):
             return False
     return True
 
-def preprocess_one_session(session_folder_raw, session_folder_mda, verbose=True):
+def load_and_notch_rhd_file(rhd_path, channels, sample_freq, notch_freq, dig_in_native_orders=None):
+    '''
+    decode one rhd file and notch it if needed;
+    returns the amplifier data as int16 (n_ch, n_samples) in microvolts
+    `dig_in_native_orders`: if given, also decode the digital inputs and
+        return (amplifier data, TTL edges of the file)
+    '''
+    print("    %s"%(rhd_path))
+    # amplifier data stay int16 (ADC counts) end-to-end; conversion to microvolts
+    # and notching happen in place on small float32 channel blocks
+    streams = ('amplifier',) if dig_in_native_orders is None else ('amplifier', 'board_dig_in')
+    data_dict = read_data(rhd_path, channels=channels, amplifier_int16=True, streams=streams, time_vectors=False)
+    ephys_data = data_dict['amplifier_data']
+    uv_per_bit = data_dict['amplifier_conversion']
+    file_edges = None
+    if dig_in_native_orders is not None:
+        file_edges = extract_block_ttl_edges(data_dict['board_dig_in_raw'], dig_in_native_orders)
+    del data_dict
+    ts_notch = time()
+    if notch_freq>0:
+        print("    Applying notch")
+    scale_and_notch_int16(ephys_data, uv_per_bit, sample_freq, notch_freq, Q=20)
+    print("    Notching done: time elapsed: %.2f sec" % (time()-ts_notch))
+    gc.collect()
+    if dig_in_native_orders is not None:
+        return ephys_data, file_edges
+    return ephys_data
+
+def preprocess_one_session(session_folder_raw, session_folder_mda, verbose=True, n_workers=1, max_inflight=None, streaming_notch=True, n_filter_threads=None):
     '''
     preprocess one session of rhd files -> store in mda format.
     Automatically creates folder for mda file if it does not already exist
+    `n_workers`: number of processes decoding and notching rhd files in parallel;
+        decoded files are written in order by this process. 
+    `max_inflight`: max number of decoded files held in memory (default 2*n_workers)
+    `streaming_notch`: if True the notch filter runs over the whole session as one
+        continuous stream (no edge transients at file seams); otherwise each
+        file is notched separately by the decoding processes
+    `n_filter_threads`: threads filtering channels in parallel in the streaming notch (default: all cores)
     '''
     ts_session = time()
-    filenames = os.listdir(session_folder_raw)
-    filenames = list(filter(lambda x: x.endswith(".rhd"), filenames))
-    if len(filenames)==0:
+    # headers and sample counts of all files come from the folder index (sidecar), sorted by time
+    rhd_index = get_rhd_folder_index(session_folder_raw)
+    if len(rhd_index["files"])==0:
         print("****Empty Session:", os.listdir(session_folder_raw))
         return
-    filenames = sorted(filenames, key=get_datetimestr_from_filename) # sort by time
+    filenames = [e["filename"] for e in rhd_index["files"]]
     print("  Starting session: %s" % (session_folder_raw))
     if not os.path.exists(session_folder_mda):
         os.makedirs(session_folder_mda)
@@ -64,32 +108,43 @@ def preprocess_one_session(session_folder_raw, session_folder_mda, verbose=True)
     sample_freq = None
 
     # first get the number of data in each .rhd file, ASSUMING all files have the same #channels
-    n_samples_cumsum_by_file = [0]
-    n_samples = 0
-    n_ch = 999999
-    for filename in filenames:
-        n_ch_, n_samples_this_file = get_n_samples_in_data(os.path.join(session_folder_raw, filename))
-        n_ch = min(n_ch, n_ch_)
-        print(n_ch)
-        n_samples += n_samples_this_file
-        n_samples_cumsum_by_file.append(n_samples)
+    n_samples_cumsum_by_file = rhd_index["n_samples_cumsum"]
+    n_samples = n_samples_cumsum_by_file[-1]
+    n_ch_by_file = [e["n_channels"] for e in rhd_index["files"]]
+    n_ch = min(n_ch_by_file)
 
     # TODO directly ERROR OUT if n_ch>32
     n_ch = min(n_ch, 32)
     if verbose:
         print("#channels:", n_ch)
 
-    # prepare writer
+    # prepare writer; disk writes happen in a background thread while the next files are decoded
     mdapath = os.path.join(session_folder_mda, "converted_data.mda")
-    writer = DiskWriteMda(mdapath, (n_ch, n_samples), dt="int16")
+    writer = StreamingMdaWriter(mdapath, (n_ch, n_samples), dt="int16")
     
-    # load data from intan and use writer to append data to one single .mda file
+    # check key information of every file from the index before decoding anything
+    ch_masks = []
     for i_file, filename in enumerate(filenames):
-        print("    %s"%(os.path.join(session_folder_raw, filename)))
-        with open(os.path.join(session_folder_raw, filename), "rb") as fh:
-            head_dict = read_header(fh)
-        data_dict = read_data(os.path.join(session_folder_raw, filename))
-        chs_info = deepcopy(data_dict['amplifier_channels'])
+        head_dict = rhd_index["files"][i_file]["header"]
+        ####------------------------------------------------------
+        #### TO ACCOMODATE NORA'S INTAN RECORDING SETTINGS; sometimes there are fewer channels; sometimes there are 64 channels (only 16-47 in PORT A are good).
+        # the extra channels are dropped while decoding so that they are never scaled or copied
+        ch_mask = None
+        if n_ch_by_file[i_file] > n_ch:
+            ch_mask = np.zeros(n_ch_by_file[i_file], dtype=bool)
+            ch_mask[16:16+n_ch] = True
+            warnstr  = "WARNING IN preprocess_rhd: %s has "%(filename)
+            warnstr +=  "%d channels, which is more than the %d present throughout session."%(n_ch_by_file[i_file], n_ch)
+            warnstr += " CLIPPING extras! Keeping only data[%d:%d, :]" % (16, 16+n_ch)
+            warnings.warn(warnstr)
+            if np.sum(ch_mask) < n_ch:
+                warnings.warn("After clipping, the #channels kept is %d < %d"%(np.sum(ch_mask), n_ch))
+        ####------------------------------------------------------
+        ch_masks.append(ch_mask)
+        if ch_mask is None:
+            chs_info = deepcopy(head_dict['amplifier_channels'])
+        else:
+            chs_info = deepcopy([head_dict['amplifier_channels'][i] for i in np.nonzero(ch_mask)[0]])
         # record and check key information
         if chs_native_order is None:
             chs_native_order = [e['native_order'] for e in chs_info]
@@ -100,36 +155,59 @@ def preprocess_one_session(session_folder_raw, session_folder_mda, verbose=True)
             print("        sampleFreq=",sample_freq, " NotchFreq=", notch_freq)
         else:
             tmp_native_order = [e['native_order'] for e in chs_info]
-            print("        #Chans with >= 3MOhm impedance:", np.sum(np.array([e['electrode_impedance_magnitude'] for e in chs_info])>=3e6))
             if not check_header_consistency(tmp_native_order, chs_native_order):
                 warnings.warn("        WARNING in preprocess_rhd: native ordering of channels inconsistent within one session\n")
             if notch_freq != head_dict['notch_filter_frequency']:
                 warnings.warn("        WARNING in preprocess_rhd: notch frequency inconsistent within one session\n")
             if sample_freq != head_dict['sample_rate']:
                 warnings.warn("        WARNING in preprocess_rhd: sampling frequency inconsistent within one session\n")
-        ephys_data = data_dict['amplifier_data']
-        ####------------------------------------------------------
-        #### TO ACCOMODATE NORA'S INTAN RECORDING SETTINGS; sometimes there are fewer channels; sometimes there are 64 channels (only 16-47 in PORT A are good).
-        if ephys_data.shape[0] > n_ch:
-            ephys_data = ephys_data[16:16+n_ch, :]
-            warnstr  = "WARNING IN preprocess_rhd: this rhd file has "
-            warnstr +=  "%d channels, which is more than the %d present throughout session."%(ephys_data.shape[0], n_ch)
-            warnstr += " CLIPPING extras! Keeping only data[%d:%d, :]" % (16, 16+n_ch)
-            warnings.warn(warnstr)
-            if ephys_data.shape[0] < n_ch:
-                warnings.warn("After clipping, the #channels kept is %d < %d"%(ephys_data.shape[0], n_ch))
-        ####------------------------------------------------------
-        ts_notch = time()
-        if notch_freq>0:
-            print("    Applying notch")
-            ephys_data = notch_filter(ephys_data, sample_freq, notch_freq, Q=20)
-        ephys_data = ephys_data.astype(np.int16)
-        print("    Notching done: time elapsed: %.2f sec" % (time()-ts_notch))
-        print("    Appending to disk at: %s; data shape=(%d,%d)" % (mdapath, ephys_data.shape[0], ephys_data.shape[1])) # (n_ch, n_samples)
-        entry_offset = n_samples_cumsum_by_file[i_file]*n_ch
-        writer.writeChunk(ephys_data, i1=0, i2=entry_offset)
-        del ephys_data
-        gc.collect()
+
+    # digital input edges are found while each file is decoded and kept as a sparse event table next to the mda
+    dig_in_native_orders = get_session_dig_in_native_orders(rhd_index)
+    ttl_collector = None
+    if dig_in_native_orders.shape[0] > 0:
+        ttl_collector = TtlEventCollector(dig_in_native_orders, sample_freq)
+    else:
+        dig_in_native_orders = None
+    # load data from intan (n_workers files in parallel) and let the writer put each file at its offset in one single .mda file
+    stream_filter = None
+    filter_engine = None
+    prefilter_fn = None
+    if streaming_notch and notch_freq>0:
+        filter_engine = FilterEngine(n_filter_threads)
+        stream_filter = StreamingSosFiltFilt(make_notch_sos(sample_freq, notch_freq, Q=20), n_ch, engine=filter_engine)
+        # workers only decode int16 counts; microvolts are truncated to int16 once, after the notch
+        decode_fn = partial(decode_rhd_file_int16, dig_in_native_orders=dig_in_native_orders)
+        prefilter_fn = partial(filter_engine.scale, factors=RHD_AMPLIFIER_UV_PER_BIT, dtype=np.float32)
+        if verbose:
+            print("  Applying streaming notch at %d Hz across the session" % (notch_freq))
+    else:
+        decode_fn = partial(load_and_notch_rhd_file, sample_freq=sample_freq, notch_freq=notch_freq, dig_in_native_orders=dig_in_native_orders)
+    decode_session_to_writer(
+        session_folder_raw, rhd_index, writer, n_workers=n_workers,
+        max_inflight=max_inflight, channels_by_file=ch_masks, decode_fn=decode_fn,
+        stream_filter=stream_filter, prefilter_fn=prefilter_fn, ttl_collector=ttl_collector
+    )
+    writer.close() # waits for the pending writes
+    if filter_engine is not None:
+        if verbose:
+            print("  Notch filter throughput:", filter_engine.report(sample_freq))
+        filter_engine.close()
+    ttl_path = None
+    if ttl_collector is not None:
+        ttl_events = ttl_collector.result(n_samples)
+        ttl_path = os.path.join(session_folder_mda, TTL_EVENTS_FILENAME)
+        save_ttl_events(ttl_path, ttl_events)
+        if verbose:
+            print("  %d TTL edges saved to %s" % (ttl_events["events"].shape[0], ttl_path))
+    # dropped or repeated samples break the sample->time mapping; keep the segments to map TTL/spike samples to time
+    ts_segments = get_session_timestamp_segments(session_folder_raw, rhd_index)
+    ts_segments_path = None
+    if ts_segments["gaps"].shape[0] > 0:
+        ts_segments_path = os.path.join(session_folder_mda, TIMESTAMP_SEGMENTS_FILENAME)
+        save_timestamp_segments(ts_segments_path, ts_segments)
+        warnings.warn("WARNING IN preprocess_rhd: %s has %s. Timestamp segments saved to %s" % (
+            session_folder_raw, describe_timestamp_gaps(ts_segments["gaps"], sample_freq), ts_segments_path))
     print("  Session preprocessed in %.2f sec" % (time()-ts_session))
     info_struct = {}
     info_struct['sample_freq'] = sample_freq
@@ -138,5 +216,7 @@ def preprocess_one_session(session_folder_raw, session_folder_mda, verbose=True)
     info_struct['n_samples'] = n_samples
     info_struct['tmp_mda_path'] = mdapath
     info_struct['tmp_mda_folder'] = session_folder_mda
+    info_struct['ttl_events_path'] = ttl_path
+    info_struct['timestamp_segments_path'] = ts_segments_path
     # #info_struct is returned so that the calling context can write it to disk
     return info_struct
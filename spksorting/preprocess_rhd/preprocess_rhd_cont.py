@@ -7,16 +7,16 @@ then in downstream processing these mda files will be spike-sorted separately an
 import os
 import gc
 import warnings
-from copy import deepcopy
 
 import numpy as np
 import pandas as pd
 from scipy.io import loadmat, savemat
 
-from load_intan_rhd_format import read_data, read_header, get_n_samples_in_data
-from utils.write_mda import writemda16i
-from utils.filtering import notch_filter
-from utils.mdaio import DiskWriteMda
+from utils.filtering import make_notch_sos, StreamingSosFiltFilt
+from utils.filter_engine import FilterEngine
+from utils.mdaio import StreamingMdaWriter
+from utils.rhd_index import get_rhd_folder_index
+from utils.rhd_stream import iter_rhd_session_chunks, RHD_AMPLIFIER_UV_PER_BIT
 
 # given a session
 DATA_ROOTPATH = "/media/hanlin/Liuyang_10T_backup/jiaaoZ/data/"
@@ -30,24 +30,15 @@ SESSION_FOLDER_MDA = os.path.join(MDA_ROOTPATH, SESSION_REL_PATH)
 # GEOM_ROOTPATH  = "/media/luanlab/Data_Processing/Jim-Zhang/Spike-Sort/spikesort_out"
 # SESSION_FOLDER_CSV = os.path.join(GEOM_ROOTPATH, SESSION_REL_PATH)
 
-def get_datetimestr_from_filename(filename):
-    """
-        Assume the rhd filename takes the form of either
-        ParentPath/Animalname_YYMMDD_HHMMSS.rhd
-        or 
-        Animialname_YYMMDD_HHMMSS.rhd
-    """
-    tmp = filename.split("/")[-1].split("_")
-    return tmp[1]+'_'+tmp[2].split('.')[0]
-
-filenames = os.listdir(SESSION_FOLDER_RAW)
-filenames = list(filter(lambda x: x.endswith(".rhd"), filenames))
-filenames = sorted(filenames, key=get_datetimestr_from_filename) # sort by time
+# file order, sample counts and headers come from the folder index
+rhd_index = get_rhd_folder_index(SESSION_FOLDER_RAW)
+filenames = [e["filename"] for e in rhd_index["files"]]
+n_samples_cumsum_by_file = rhd_index["n_samples_cumsum"]
 
 segment_size = 48 # number of .rhd files (5min per file) for each segment
 n_segments = int(np.ceil(len(filenames)/segment_size))
 
-segment_files_list = [filenames[i*segment_size:(i+1)*segment_size] for i in range(n_segments)]
+chunk_samples = 30000*10 # samples per chunk streamed from the rhd files
 
 if not os.path.exists(SESSION_FOLDER_MDA):
     os.makedirs(SESSION_FOLDER_MDA)
@@ -64,59 +55,72 @@ def check_header_consistency(hA, hB):
     return True
 
 ### REMEMBER native order starts from 0 ###
-# data_rhd_list = []
-chs_native_order = None
-chs_impedance = None
-notch_freq = None
-sample_freq = None
-for i_seg, seg_filenames in enumerate(segment_files_list):
-    # save all data in seg_filenames into a single .mda
-
-    # first get the number of data in each .rhd file, ASSUMING all files have the same #channels
-    n_samples_cumsum_by_file = [0]
-    n_samples = 0
-    for filename in seg_filenames:
-        n_ch, n_samples_this_file =get_n_samples_in_data(os.path.join(SESSION_FOLDER_RAW, filename))
-        n_samples += n_samples_this_file
-        n_samples_cumsum_by_file.append(n_samples)
-    
-    # prepare writer
+# record and check key information
+head_dict = rhd_index["files"][0]["header"]
+chs_native_order = [e['native_order'] for e in head_dict['amplifier_channels']]
+chs_impedance = [e['electrode_impedance_magnitude'] for e in head_dict['amplifier_channels']]
+print("#Chans with >= 3MOhm impedance:", np.sum(np.array(chs_impedance)>=3e6))
+notch_freq = head_dict['notch_filter_frequency']
+sample_freq = head_dict['sample_rate']
+print("sampleFreq=",sample_freq, " NotchFreq=", notch_freq)
+for rhd_entry in rhd_index["files"][1:]:
+    head_dict = rhd_entry["header"]
+    if not check_header_consistency([e['native_order'] for e in head_dict['amplifier_channels']], chs_native_order):
+        warnings.warn("WARNING in preprocess_rhd: native ordering of channels inconsistent within one session: %s\n"%(rhd_entry["filename"]))
+    if notch_freq != head_dict['notch_filter_frequency']:
+        warnings.warn("WARNING in preprocess_rhd: notch frequency inconsistent within one session: %s\n"%(rhd_entry["filename"]))
+    if sample_freq != head_dict['sample_rate']:
+        warnings.warn("WARNING in preprocess_rhd: sampling frequency inconsistent within one session: %s\n"%(rhd_entry["filename"]))
+
+def get_segment_bounds(i_seg):
+    # segment i_seg holds all data of files [i_seg*segment_size, (i_seg+1)*segment_size)
+    seg_beg_sample = n_samples_cumsum_by_file[i_seg*segment_size]
+    seg_end_sample = n_samples_cumsum_by_file[min((i_seg+1)*segment_size, len(filenames))]
+    return seg_beg_sample, seg_end_sample
+
+def open_segment_writer(i_seg):
+    seg_beg_sample, seg_end_sample = get_segment_bounds(i_seg)
+    n_ch = rhd_index["files"][i_seg*segment_size]["n_channels"]
     seg_mdapath = os.path.join(SESSION_FOLDER_MDA, "converted_data_seg%d.mda"%(i_seg+1))
     print("Creating Writer for %d"%(i_seg))
-    writer = DiskWriteMda(seg_mdapath, (n_ch, n_samples), dt="int16")
-    
-    # load data from intan and use writer to append data to one single .mda file
-    for i_file, filename in enumerate(seg_filenames):
-        print("----%s----"%(os.path.join(SESSION_FOLDER_RAW, filename)))
-        with open(os.path.join(SESSION_FOLDER_RAW, filename), "rb") as fh:
-            head_dict = read_header(fh)
-        data_dict = read_data(os.path.join(SESSION_FOLDER_RAW, filename))
-        chs_info = deepcopy(data_dict['amplifier_channels'])
-        
-        # record and check key information
-        if chs_native_order is None:
-            chs_native_order = [e['native_order'] for e in chs_info]
-            chs_impedance = [e['electrode_impedance_magnitude'] for e in chs_info]
-            print("#Chans with >= 3MOhm impedance:", np.sum(np.array(chs_impedance)>=3e6))
-            notch_freq = head_dict['notch_filter_frequency']
-            sample_freq = head_dict['sample_rate']
-            print("sampleFreq=",sample_freq, " NotchFreq=", notch_freq)
-        else:
-            tmp_native_order = [e['native_order'] for e in chs_info]
-            print("#Chans with >= 3MOhm impedance:", np.sum(np.array([e['electrode_impedance_magnitude'] for e in chs_info])>=3e6))
-            if not check_header_consistency(tmp_native_order, chs_native_order):
-                warnings.warn("WARNING in preprocess_rhd: native ordering of channels inconsistent within one session\n")
-            if notch_freq != head_dict['notch_filter_frequency']:
-                warnings.warn("WARNING in preprocess_rhd: notch frequency inconsistent within one session\n")
-            if sample_freq != head_dict['sample_rate']:
-                warnings.warn("WARNING in preprocess_rhd: sampling frequency inconsistent within one session\n")
-        
-        ephys_data = data_dict['amplifier_data']
-        # if notch_freq>0:
-        #     print("Applying notch")
-        #     ephys_data = notch_filter(ephys_data, sample_freq, notch_freq, Q=20)
-        ephys_data = ephys_data.astype(np.int16)
-        print("Appending to disk at: %s" % (seg_mdapath))
-        entry_offset = n_samples_cumsum_by_file[i_file]*n_ch
-        writer.writeChunk(ephys_data, i1=0, i2=entry_offset)
+    return StreamingMdaWriter(seg_mdapath, (n_ch, seg_end_sample-seg_beg_sample), dt="int16")
+
+# the whole session is streamed (and notched) as one continuous signal, so the
+# notch has no transients at file or segment seams; each filtered block is
+# written to the segment file(s) it falls into
+n_ch_session = rhd_index["files"][0]["n_channels"]
+stream_filter = None
+filter_engine = FilterEngine() # channels are scaled and filtered on all cores
+if notch_freq>0:
+    print("Applying streaming notch at %d Hz" % (notch_freq))
+    stream_filter = StreamingSosFiltFilt(make_notch_sos(sample_freq, notch_freq, Q=20), n_ch_session, engine=filter_engine)
+writers = {}
+def write_block(beg_sample, ephys_data):
+    end_sample = beg_sample + ephys_data.shape[1]
+    for i_seg in range(n_segments):
+        seg_beg_sample, seg_end_sample = get_segment_bounds(i_seg)
+        if seg_end_sample <= beg_sample or seg_beg_sample >= end_sample:
+            continue
+        if i_seg not in writers:
+            writers[i_seg] = open_segment_writer(i_seg)
+        b = max(beg_sample, seg_beg_sample)
+        e = min(end_sample, seg_end_sample)
+        writers[i_seg].writeChunk(ephys_data[:, b-beg_sample:e-beg_sample], i1=0, i2=b-seg_beg_sample)
+        if e == seg_end_sample:
+            writers.pop(i_seg).close() # waits for the pending writes
 
+for chunk in iter_rhd_session_chunks(SESSION_FOLDER_RAW, chunk_samples, rhd_index=rhd_index):
+    # converted data are stored in microvolts
+    if stream_filter is None:
+        beg_sample = chunk.beg_sample
+        ephys_data = filter_engine.scale(chunk.data, RHD_AMPLIFIER_UV_PER_BIT, dtype=np.int16)
+    else:
+        ephys_data = filter_engine.scale(chunk.data, RHD_AMPLIFIER_UV_PER_BIT, dtype=np.float32)
+        beg_sample, ephys_data = stream_filter.process(ephys_data)
+    print("Writing samples %d-%d" % (beg_sample, beg_sample+ephys_data.shape[1]))
+    write_block(beg_sample, ephys_data.astype(np.int16))
+if stream_filter is not None:
+    beg_sample, ephys_data = stream_filter.flush()
+    write_block(beg_sample, ephys_data.astype(np.int16))
+print("Filtering throughput:", filter_engine.report(sample_freq))
+filter_engine.close()
@@ -109,6 +109,5 @@ for i_file, filename in enumerate(filenames):
     #     ephys_data = notch_filter(ephys_data, sample_freq, notch_freq, Q=20)
     ephys_data = ephys_data.astype(np.int16)
     print("Appending to disk at: %s" % (mdapath))
-    entry_offset = n_samples_cumsum_by_file[i_file]*n_ch
-    writer.writeChunk(ephys_data, i1=0, i2=entry_offset)
+    writer.writeChunk(ephys_data, i1=0, i2=n_samples_cumsum_by_file[i_file])
 print("Done")
@@ -111,8 +111,7 @@ def preprocess_one_session(session_folder_raw, session_folder_mda, verbose=True)
         ephys_data = ephys_data.astype(np.int16)
         print("    Notching done: time elapsed: %.2f sec" % (time()-ts_notch))
         print("    Appending to disk at: %s; data shape=(%d,%d)" % (mdapath, ephys_data.shape[0], ephys_data.shape[1])) # (n_ch, n_samples)
-        entry_offset = n_samples_cumsum_by_file[i_file]*n_ch
-        writer.writeChunk(ephys_data, i1=0, i2=entry_offset)
+        writer.writeChunk(ephys_data, i1=0, i2=n_samples_cumsum_by_file[i_file])
         del ephys_data
         gc.collect()
     print("  Session preprocessed in %.2f sec" % (time()-ts_session))
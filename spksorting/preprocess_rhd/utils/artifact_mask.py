@@ -0,0 +1,191 @@
+'''
+Artifact masking with a persisted list of masked intervals.
+
+Same detection as ephys.mask_out_artifacts: the recording is cut into
+intervals of `interval_size` samples, the norm of each channel over each
+interval is computed, and an interval is an artifact when the norm of any
+channel exceeds mean + threshold*std of that channel's norms; its two
+neighbours are masked too. (ml_ephys skips the neighbours of the very first
+interval because of a negative slice index; here they are always masked.)
+
+Instead of rewriting the whole recording with the artifacts set to zero,
+the masked intervals are saved as a small JSON file with the session
+(artifact_intervals.json, 0-based [start, end) sample ranges) and applied
+when the data is read (`MaskedMdaReader`, `mask_chunk`), or written over in
+place (`mask_mda_in_place`) for programs that must read a plain .mda file.
+The norms can be accumulated by the pass that writes the data
+(`IntervalNormAccumulator`), so detection needs no extra read either.
+'''
+import os
+import json
+
+import numpy as np
+
+from .mdaio import DiskReadMda, _read_header
+
+ARTIFACT_INTERVALS_FNAME = "artifact_intervals.json"
+DEFAULT_THRESHOLD = 6
+DEFAULT_INTERVAL_SIZE = 2000
+
+
+class IntervalNormAccumulator:
+    """Per-channel sum of squares over each interval of `interval_size` samples, fed chunk by chunk in any order."""
+    def __init__(self, n_ch, n_samples, interval_size=DEFAULT_INTERVAL_SIZE):
+        self.n_samples = n_samples
+        self.interval_size = interval_size
+        self.sumsq = np.zeros((n_ch, -(-n_samples//interval_size)), dtype=np.float64)
+    def add(self, t1, chunk):
+        """`chunk`: samples [t1, t1+chunk.shape[1]) of the recording."""
+        n = chunk.shape[1]
+        if n == 0:
+            return
+        i_first, i_last = t1//self.interval_size, (t1+n-1)//self.interval_size
+        # start of each interval touched by the chunk, relative to the chunk
+        starts = np.maximum(np.arange(i_first, i_last+1)*self.interval_size - t1, 0)
+        sq = np.square(np.asarray(chunk, dtype=np.float64))
+        self.sumsq[:, i_first:i_last+1] += np.add.reduceat(sq, starts, axis=1)
+    def norms(self):
+        return np.sqrt(self.sumsq)
+
+
+def detect_artifacts(norms, threshold=DEFAULT_THRESHOLD):
+    """Boolean mask of the artifact intervals (neighbours included) from the (n_ch, n_intervals) norms."""
+    n_intervals = norms.shape[1]
+    is_artifact = np.zeros(n_intervals, dtype=bool)
+    for vals in norms:
+        for i in np.where(vals > np.mean(vals)+np.std(vals)*threshold)[0]:
+            is_artifact[max(0, i-1):i+2] = True
+    return is_artifact
+
+
+def get_artifact_intervals(is_artifact, interval_size, n_samples):
+    """Merge consecutive artifact intervals into an (n, 2) int64 array of [start, end) samples."""
+    flags = np.concatenate([[False], is_artifact, [False]]).astype(np.int8)
+    edges = np.diff(flags)
+    starts = np.where(edges == 1)[0] * interval_size
+    ends = np.minimum(np.where(edges == -1)[0] * interval_size, n_samples)
+    return np.stack([starts, ends], axis=1).astype(np.int64)
+
+
+def get_artifact_intervals_path(session_folder):
+    return os.path.join(session_folder, ARTIFACT_INTERVALS_FNAME)
+
+
+def save_artifact_intervals(path, intervals, n_samples, threshold=DEFAULT_THRESHOLD, interval_size=DEFAULT_INTERVAL_SIZE):
+    info = {
+        "threshold": threshold,
+        "interval_size": interval_size,
+        "n_samples": int(n_samples),
+        "n_masked_samples": int(np.sum(intervals[:, 1]-intervals[:, 0])) if len(intervals) > 0 else 0,
+        "intervals": [[int(t1), int(t2)] for t1, t2 in intervals],
+    }
+    with open(path, "w") as f:
+        json.dump(info, f)
+
+
+def load_artifact_intervals(path):
+    """(n, 2) int64 array of masked [start, end) samples; `path` may be the session folder."""
+    if os.path.isdir(path):
+        path = get_artifact_intervals_path(path)
+    with open(path, "r") as f:
+        info = json.load(f)
+    return np.array(info["intervals"], dtype=np.int64).reshape(-1, 2)
+
+
+def times_in_intervals(times, intervals):
+    """Boolean mask of the sample indices `times` (0-based) that fall inside the intervals."""
+    times = np.asarray(times)
+    if len(intervals) == 0:
+        return np.zeros(times.shape, dtype=bool)
+    i = np.searchsorted(intervals[:, 0], times, side="right") - 1
+    return (i >= 0) & (times < intervals[np.maximum(i, 0), 1])
+
+
+def mask_chunk(chunk, t1, intervals):
+    """Zero, in place, the samples of `chunk` (samples [t1, t1+chunk.shape[-1]) of the recording) inside the intervals."""
+    t2 = t1 + chunk.shape[-1]
+    for a, b in intervals[(intervals[:, 1] > t1) & (intervals[:, 0] < t2)]:
+        chunk[..., max(a, t1)-t1:min(b, t2)-t1] = 0
+    return chunk
+
+
+def mask_mda_in_place(path, intervals):
+    """Overwrite the samples of the (n_ch, n_samples) .mda file inside the intervals with zeros."""
+    H = _read_header(path)
+    if H is None:
+        raise IOError("Unable to read header of %s" % (path))
+    n_ch = H.dims[0]
+    with open(path, "r+b") as f:
+        for t1, t2 in intervals:
+            f.seek(H.header_size + H.num_bytes_per_entry*n_ch*int(t1))
+            f.write(np.zeros(n_ch*int(t2-t1), dtype=H.dt).tobytes())
+
+
+class MaskedMdaReader:
+    """
+    Read-only view of an (n_ch, n_samples) recording (a DiskReadMda-like
+    reader or a path) with the artifact intervals set to zero on read.
+    """
+    def __init__(self, source, intervals):
+        self._own_reader = isinstance(source, str)
+        self._reader = DiskReadMda(source) if self._own_reader else source
+        self.intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        if self._own_reader and self._reader is not None:
+            self._reader.close()
+        self._reader = None
+    def dims(self):
+        return self._reader.dims()
+    def N1(self):
+        return self._reader.N1()
+    def N2(self):
+        return self._reader.N2()
+    def dt(self):
+        return self._reader.dt()
+    def readChunk(self, i1=0, N1=None, i2=0, N2=1):
+        if N1 is None:
+            N1 = self.N1()
+        X = self._reader.readChunk(i1=i1, N1=N1, i2=i2, N2=N2)
+        if X is None:
+            return None
+        return mask_chunk(np.array(X), i2, self.intervals)
+
+
+def detect_artifacts_mda(timeseries, threshold=DEFAULT_THRESHOLD, interval_size=DEFAULT_INTERVAL_SIZE,
+        chunk_size=DEFAULT_INTERVAL_SIZE*15, intervals_out=None):
+    """
+    Streaming detection pass over the (whitened) .mda file `timeseries`.
+    Saves the intervals to `intervals_out` (default: artifact_intervals.json
+    next to `timeseries`) and returns them.
+    """
+    with DiskReadMda(timeseries) as reader:
+        n_ch, n_samples = reader.N1(), reader.N2()
+        acc = IntervalNormAccumulator(n_ch, n_samples, interval_size)
+        for t1 in range(0, n_samples, chunk_size):
+            n = min(chunk_size, n_samples-t1)
+            acc.add(t1, reader.readChunk(i1=0, N1=n_ch, i2=t1, N2=n))
+    intervals = get_artifact_intervals(detect_artifacts(acc.norms(), threshold), interval_size, n_samples)
+    if intervals_out is None:
+        intervals_out = get_artifact_intervals_path(os.path.dirname(os.path.abspath(timeseries)))
+    save_artifact_intervals(intervals_out, intervals, n_samples, threshold, interval_size)
+    print("Masked %d intervals (%d of %d samples)" % (len(intervals), np.sum(intervals[:, 1]-intervals[:, 0]), n_samples))
+    return intervals
+
+
+if __name__ == '__main__':
+    # e.g. `python -m utils.artifact_mask pre1.mda --in_place` to detect and mask artifacts like ephys.mask_out_artifacts
+    import argparse
+    parser = argparse.ArgumentParser(description="Detect artifact intervals of a .mda recording and save them as JSON")
+    parser.add_argument("timeseries")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--interval_size", type=int, default=DEFAULT_INTERVAL_SIZE)
+    parser.add_argument("--intervals_out", default=None)
+    parser.add_argument("--in_place", action="store_true", help="also zero the intervals in the file")
+    args = parser.parse_args()
+    intervals = detect_artifacts_mda(args.timeseries, args.threshold, args.interval_size, intervals_out=args.intervals_out)
+    if args.in_place:
+        mask_mda_in_place(args.timeseries, intervals)
@@ -0,0 +1,214 @@
+"""
+In-process replacement of the `ephys.bandpass_filter` stage of MountainSort.
+
+The frequency response is the one of ml_ephys (create_filter_kernel: erf
+roll-offs at freq_min and freq_max, DC removed, square root applied to the
+spectral intensity), applied in the frequency domain to overlapping chunks
+of the recording: each chunk of `chunk_size` samples is read with `padding`
+samples on both sides, filtered, and only its center is written, like
+ml_ephys does. The filtered chunks can be common average (or median)
+referenced on the way (`reference`, see common_reference.py). Channels of a chunk are filtered in parallel by a
+`FilterEngine`, the next chunk is read while the current one is filtered,
+and filt.mda is written directly instead of going through
+$ML_TEMPORARY_DIRECTORY.
+"""
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+from scipy import special
+
+from .mdaio import DiskReadMda, StreamingMdaWriter
+from .filter_engine import FilterEngine
+from .common_reference import get_reference, REFERENCE_METHODS
+
+DEFAULT_FREQ_MIN = 250
+DEFAULT_FREQ_MAX = 5000
+DEFAULT_FREQ_WID = 1000
+DEFAULT_PADDING = 3000
+DEFAULT_CHUNK_SIZE = 30000 # same as ml_ephys, so that the output matches ephys.bandpass_filter
+
+
+@lru_cache(maxsize=8)
+def _get_kernel_cached(n, samplerate, freq_min, freq_max, freq_wid):
+    kernel = create_filter_kernel(n, samplerate, freq_min, freq_max, freq_wid)
+    kernel.flags.writeable = False
+    return kernel
+
+
+def create_filter_kernel(n, samplerate, freq_min, freq_max, freq_wid=DEFAULT_FREQ_WID):
+    """
+    Gain of the ml_ephys bandpass filter at the np.fft.rfftfreq(n, 1/samplerate)
+    frequencies (0 disables the corresponding edge).
+    """
+    absf = np.arange(n//2+1) * (samplerate/n)
+    relwid = 3.0 # relative width of the low roll-off; kills low frequencies by 1e-5
+    val = np.ones(absf.shape)
+    if freq_min != 0:
+        val = val * (1 + special.erf(relwid*(absf-freq_min)/freq_min)) / 2
+        val[0] = 0 # remove DC exactly
+    if freq_max != 0:
+        val = val * (1 - special.erf((absf-freq_max)/freq_wid)) / 2
+    return np.sqrt(val) # the filter function applies to the spectral intensity, not the amplitude
+
+
+def bandpass_filter(x, samplerate, freq_min=DEFAULT_FREQ_MIN, freq_max=DEFAULT_FREQ_MAX,
+        freq_wid=DEFAULT_FREQ_WID, engine=None, dtype=np.float32):
+    """Bandpass filter each row of `x` (n_ch, n_samples) at once in the frequency domain."""
+    kernel = _get_kernel_cached(x.shape[1], float(samplerate), float(freq_min), float(freq_max), float(freq_wid))
+    if engine is None:
+        engine = FilterEngine(n_threads=1)
+    return engine.fft_filter(x, kernel, dtype=dtype)
+
+
+def get_chunk_bounds(n_samples, chunk_size, padding):
+    """List of (t1, t2, s1, s2): written range [t1, t2) read with padding as [s1, s2)."""
+    bounds = []
+    for t1 in range(0, n_samples, chunk_size):
+        t2 = min(n_samples, t1+chunk_size)
+        bounds.append((t1, t2, max(0, t1-padding), min(n_samples, t2+padding)))
+    return bounds
+
+
+def iter_chunks(reader, bounds, chunk_inds=None):
+    """
+    Yield ((t1, t2, s1, s2), data[:, s1:s2]) for the chunks `chunk_inds` (default:
+    all) of `bounds` (see get_chunk_bounds) from the (n_ch, n_samples) `reader`,
+    reading the next chunk in a background thread while the current one is used.
+    """
+    if chunk_inds is None:
+        chunk_inds = range(len(bounds))
+    chunk_inds = list(chunk_inds)
+    n_ch = reader.N1()
+    def _read(i_chunk):
+        _, _, s1, s2 = bounds[i_chunk]
+        return reader.readChunk(i1=0, N1=n_ch, i2=s1, N2=s2-s1)
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_chunk = prefetcher.submit(_read, chunk_inds[0]) if len(chunk_inds) > 0 else None
+        for i, i_chunk in enumerate(chunk_inds):
+            chunk = next_chunk.result()
+            if i+1 < len(chunk_inds):
+                next_chunk = prefetcher.submit(_read, chunk_inds[i+1])
+            if chunk is None:
+                raise IOError("Failed to read samples %d-%d" % (bounds[i_chunk][2], bounds[i_chunk][3]))
+            yield bounds[i_chunk], chunk
+
+
+def iter_bandpass_chunks(reader, samplerate, freq_min=DEFAULT_FREQ_MIN, freq_max=DEFAULT_FREQ_MAX,
+        freq_wid=DEFAULT_FREQ_WID, padding=DEFAULT_PADDING, chunk_size=DEFAULT_CHUNK_SIZE,
+        chunk_inds=None, engine=None, dtype=np.float32, reference=None, ref_channels=None):
+    """
+    Yield (t1, t2, filtered samples [t1, t2)) of the recording in `reader` for
+    the chunks `chunk_inds` (default: all) of `chunk_size` samples; the
+    result does not depend on which chunks are requested.
+    `reference`: None, or "mean" (CAR) / "median" (CMR) across `ref_channels`
+        (default: all) subtracted from every channel of the filtered chunks
+    """
+    bounds = get_chunk_bounds(reader.N2(), chunk_size, padding)
+    for (t1, t2, s1, s2), chunk in iter_chunks(reader, bounds, chunk_inds):
+        filtered = bandpass_filter(chunk, samplerate, freq_min, freq_max, freq_wid, engine=engine, dtype=dtype)[:, t1-s1:t2-s1]
+        if reference is not None:
+            filtered = (filtered - get_reference(filtered, reference, ref_channels)).astype(dtype, copy=False)
+        yield t1, t2, filtered
+
+
+def bandpass_filter_mda(timeseries, timeseries_out, samplerate, freq_min=DEFAULT_FREQ_MIN,
+        freq_max=DEFAULT_FREQ_MAX, freq_wid=DEFAULT_FREQ_WID, padding=DEFAULT_PADDING,
+        chunk_size=DEFAULT_CHUNK_SIZE, n_threads=None, dt="float32", reference=None, ref_channels=None):
+    """
+    Bandpass filter the (n_ch, n_samples) .mda file `timeseries` chunk by chunk
+    into `timeseries_out` (float32 like ml_ephys by default).
+    `reference`, `ref_channels`: optional CAR/CMR of the output, see iter_bandpass_chunks.
+    Returns the FilterEngine used, for its throughput report.
+    """
+    ts = time()
+    reader = DiskReadMda(timeseries)
+    n_ch, n_samples = reader.N1(), reader.N2()
+    with StreamingMdaWriter(timeseries_out, (n_ch, n_samples), dt=dt) as writer, \
+            FilterEngine(n_threads=n_threads) as engine:
+        for t1, _, filtered in iter_bandpass_chunks(reader, samplerate, freq_min, freq_max, freq_wid,
+                padding=padding, chunk_size=chunk_size, engine=engine, dtype=dt,
+                reference=reference, ref_channels=ref_channels):
+            writer.writeChunk(filtered, i1=0, i2=t1)
+    reader.close()
+    print("Bandpass filtered %s%s (%d channels, %.2f seconds of data) in %.2f seconds: %s" % (
+        timeseries, "" if reference is None else " with %s reference" % (reference), n_ch, n_samples/samplerate, time()-ts, engine.report(samplerate)
+    ))
+    return engine
+
+
+def _reference_bandpass_filter(x, samplerate, freq_min, freq_max, freq_wid, chunk_size, padding):
+    # straightforward version of ml_ephys's chunked filter: full complex FFT of each padded chunk
+    n_samples = x.shape[1]
+    y = np.zeros(x.shape, dtype=np.float32)
+    for t1, t2, s1, s2 in get_chunk_bounds(n_samples, chunk_size, padding):
+        n = s2 - s1
+        k_inds = np.arange(n)
+        k_inds = np.where(k_inds <= (n+1)/2, k_inds, k_inds-n)
+        absf = np.abs(k_inds * (samplerate/n))
+        val = np.ones(n)
+        if freq_min != 0:
+            val = val * (1 + special.erf(3.0*(absf-freq_min)/freq_min)) / 2
+            val = np.where(np.abs(k_inds) < 0.1, 0, val)
+        if freq_max != 0:
+            val = val * (1 - special.erf((absf-freq_max)/freq_wid)) / 2
+        chunk = np.real(np.fft.ifft(np.fft.fft(x[:, s1:s2], axis=1)*np.sqrt(val)[None, :], axis=1))
+        y[:, t1:t2] = chunk[:, t1-s1:t2-s1]
+    return y
+
+
+def check_equivalence(samplerate=30000, n_ch=8, n_samples=1000003, chunk_size=DEFAULT_CHUNK_SIZE,
+        padding=DEFAULT_PADDING, n_threads=4, tol=1e-5):
+    """
+    Filter a synthetic recording through .mda files with `bandpass_filter_mda`
+    and compare it with a plain single-threaded implementation of the
+    ml_ephys filter. Returns the max error relative to the RMS of the reference.
+    """
+    import os
+    import tempfile
+    from .mdaio import writemda16i, readmda
+    rng = np.random.default_rng(0)
+    t = np.arange(n_samples) / samplerate
+    x = rng.normal(0, 20, (n_ch, n_samples)) # broadband noise
+    x += 500*np.sin(2*np.pi*1*t) + 200*np.sin(2*np.pi*60*t) # drift and line noise, out of band
+    x += 100*np.sin(2*np.pi*1000*t)*(rng.random(n_samples) < 0.01) # in-band bursts
+    x = x.astype(np.int16)
+    ref = _reference_bandpass_filter(x, samplerate, DEFAULT_FREQ_MIN, DEFAULT_FREQ_MAX, DEFAULT_FREQ_WID, chunk_size, padding)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        in_path = os.path.join(tmpdir, "converted_data.mda")
+        out_path = os.path.join(tmpdir, "filt.mda")
+        writemda16i(x, in_path)
+        bandpass_filter_mda(in_path, out_path, samplerate, chunk_size=chunk_size, padding=padding, n_threads=n_threads)
+        y = readmda(out_path)
+    err = np.max(np.abs(y-ref)) / np.sqrt(np.mean(ref.astype(np.float64)**2))
+    print("max error vs reference filter: %.2e of RMS" % (err))
+    assert err < tol, "Bandpass filter differs from the reference"
+    return err
+
+
+if __name__ == '__main__':
+    # e.g. `python -m utils.bandpass_mda converted_data.mda filt.mda --samplerate 30000 [--reference median]`
+    # or `python -m utils.bandpass_mda --check` to run the equivalence check on synthetic data
+    import argparse
+    parser = argparse.ArgumentParser(description="Bandpass filter a .mda recording like ephys.bandpass_filter")
+    parser.add_argument("timeseries", nargs="?")
+    parser.add_argument("timeseries_out", nargs="?")
+    parser.add_argument("--samplerate", type=float, default=30000)
+    parser.add_argument("--freq_min", type=float, default=DEFAULT_FREQ_MIN)
+    parser.add_argument("--freq_max", type=float, default=DEFAULT_FREQ_MAX)
+    parser.add_argument("--freq_wid", type=float, default=DEFAULT_FREQ_WID)
+    parser.add_argument("--padding", type=int, default=DEFAULT_PADDING)
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--n_threads", type=int, default=None)
+    parser.add_argument("--reference", default=None, choices=REFERENCE_METHODS, help="common average (mean) or median reference of the output")
+    parser.add_argument("--check", action="store_true", help="run the equivalence check on synthetic data")
+    args = parser.parse_args()
+    if args.check:
+        check_equivalence(samplerate=args.samplerate, chunk_size=args.chunk_size, padding=args.padding, n_threads=args.n_threads)
+    else:
+        if args.timeseries is None or args.timeseries_out is None:
+            parser.error("timeseries and timeseries_out are required")
+        bandpass_filter_mda(args.timeseries, args.timeseries_out, args.samplerate,
+            freq_min=args.freq_min, freq_max=args.freq_max, freq_wid=args.freq_wid,
+            padding=args.padding, chunk_size=args.chunk_size, n_threads=args.n_threads, reference=args.reference)
@@ -0,0 +1,186 @@
+'''
+Chunked common average / common median reference (CAR / CMR).
+
+`CommonReferenceView` is a lazy view of an (n_ch, n_samples) recording with
+the mean (CAR) or median (CMR) across channels subtracted from every
+channel. It works over any recording source: an .mda path, a DiskReadMda
+(or any reader with N1/N2/readChunk, e.g. MaskedMdaReader) or an array /
+memmap. Only the samples that are asked for are read and referenced, in
+float32, so the referenced recording is never held in memory; waveforms
+around spikes are read with `readWindows`. `materialize` writes the
+referenced recording to an .mda file once, chunk by chunk, for repeated use.
+'''
+import os
+
+import numpy as np
+
+from .mdaio import DiskReadMda, DiskWriteMda
+
+REFERENCE_METHODS = ("mean", "median")
+DEFAULT_CHUNK_SIZE = 300000 # 10 seconds at 30 kHz
+
+
+def get_reference(X, method="mean", ref_channels=None):
+    """Mean or median across (the `ref_channels` of) the channels of an (n_ch, ...) array, in float32."""
+    if ref_channels is not None:
+        X = X[ref_channels]
+    if method == "mean":
+        return np.mean(X, axis=0, dtype=np.float32)
+    if method == "median":
+        return np.median(X, axis=0).astype(np.float32)
+    raise ValueError("Unknown reference method: %s (expected one of %s)" % (method, REFERENCE_METHODS))
+
+
+class _ArraySource:
+    """DiskReadMda-like access to an in-memory or memory-mapped (n_ch, n_samples) array."""
+    def __init__(self, X):
+        self._X = X
+    def N1(self):
+        return self._X.shape[0]
+    def N2(self):
+        return self._X.shape[1]
+    def dt(self):
+        return str(self._X.dtype)
+    def readChunk(self, i1=0, N1=1, i2=0, N2=1):
+        return np.asarray(self._X[i1:i1+N1, i2:i2+N2])
+    def readWindows(self, i2_starts, N2, i1=0, N1=None):
+        if N1 is None:
+            N1 = self.N1()-i1
+        return np.asarray(self._X[i1:i1+N1, np.asarray(i2_starts)[:,None]+np.arange(N2)]).transpose(1, 0, 2)
+
+
+class CommonReferenceView:
+    """
+    Lazy CAR (method="mean") or CMR (method="median") view of `source`.
+    `ref_channels`: channels the reference is computed from (default: all),
+        e.g. to leave out bad channels; it is subtracted from every channel.
+    """
+    def __init__(self, source, method="mean", ref_channels=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        if method not in REFERENCE_METHODS:
+            raise ValueError("Unknown reference method: %s (expected one of %s)" % (method, REFERENCE_METHODS))
+        self._own_reader = isinstance(source, str)
+        if self._own_reader:
+            source = DiskReadMda(source)
+        elif isinstance(source, np.ndarray):
+            source = _ArraySource(source)
+        self._source = source
+        self.method = method
+        self.ref_channels = None if ref_channels is None else np.asarray(ref_channels)
+        self.chunk_size = chunk_size
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        if self._own_reader and self._source is not None:
+            self._source.close()
+        self._source = None
+    def N1(self):
+        return self._source.N1()
+    def N2(self):
+        return self._source.N2()
+    def dims(self):
+        return [self.N1(), self.N2()]
+    def dt(self):
+        return "float32"
+    def readChunk(self, i1=0, N1=None, i2=0, N2=1):
+        """Referenced channels [i1, i1+N1) x samples [i2, i2+N2) (the reference uses all channels)."""
+        if N1 is None:
+            N1 = self.N1()-i1
+        X = self._source.readChunk(i1=0, N1=self.N1(), i2=i2, N2=N2)
+        if X is None:
+            return None
+        return X[i1:i1+N1] - get_reference(X, self.method, self.ref_channels)
+    def iterChunks(self, chunk_size=None):
+        """Yield (i2, referenced chunk of all channels) over the whole recording."""
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        for i2 in range(0, self.N2(), chunk_size):
+            yield i2, self.readChunk(i2=i2, N2=min(chunk_size, self.N2()-i2))
+    def readWindows(self, ch, i2_starts, N2, n_windows_per_batch=4096):
+        """
+        Referenced windows [t, t+N2) of channel `ch` for every t in `i2_starts`
+        (e.g. spike-aligned waveforms), read in batches. Returns (n_windows, N2) float32.
+        """
+        i2_starts = np.asarray(i2_starts, dtype=np.int64)
+        ret = np.empty((i2_starts.shape[0], N2), dtype=np.float32)
+        for i_beg in range(0, i2_starts.shape[0], n_windows_per_batch):
+            i_end = min(i_beg+n_windows_per_batch, i2_starts.shape[0])
+            if hasattr(self._source, "readWindows"):
+                tmp = self._source.readWindows(i2_starts[i_beg:i_end], N2) # (n_windows, n_ch, N2)
+            else:
+                tmp = np.stack([self._source.readChunk(i1=0, N1=self.N1(), i2=t, N2=N2) for t in i2_starts[i_beg:i_end]])
+            ret[i_beg:i_end] = tmp[:, ch] - get_reference(tmp.transpose(1, 0, 2), self.method, self.ref_channels)
+        return ret
+    def materialize(self, path, chunk_size=None):
+        """Write the referenced recording to the .mda file `path` (float32) chunk by chunk; returns `path`."""
+        tmp_path = path + ".tmp"
+        with DiskWriteMda(tmp_path, self.dims(), dt="float32") as writer:
+            for i2, X in self.iterChunks(chunk_size):
+                writer.writeChunk(X, i1=0, i2=i2)
+        os.replace(tmp_path, path) # a materialized file is either complete or absent
+        return path
+
+
+class MaterializedReference:
+    """Reader of a materialized referenced recording with the methods of CommonReferenceView."""
+    def __init__(self, path):
+        self._reader = DiskReadMda(path)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = None
+    def N1(self):
+        return self._reader.N1()
+    def N2(self):
+        return self._reader.N2()
+    def dims(self):
+        return [self.N1(), self.N2()]
+    def dt(self):
+        return self._reader.dt()
+    def readChunk(self, i1=0, N1=None, i2=0, N2=1):
+        if N1 is None:
+            N1 = self.N1()-i1
+        return self._reader.readChunk(i1=i1, N1=N1, i2=i2, N2=N2)
+    def readWindows(self, ch, i2_starts, N2):
+        return self._reader.readWindows(i2_starts, N2, i1=ch, N1=1)[:, 0, :]
+
+
+def get_materialized_path(mda_path, method="mean"):
+    """e.g. filt.mda -> filt_car.mda (mean) or filt_cmr.mda (median)."""
+    root, ext = os.path.splitext(mda_path)
+    return "%s_%s%s" % (root, "car" if method == "mean" else "cmr", ext)
+
+
+def open_referenced(mda_path, method="mean", ref_channels=None, materialize=False):
+    """
+    Referenced recording of `mda_path`: the materialized file if it exists and
+    is not older than `mda_path` (written first if `materialize`), otherwise
+    a lazy CommonReferenceView. Both are read with the same methods.
+    A materialized file does not record `ref_channels`; delete it to change them.
+    """
+    mat_path = get_materialized_path(mda_path, method)
+    is_current = os.path.exists(mat_path) and os.path.getmtime(mat_path) >= os.path.getmtime(mda_path)
+    if not is_current and materialize:
+        with CommonReferenceView(mda_path, method, ref_channels) as view:
+            view.materialize(mat_path)
+        is_current = True
+    if is_current:
+        return MaterializedReference(mat_path)
+    return CommonReferenceView(mda_path, method, ref_channels)
+
+
+if __name__ == '__main__':
+    # e.g. `python -m utils.common_reference /path/to/filt.mda --method median` writes filt_cmr.mda
+    import argparse
+    parser = argparse.ArgumentParser(description="Write the common average (or median) referenced copy of a 2D .mda file")
+    parser.add_argument("mda_path")
+    parser.add_argument("--method", default="mean", choices=REFERENCE_METHODS)
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+    with CommonReferenceView(args.mda_path, args.method, chunk_size=args.chunk_size) as view:
+        print("Written:", view.materialize(get_materialized_path(args.mda_path, args.method)))
@@ -7,6 +7,8 @@
 import numpy as np
 import scipy.signal as signal
 
+from .filter_engine import get_notch_sos
+
 def notch_filter(input, fSample, fNotch, Bandwidth=None, Q=20):
     """Implements a notch filter (e.g., for 50 or 60 Hz) on vector 'input'.
 
@@ -31,3 +33,104 @@ def notch_filter(input, fSample, fNotch, Bandwidth=None, Q=20):
     out = signal.filtfilt(b, a, input, axis=-1)
     
     return out
+
+def scale_and_notch_int16(data, conversion, fSample=None, fNotch=0, Q=20, n_ch_per_block=4):
+    """Converts int16 ADC counts to int16 values in `conversion` units (e.g. microvolts),
+    applying the notch filter of `notch_filter` on the way if fNotch > 0.
+
+    `data` : (n_ch, n_samples) int16, overwritten in place and returned.
+    Only `n_ch_per_block` channels at a time are held as float32, so the
+    whole recording is never materialized as floats.
+    Converted values are truncated toward zero like ndarray.astype(np.int16).
+    """
+    if fNotch > 0:
+        # second-order sections keep the float32 notch numerically well-behaved
+        sos = get_notch_sos(fSample, fNotch, Q).astype(np.float32)
+    for i_ch in range(0, data.shape[0], n_ch_per_block):
+        block = np.empty(data[i_ch:i_ch+n_ch_per_block].shape, dtype=np.float32)
+        # product in float64 like `conversion*data`, so that truncation matches it for every count
+        np.multiply(data[i_ch:i_ch+n_ch_per_block], float(conversion), out=block, dtype=np.float64)
+        if fNotch > 0:
+            block = signal.sosfiltfilt(sos, block, axis=-1)
+        data[i_ch:i_ch+n_ch_per_block] = block
+    return data
+
+def make_notch_sos(fSample, fNotch, Bandwidth=None, Q=20):
+    """Second-order sections of the notch filter used by `notch_filter` (cached per sample rate)."""
+    if Bandwidth is not None:
+        Q = fNotch/Bandwidth
+    return get_notch_sos(fSample, fNotch, Q)
+
+def get_sos_settle_samples(sos, tol=1e-6):
+    """Number of samples after which the impulse response of `sos` has decayed below `tol` (relative)."""
+    _, p, _ = signal.sos2zpk(sos)
+    r = np.max(np.abs(p)) if p.shape[0] > 0 else 0
+    if r <= 0:
+        return 3*sos.shape[0]
+    return int(np.ceil(np.log(tol)/np.log(r)))
+
+class StreamingSosFiltFilt:
+    """Zero-phase (forward-backward) sos filtering of an endless (n_ch, n_samples) stream.
+
+    The forward pass runs `sosfilt` with its state carried from chunk to
+    chunk (and from file to file), so there is no transient at chunk seams.
+    The backward pass of each output block is started `margin` samples later
+    in the stream and the first `margin` outputs are discarded
+    (overlap-and-discard); `margin` is chosen so that the backward start-up
+    transient has decayed below `tol`. The output thus lags the input by
+    `margin` samples; `flush` returns the rest at the end of the stream.
+    All arithmetic is float32 and memory is bounded by one chunk plus the margin.
+    If a `filter_engine.FilterEngine` is given, channels are filtered in parallel.
+
+    Usage:
+        f = StreamingSosFiltFilt(make_notch_sos(30000, 60), n_ch)
+        for chunk in chunks:
+            beg, out = f.process(chunk)  # out: samples [beg, beg+out.shape[1]) of the stream
+            ...
+        beg, out = f.flush()
+    """
+    def __init__(self, sos, n_ch, margin=None, tol=1e-6, engine=None):
+        self._sos = np.asarray(sos, dtype=np.float32)
+        self._engine = engine
+        # steady-state filter state for a unit step; scaled by the first/last sample
+        # like the edge handling of filtfilt, to avoid a transient at the stream ends
+        self._zi_unit = signal.sosfilt_zi(sos).astype(np.float32)[:, None, :]
+        self.margin = get_sos_settle_samples(sos, tol) if margin is None else int(margin)
+        self._zf = None
+        self._pending = np.zeros((n_ch, 0), dtype=np.float32) # forward-filtered, not yet emitted
+        self.n_out = 0
+    def _sosfilt(self, x, zi, count_samples=True):
+        if self._engine is None:
+            return signal.sosfilt(self._sos, x, axis=-1, zi=zi)
+        return self._engine.sosfilt(self._sos, x, zi=zi, count_samples=count_samples)
+    def _backward(self, y, n_emit):
+        zi = self._zi_unit * y[None, :, -1:]
+        out, _ = self._sosfilt(y[:, ::-1], zi, count_samples=False)
+        return np.ascontiguousarray(out[:, ::-1][:, :n_emit])
+    def process(self, x):
+        """Push samples of all channels; returns (beg_sample, filtered block), possibly empty."""
+        x = np.asarray(x, dtype=np.float32)
+        if x.shape[1] == 0:
+            return self.n_out, np.zeros((self._pending.shape[0], 0), dtype=np.float32)
+        if self._zf is None:
+            self._zf = self._zi_unit * x[None, :, :1]
+        y, self._zf = self._sosfilt(x, self._zf)
+        self._pending = np.concatenate([self._pending, y], axis=1)
+        n_emit = self._pending.shape[1] - self.margin
+        beg = self.n_out
+        if n_emit <= 0:
+            return beg, np.zeros((self._pending.shape[0], 0), dtype=np.float32)
+        out = self._backward(self._pending, n_emit)
+        self._pending = self._pending[:, n_emit:].copy()
+        self.n_out += n_emit
+        return beg, out
+    def flush(self):
+        """End of stream: returns (beg_sample, last filtered block)."""
+        beg = self.n_out
+        n_emit = self._pending.shape[1]
+        if n_emit == 0:
+            return beg, self._pending.copy()
+        out = self._backward(self._pending, n_emit)
+        self._pending = self._pending[:, :0]
+        self.n_out += n_emit
+        return beg, out
@@ -1,3 +1,3 @@
-from .load_intan_rhd_format import read_data, get_n_samples_in_data
+from .load_intan_rhd_format import read_data, get_n_samples_in_data, memmap_data
 from .intanutil.read_header import read_header
 # from .intanutil.notch_filter import notch_filter
\ No newline at end of file
@@ -4,20 +4,22 @@
 # Modified Adrian Foy Sep 2018
 
 def data_to_result(header, data, data_present):
-    """Moves the header and data (if present) into a common object."""
+    """Moves the header and data (if present) into a common object.
+
+    Entries missing from data (streams not selected in read_data) are skipped."""
     
     result = {}
-    if header['num_amplifier_channels'] > 0 and data_present:
+    if header['num_amplifier_channels'] > 0 and data_present and 't_amplifier' in data:
         result['t_amplifier'] = data['t_amplifier']
-    if header['num_aux_input_channels'] > 0 and data_present:
+    if header['num_aux_input_channels'] > 0 and data_present and 't_aux_input' in data:
         result['t_aux_input'] = data['t_aux_input']
-    if header['num_supply_voltage_channels'] > 0 and data_present:
+    if header['num_supply_voltage_channels'] > 0 and data_present and 't_supply_voltage' in data:
         result['t_supply_voltage'] = data['t_supply_voltage']
-    if header['num_board_adc_channels'] > 0 and data_present:
+    if header['num_board_adc_channels'] > 0 and data_present and 't_board_adc' in data:
         result['t_board_adc'] = data['t_board_adc']
-    if (header['num_board_dig_in_channels'] > 0 or header['num_board_dig_out_channels'] > 0) and data_present:
+    if (header['num_board_dig_in_channels'] > 0 or header['num_board_dig_out_channels'] > 0) and data_present and 't_dig' in data:
         result['t_dig'] = data['t_dig']
-    if header['num_temp_sensor_channels'] > 0 and data_present:
+    if header['num_temp_sensor_channels'] > 0 and data_present and 't_temp_sensor' in data:
         result['t_temp_sensor'] = data['t_temp_sensor']
         
     if header['num_amplifier_channels'] > 0:
@@ -31,32 +33,32 @@ def data_to_result(header, data, data_present):
     
     if header['num_amplifier_channels'] > 0:
         result['amplifier_channels'] = header['amplifier_channels']
-        if data_present:
+        if data_present and 'amplifier_data' in data:
             result['amplifier_data'] = data['amplifier_data']
             
     if header['num_aux_input_channels'] > 0:
         result['aux_input_channels'] = header['aux_input_channels']
-        if data_present:
+        if data_present and 'aux_input_data' in data:
             result['aux_input_data'] = data['aux_input_data']
             
     if header['num_supply_voltage_channels'] > 0:
         result['supply_voltage_channels'] = header['supply_voltage_channels']
-        if data_present:
+        if data_present and 'supply_voltage_data' in data:
             result['supply_voltage_data'] = data['supply_voltage_data']
     
     if header['num_board_adc_channels'] > 0:
         result['board_adc_channels'] = header['board_adc_channels']
-        if data_present:
+        if data_present and 'board_adc_data' in data:
             result['board_adc_data'] = data['board_adc_data']
             
     if header['num_board_dig_in_channels'] > 0:
         result['board_dig_in_channels'] = header['board_dig_in_channels']
-        if data_present:
+        if data_present and 'board_dig_in_data' in data:
             result['board_dig_in_data'] = data['board_dig_in_data']
             
     if header['num_board_dig_out_channels'] > 0:
         result['board_dig_out_channels'] = header['board_dig_out_channels']
-        if data_present:
+        if data_present and 'board_dig_out_data' in data:
             result['board_dig_out_data'] = data['board_dig_out_data']
     
     return result
\ No newline at end of file
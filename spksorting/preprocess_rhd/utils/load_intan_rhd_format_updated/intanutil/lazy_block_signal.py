@@ -0,0 +1,126 @@
+#! /bin/env python
+#
+# Lazy (channel, time) views over the memory-mapped data blocks of an .rhd file.
+
+import numpy as np
+
+
+class LazyBlockSignal:
+    """Array-like view of one signal type stored block-interleaved in an .rhd file.
+
+    `blocks` is a np.memmap of the structured block dtype (see
+    get_data_block_dtype); nothing is read from disk until the view is indexed.
+    Indexing with [ch, t] only touches the data blocks overlapping t and only
+    converts the selected channels, e.g. `amplifier[0:32, 30000:60000]`.
+    The returned values equal scale*(raw+offset); use `.raw` for the stored uint16.
+    `ch_indices` restricts the view to a subset of the stored channels.
+    """
+    def __init__(self, blocks, field, scale=1.0, offset=0, dtype=np.float64, ch_indices=None):
+        self._blocks = blocks
+        self._field = field
+        self._scale = scale
+        self._offset = offset
+        self._dtype = dtype
+        sub_shape = blocks.dtype[field].shape
+        self._is_1d = (len(sub_shape) == 1)
+        self._n_per_block = sub_shape[-1]
+        if self._is_1d:
+            self._ch_indices = None
+            self._n_ch = 1
+        else:
+            if ch_indices is None:
+                ch_indices = np.arange(sub_shape[0])
+            self._ch_indices = np.asarray(ch_indices)
+            self._n_ch = self._ch_indices.shape[0]
+        self._n_total = self._n_per_block * blocks.shape[0]
+
+    @property
+    def shape(self):
+        if self._is_1d:
+            return (self._n_total,)
+        return (self._n_ch, self._n_total)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        if self._scale is None:
+            return self._blocks.dtype[self._field].base
+        return np.dtype(self._dtype)
+
+    @property
+    def raw(self):
+        """The same view, returning the stored bits without scaling."""
+        return LazyBlockSignal(self._blocks, self._field, scale=None, ch_indices=self._ch_indices)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        ret = self[...]
+        if dtype is not None:
+            ret = ret.astype(dtype)
+        return ret
+
+    def _time_key_to_block_range(self, t_key):
+        """Returns (first_block, end_block, local_key) where local_key indexes
+        the decoded samples of blocks [first_block, end_block)."""
+        n = self._n_total
+        if isinstance(t_key, slice):
+            start, stop, step = t_key.indices(n)
+            if step > 0:
+                if stop <= start:
+                    return 0, 0, slice(0, 0)
+                b0 = start // self._n_per_block
+                b1 = (stop - 1) // self._n_per_block + 1
+                base = b0 * self._n_per_block
+                return b0, b1, slice(start-base, stop-base, step)
+            t_key = np.arange(start, stop, step)
+        if isinstance(t_key, (int, np.integer)):
+            t_key = int(t_key)
+            if t_key < -n or t_key >= n:
+                raise IndexError("index {} is out of bounds for axis with size {}".format(t_key, n))
+            t_key = t_key % n
+            b0 = t_key // self._n_per_block
+            return b0, b0+1, t_key - b0*self._n_per_block
+        t_key = np.asarray(t_key)
+        if t_key.dtype == bool:
+            t_key = np.nonzero(t_key)[0]
+        if t_key.size == 0:
+            return 0, 0, t_key.astype(int)
+        t_key = np.where(t_key < 0, t_key + n, t_key)
+        b0 = int(t_key.min()) // self._n_per_block
+        b1 = int(t_key.max()) // self._n_per_block + 1
+        return b0, b1, t_key - b0*self._n_per_block
+
+    def __getitem__(self, key):
+        if key is Ellipsis:
+            key = ()
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = tuple(slice(None) if k is Ellipsis else k for k in key)
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for LazyBlockSignal of shape {}".format(self.shape))
+        key = key + (slice(None),)*(self.ndim-len(key))
+        t_key = key[-1]
+        b0, b1, local_t_key = self._time_key_to_block_range(t_key)
+        # view into the memmap; decoding happens below on the touched blocks only
+        x = self._blocks[b0:b1][self._field]
+        if self._is_1d:
+            x = x.reshape(-1)[local_t_key]
+        else:
+            ch_key = self._ch_indices[key[0]]
+            if ch_key.ndim == 0:
+                x = x[:, ch_key, :].reshape(-1)[local_t_key]
+            else:
+                x = x[:, ch_key, :]
+                x = x.transpose(1, 0, 2).reshape(x.shape[1], x.shape[0]*x.shape[2])[:, local_t_key]
+        if self._scale is None:
+            return np.array(x)
+        ret = x.astype(self._dtype)
+        if self._offset != 0:
+            ret += self._offset
+        ret *= self._scale
+        return ret
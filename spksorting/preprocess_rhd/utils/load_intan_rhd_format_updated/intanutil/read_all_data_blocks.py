@@ -0,0 +1,146 @@
+#! /bin/env python
+#
+# Vectorized counterpart of read_one_data_block.py: describe one data block
+# as a numpy structured dtype and decode every block of the file at once.
+
+import numpy as np
+
+# Signal types ("streams") of a data block besides the timestamps, in on-disk order.
+ALL_STREAMS = ('amplifier', 'aux_input', 'supply_voltage', 'temp_sensor', 'board_adc', 'board_dig_in', 'board_dig_out')
+
+
+def check_streams(streams):
+    """Returns streams as a tuple (ALL_STREAMS if None) after validating the names."""
+    if streams is None:
+        return ALL_STREAMS
+    if isinstance(streams, str):
+        streams = (streams,)
+    streams = tuple(streams)
+    unknown = [s for s in streams if s not in ALL_STREAMS]
+    if len(unknown) > 0:
+        raise ValueError('Unknown stream(s) {}; expected any of {}'.format(unknown, ALL_STREAMS))
+    return streams
+
+
+def get_data_block_dtype(header, streams=None):
+    """Builds a numpy structured dtype describing one 60 or 128 sample data block.
+
+    Field order follows the on-disk order used by read_one_data_block;
+    signal types with no enabled channels are left out of the dtype.
+    The itemsize equals get_bytes_per_data_block(header).
+    If `streams` is given, only the timestamps and those signal types are
+    fields of the dtype; the others are skipped by their byte offset within
+    the block and never decoded.
+    """
+
+    n_spb = header['num_samples_per_data_block']
+
+    # In version 1.2, timestamps moved from unsigned to signed integers
+    if (header['version']['major'] == 1 and header['version']['minor'] >= 2) or (header['version']['major'] > 1):
+        fields = [('timestamps', '<i4', (n_spb,))]
+    else:
+        fields = [('timestamps', '<u4', (n_spb,))]
+
+    if header['num_amplifier_channels'] > 0:
+        fields.append(('amplifier', '<u2', (header['num_amplifier_channels'], n_spb)))
+    if header['num_aux_input_channels'] > 0:
+        fields.append(('aux_input', '<u2', (header['num_aux_input_channels'], n_spb // 4)))
+    if header['num_supply_voltage_channels'] > 0:
+        fields.append(('supply_voltage', '<u2', (header['num_supply_voltage_channels'], 1)))
+    if header['num_temp_sensor_channels'] > 0:
+        fields.append(('temp_sensor', '<u2', (header['num_temp_sensor_channels'], 1)))
+    if header['num_board_adc_channels'] > 0:
+        fields.append(('board_adc', '<u2', (header['num_board_adc_channels'], n_spb)))
+    if header['num_board_dig_in_channels'] > 0:
+        fields.append(('board_dig_in', '<u2', (n_spb,)))
+    if header['num_board_dig_out_channels'] > 0:
+        fields.append(('board_dig_out', '<u2', (n_spb,)))
+
+    block_dtype = np.dtype(fields)
+    if streams is None:
+        return block_dtype
+
+    keep = ('timestamps',) + check_streams(streams)
+    names = [name for name in block_dtype.names if name in keep]
+    return np.dtype({
+        'names': names,
+        'formats': [block_dtype.fields[name][0] for name in names],
+        'offsets': [block_dtype.fields[name][1] for name in names],
+        'itemsize': block_dtype.itemsize,
+    })
+
+
+def rawbits_to_int16(x):
+    """In-place conversion of uint16 amplifier bits to int16 ADC counts (x - 32768)."""
+    x ^= np.uint16(0x8000)
+    return x.view(np.int16)
+
+
+def _deinterleave(blocks, field, ch_indices=None):
+    """(n_blocks, n_ch, n_per_block) block field -> (n_ch, n_blocks*n_per_block) array."""
+    x = blocks[field]
+    if ch_indices is not None:
+        x = x[:, ch_indices, :]
+    return np.ascontiguousarray(x.transpose(1, 0, 2)).reshape(x.shape[1], x.shape[0]*x.shape[2])
+
+
+def read_all_data_blocks(header, fid, num_data_blocks, amplifier_ch_indices=None, streams=None):
+    """Reads num_data_blocks data blocks from fid in a single call.
+
+    Returns a dict with the same raw (unscaled) arrays that read_data fills
+    block-by-block with read_one_data_block. If amplifier_ch_indices is given,
+    only those amplifier channels are de-interleaved into 'amplifier_data'.
+    If `streams` is given (see ALL_STREAMS), only those signal types are
+    de-interleaved and returned; 't_amplifier' is always returned.
+    """
+
+    streams = check_streams(streams)
+    block_dtype = get_data_block_dtype(header, streams)
+    blocks = np.fromfile(fid, dtype=block_dtype, count=num_data_blocks)
+    if blocks.shape[0] != num_data_blocks:
+        raise Exception('Error: file ended after {} of {} data blocks.'.format(blocks.shape[0], num_data_blocks))
+
+    n_spb = header['num_samples_per_data_block']
+    n_samples = n_spb * num_data_blocks
+    names = block_dtype.names
+
+    data = {}
+    data['t_amplifier'] = blocks['timestamps'].reshape(n_samples).astype(int)
+
+    if 'amplifier' in streams:
+        if 'amplifier' in names:
+            data['amplifier_data'] = _deinterleave(blocks, 'amplifier', amplifier_ch_indices)
+        else:
+            data['amplifier_data'] = np.zeros([0, n_samples], dtype=np.uint16)
+    if 'aux_input' in streams:
+        if 'aux_input' in names:
+            data['aux_input_data'] = _deinterleave(blocks, 'aux_input')
+        else:
+            data['aux_input_data'] = np.zeros([0, (n_spb // 4) * num_data_blocks], dtype=np.uint16)
+    if 'supply_voltage' in streams:
+        if 'supply_voltage' in names:
+            data['supply_voltage_data'] = _deinterleave(blocks, 'supply_voltage')
+        else:
+            data['supply_voltage_data'] = np.zeros([0, num_data_blocks], dtype=np.uint16)
+    if 'temp_sensor' in streams:
+        if 'temp_sensor' in names:
+            data['temp_sensor_data'] = _deinterleave(blocks, 'temp_sensor')
+        else:
+            data['temp_sensor_data'] = np.zeros([0, num_data_blocks], dtype=np.uint16)
+    if 'board_adc' in streams:
+        if 'board_adc' in names:
+            data['board_adc_data'] = _deinterleave(blocks, 'board_adc')
+        else:
+            data['board_adc_data'] = np.zeros([0, n_samples], dtype=np.uint16)
+    if 'board_dig_in' in streams:
+        if 'board_dig_in' in names:
+            data['board_dig_in_raw'] = blocks['board_dig_in'].reshape(n_samples)
+        else:
+            data['board_dig_in_raw'] = np.zeros(n_samples, dtype=np.uint16)
+    if 'board_dig_out' in streams:
+        if 'board_dig_out' in names:
+            data['board_dig_out_raw'] = blocks['board_dig_out'].reshape(n_samples)
+        else:
+            data['board_dig_out_raw'] = np.zeros(n_samples, dtype=np.uint16)
+
+    return data
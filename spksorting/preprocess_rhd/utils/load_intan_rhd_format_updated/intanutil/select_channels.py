@@ -0,0 +1,40 @@
+#! /bin/env python
+#
+# Resolve a channel selection against the amplifier channel table of a header.
+
+import numpy as np
+
+
+def get_amplifier_channel_indices(header, channels=None):
+    """Converts a channel selection into positional indices of amplifier channels.
+
+    `channels` may be
+        - None: keep all amplifier channels;
+        - an array of bools with one entry per amplifier channel (True = keep);
+        - a list/array of ints: the `native_order` of the channels to keep,
+          returned in the given order.
+    """
+    n_ch = header['num_amplifier_channels']
+    if channels is None:
+        return np.arange(n_ch)
+    channels = np.asarray(channels)
+    if channels.dtype == bool:
+        if channels.shape != (n_ch,):
+            raise ValueError("Channel mask has shape %s but the file has %d amplifier channels" % (channels.shape, n_ch))
+        return np.nonzero(channels)[0]
+    native_orders = [ch['native_order'] for ch in header['amplifier_channels']]
+    indices = []
+    for native_order in channels.ravel():
+        if native_order not in native_orders:
+            raise ValueError("Native channel %d not found among amplifier channels" % (native_order))
+        indices.append(native_orders.index(native_order))
+    return np.array(indices, dtype=int)
+
+
+def subset_header_channels(header, ch_indices):
+    """Returns a shallow copy of header describing only the selected amplifier channels."""
+    header_sub = dict(header)
+    header_sub['amplifier_channels'] = [header['amplifier_channels'][i] for i in ch_indices]
+    header_sub['spike_triggers'] = [header['spike_triggers'][i] for i in ch_indices]
+    header_sub['num_amplifier_channels'] = len(ch_indices)
+    return header_sub
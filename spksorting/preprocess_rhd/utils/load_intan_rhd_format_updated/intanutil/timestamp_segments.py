@@ -0,0 +1,22 @@
+#! /bin/env python
+#
+# Run-length encoding of the per-sample Intan timestamps (see utils/rhd_timestamps.py
+# for the session-level index and the sample <-> timestamp lookups).
+
+import numpy as np
+
+# within a segment the timestamp increases by exactly 1 per sample
+TIMESTAMP_SEGMENT_DTYPE = np.dtype([("start_sample", np.int64), ("start_timestamp", np.int64), ("length", np.int64)])
+
+
+def timestamps_to_segments(timestamps, sample_offset=0):
+    """Compress integer timestamps (one per sample) into TIMESTAMP_SEGMENT_DTYPE segments."""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if timestamps.shape[0] == 0:
+        return np.zeros(0, dtype=TIMESTAMP_SEGMENT_DTYPE)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(timestamps) != 1) + 1])
+    segments = np.empty(starts.shape[0], dtype=TIMESTAMP_SEGMENT_DTYPE)
+    segments["start_sample"] = starts + sample_offset
+    segments["start_timestamp"] = timestamps[starts]
+    segments["length"] = np.diff(np.concatenate([starts, [timestamps.shape[0]]]))
+    return segments
@@ -10,7 +10,10 @@ import numpy as np
 
 from .intanutil.read_header import read_header
 from .intanutil.get_bytes_per_data_block import get_bytes_per_data_block
-from .intanutil.read_one_data_block import read_one_data_block
+from .intanutil.read_all_data_blocks import read_all_data_blocks, get_data_block_dtype, rawbits_to_int16, check_streams
+from .intanutil.lazy_block_signal import LazyBlockSignal
+from .intanutil.timestamp_segments import timestamps_to_segments
+from .intanutil.select_channels import get_amplifier_channel_indices, subset_header_channels
 # from .intanutil.notch_filter import notch_filter
 from .intanutil.data_to_result import data_to_result
 
@@ -43,10 +46,28 @@ def get_n_samples_in_data(filename):
 
 
 
-def read_data(filename, amplifier_rawbits=False):
+def read_data(filename, amplifier_rawbits=False, channels=None, amplifier_int16=False, streams=None, time_vectors=True):
     """Reads Intan Technologies RHD2000 data file generated by evaluation board GUI.
     
     Data are returned in a dictionary, for future extensibility.
+    `channels`: optional amplifier channel selection, either a boolean mask over
+        the amplifier channels in file order or a list of native orders
+        (see intanutil.select_channels). Unselected channels are never scaled
+        nor copied out of the raw data blocks; 'amplifier_channels' in the
+        result then only lists the selected channels.
+    `amplifier_int16`: return amplifier data as int16 ADC counts (raw bits - 32768,
+        converted in place) instead of float64 microvolts; the microvolts-per-bit
+        factor is returned as result['amplifier_conversion'].
+    `streams`: optional subset of intanutil.read_all_data_blocks.ALL_STREAMS
+        (e.g. ('amplifier',) for spike sorting) to decode; the other signal
+        types are skipped within each data block and their data and time
+        vectors are left out of the result. Default decodes everything.
+    `time_vectors`: whether to build the per-sample float64 time vectors
+        (t_amplifier, t_aux_input, ...). The timestamps are always returned
+        run-length encoded as result['timestamp_segments']
+        (start_sample, start_timestamp, length), see intanutil.timestamp_segments.
+    With the 'board_dig_in' stream, the packed uint16 digital-input words
+    (one per sample) are also returned as result['board_dig_in_raw'].
     """
 
     tic = time.time()
@@ -78,6 +99,12 @@ def read_data(filename, amplifier_rawbits=False):
 
     num_data_blocks = int(bytes_remaining / bytes_per_block)
 
+    streams = check_streams(streams)
+    amplifier_ch_indices = None
+    if channels is not None:
+        amplifier_ch_indices = get_amplifier_channel_indices(header, channels)
+        print('Keeping {} of {} amplifier channels.'.format(len(amplifier_ch_indices), header['num_amplifier_channels']))
+
     num_amplifier_samples = header['num_samples_per_data_block'] * num_data_blocks
     num_aux_input_samples = int((header['num_samples_per_data_block'] / 4) * num_data_blocks)
     num_supply_voltage_samples = 1 * num_data_blocks
@@ -93,66 +120,17 @@ def read_data(filename, amplifier_rawbits=False):
         print('Header file contains no data.  Amplifiers were sampled at {:0.2f} kS/s.'.format(header['sample_rate'] / 1000))
 
     if data_present:
-        # Pre-allocate memory for data.
+        # Read all data blocks at once with a structured block dtype instead
+        # of looping over read_one_data_block (tens of thousands of blocks per file).
         print('')
-        print('Allocating memory for data...')
-
-        data = {}
-        if (header['version']['major'] == 1 and header['version']['minor'] >= 2) or (header['version']['major'] > 1):
-            data['t_amplifier'] = np.zeros(num_amplifier_samples, dtype=int)
-        else:
-            data['t_amplifier'] = np.zeros(num_amplifier_samples, dtype=np.uint)
-
-        if amplifier_rawbits:
-            data['amplifier_data'] = np.zeros([header['num_amplifier_channels'], num_amplifier_samples], dtype=np.uint16)
-        else:
-            # what Intan developers originally did
-            data['amplifier_data'] = np.zeros([header['num_amplifier_channels'], num_amplifier_samples], dtype=np.uint)
-        data['aux_input_data'] = np.zeros([header['num_aux_input_channels'], num_aux_input_samples], dtype=np.uint)
-        data['supply_voltage_data'] = np.zeros([header['num_supply_voltage_channels'], num_supply_voltage_samples], dtype=np.uint)
-        data['temp_sensor_data'] = np.zeros([header['num_temp_sensor_channels'], num_supply_voltage_samples], dtype=np.uint)
-        data['board_adc_data'] = np.zeros([header['num_board_adc_channels'], num_board_adc_samples], dtype=np.uint)
-        
-        # by default, this script interprets digital events (digital inputs and outputs) as booleans
-        # if unsigned int values are preferred(0 for False, 1 for True), replace the 'dtype=np.bool' argument with 'dtype=np.uint' as shown
-        # the commented line below illustrates this for digital input data; the same can be done for digital out
-        
-        #data['board_dig_in_data'] = np.zeros([header['num_board_dig_in_channels'], num_board_dig_in_samples], dtype=np.uint)
-        data['board_dig_in_data'] = np.zeros([header['num_board_dig_in_channels'], num_board_dig_in_samples], dtype=bool)
-        data['board_dig_in_raw'] = np.zeros(num_board_dig_in_samples, dtype=np.uint)
-        
-        data['board_dig_out_data'] = np.zeros([header['num_board_dig_out_channels'], num_board_dig_out_samples], dtype=bool)
-        data['board_dig_out_raw'] = np.zeros(num_board_dig_out_samples, dtype=np.uint)
-
-        # Read sampled data from file.
         print('Reading data from file...')
+        data = read_all_data_blocks(header, fid, num_data_blocks, amplifier_ch_indices=amplifier_ch_indices, streams=streams)
 
-        # Initialize indices used in looping
-        indices = {}
-        indices['amplifier'] = 0
-        indices['aux_input'] = 0
-        indices['supply_voltage'] = 0
-        indices['board_adc'] = 0
-        indices['board_dig_in'] = 0
-        indices['board_dig_out'] = 0
-
-        print_increment = 10
-        percent_done = print_increment
-        for i in range(num_data_blocks):
-            read_one_data_block(data, header, indices, fid)
-
-            # Increment indices
-            indices['amplifier'] += header['num_samples_per_data_block']
-            indices['aux_input'] += int(header['num_samples_per_data_block'] / 4)
-            indices['supply_voltage'] += 1
-            indices['board_adc'] += header['num_samples_per_data_block']
-            indices['board_dig_in'] += header['num_samples_per_data_block']
-            indices['board_dig_out'] += header['num_samples_per_data_block']            
-
-            fraction_done = 100 * (1.0 * i / num_data_blocks)
-            if fraction_done >= percent_done:
-                print('{}% done...'.format(percent_done))
-                percent_done = percent_done + print_increment
+        # by default, this script interprets digital events (digital inputs and outputs) as booleans
+        if 'board_dig_in' in streams:
+            data['board_dig_in_data'] = np.zeros([header['num_board_dig_in_channels'], num_board_dig_in_samples], dtype=bool)
+        if 'board_dig_out' in streams:
+            data['board_dig_out_data'] = np.zeros([header['num_board_dig_out_channels'], num_board_dig_out_samples], dtype=bool)
 
         # Make sure we have read exactly the right amount of data.
         bytes_remaining = filesize - fid.tell()
@@ -167,40 +145,58 @@ def read_data(filename, amplifier_rawbits=False):
         print('Parsing data...')
 
         # Extract digital input channels to separate variables.
-        for i in range(header['num_board_dig_in_channels']):
-            data['board_dig_in_data'][i, :] = np.not_equal(np.bitwise_and(data['board_dig_in_raw'], (1 << header['board_dig_in_channels'][i]['native_order'])), 0)
+        if 'board_dig_in' in streams:
+            for i in range(header['num_board_dig_in_channels']):
+                data['board_dig_in_data'][i, :] = np.not_equal(np.bitwise_and(data['board_dig_in_raw'], (1 << header['board_dig_in_channels'][i]['native_order'])), 0)
 
         # Extract digital output channels to separate variables.
-        for i in range(header['num_board_dig_out_channels']):
-            data['board_dig_out_data'][i, :] = np.not_equal(np.bitwise_and(data['board_dig_out_raw'], (1 << header['board_dig_out_channels'][i]['native_order'])), 0)
+        if 'board_dig_out' in streams:
+            for i in range(header['num_board_dig_out_channels']):
+                data['board_dig_out_data'][i, :] = np.not_equal(np.bitwise_and(data['board_dig_out_raw'], (1 << header['board_dig_out_channels'][i]['native_order'])), 0)
 
         # Scale voltage levels appropriately.
-        if not(amplifier_rawbits):
-            data['amplifier_data'] = np.multiply(0.195, (data['amplifier_data'].astype(np.int32) - 32768))      # units = microvolts
-        data['aux_input_data'] = np.multiply(37.4e-6, data['aux_input_data'])               # units = volts
-        data['supply_voltage_data'] = np.multiply(74.8e-6, data['supply_voltage_data'])     # units = volts
-        if header['eval_board_mode'] == 1:
-            data['board_adc_data'] = np.multiply(152.59e-6, (data['board_adc_data'].astype(np.int32) - 32768)) # units = volts
-        elif header['eval_board_mode'] == 13:
-            data['board_adc_data'] = np.multiply(312.5e-6, (data['board_adc_data'].astype(np.int32) - 32768)) # units = volts
-        else:
-            data['board_adc_data'] = np.multiply(50.354e-6, data['board_adc_data'])           # units = volts
-        data['temp_sensor_data'] = np.multiply(0.01, data['temp_sensor_data'])               # units = deg C
+        if 'amplifier' in streams:
+            if amplifier_int16:
+                data['amplifier_data'] = rawbits_to_int16(data['amplifier_data'])                   # units = 0.195 microvolts
+            elif not(amplifier_rawbits):
+                data['amplifier_data'] = np.multiply(0.195, (data['amplifier_data'].astype(np.int32) - 32768))      # units = microvolts
+        if 'aux_input' in streams:
+            data['aux_input_data'] = np.multiply(37.4e-6, data['aux_input_data'])               # units = volts
+        if 'supply_voltage' in streams:
+            data['supply_voltage_data'] = np.multiply(74.8e-6, data['supply_voltage_data'])     # units = volts
+        if 'board_adc' in streams:
+            if header['eval_board_mode'] == 1:
+                data['board_adc_data'] = np.multiply(152.59e-6, (data['board_adc_data'].astype(np.int32) - 32768)) # units = volts
+            elif header['eval_board_mode'] == 13:
+                data['board_adc_data'] = np.multiply(312.5e-6, (data['board_adc_data'].astype(np.int32) - 32768)) # units = volts
+            else:
+                data['board_adc_data'] = np.multiply(50.354e-6, data['board_adc_data'])           # units = volts
+        if 'temp_sensor' in streams:
+            data['temp_sensor_data'] = np.multiply(0.01, data['temp_sensor_data'])               # units = deg C
 
         # Check for gaps in timestamps.
-        num_gaps = np.sum(np.not_equal(data['t_amplifier'][1:]-data['t_amplifier'][:-1], 1))
+        timestamp_segments = timestamps_to_segments(data['t_amplifier'])
+        num_gaps = timestamp_segments.shape[0] - 1
         if num_gaps == 0:
             print('No missing timestamps in data.')
         else:
             print('Warning: {0} gaps in timestamp data found.  Time scale will not be uniform!'.format(num_gaps))
 
         # Scale time steps (units = seconds).
-        data['t_amplifier'] = data['t_amplifier'] / header['sample_rate']
-        data['t_aux_input'] = data['t_amplifier'][range(0, len(data['t_amplifier']), 4)]
-        data['t_supply_voltage'] = data['t_amplifier'][range(0, len(data['t_amplifier']), header['num_samples_per_data_block'])]
-        data['t_board_adc'] = data['t_amplifier']
-        data['t_dig'] = data['t_amplifier']
-        data['t_temp_sensor'] = data['t_supply_voltage']
+        if not time_vectors:
+            del data['t_amplifier']
+        else:
+            data['t_amplifier'] = data['t_amplifier'] / header['sample_rate']
+            if 'aux_input' in streams:
+                data['t_aux_input'] = data['t_amplifier'][range(0, len(data['t_amplifier']), 4)]
+            if 'supply_voltage' in streams:
+                data['t_supply_voltage'] = data['t_amplifier'][range(0, len(data['t_amplifier']), header['num_samples_per_data_block'])]
+            if 'board_adc' in streams:
+                data['t_board_adc'] = data['t_amplifier']
+            if 'board_dig_in' in streams or 'board_dig_out' in streams:
+                data['t_dig'] = data['t_amplifier']
+            if 'temp_sensor' in streams:
+                data['t_temp_sensor'] = data['t_amplifier'][range(0, len(data['t_amplifier']), header['num_samples_per_data_block'])]
         
         # NO NOTCHING FOR LUANLAB STROKE EXPERIEMENTS: make sure to do it after the data are read
         # NOT SURE ABOUT THE POSSIBLE IMPLICATIONS OF DOING IT BY THE CHUNK 
@@ -223,12 +219,80 @@ def read_data(filename, amplifier_rawbits=False):
         data = [];
 
     # Move variables to result struct.
+    if amplifier_ch_indices is not None:
+        header = subset_header_channels(header, amplifier_ch_indices)
     result = data_to_result(header, data, data_present)
     result['sample_rate'] = header['sample_rate'] # added by jz103 March 29 2022
+    if data_present:
+        result['timestamp_segments'] = timestamp_segments
+        if 'board_dig_in' in streams:
+            result['board_dig_in_raw'] = data['board_dig_in_raw']
+    if amplifier_int16:
+        result['amplifier_conversion'] = 0.195
 
     print('Done!  Elapsed time: {0:0.1f} seconds'.format(time.time() - tic))
     return result
 
+def memmap_data(filename, channels=None):
+    """Memory-maps an RHD2000 data file instead of reading it into RAM.
+
+    Returns a dictionary shaped like the result of read_data, except that the
+    data entries are LazyBlockSignal views over an np.memmap of the data
+    blocks: `result['amplifier_data'][ch_slice, t_slice]` decodes only the
+    requested channels and blocks and scales them to microvolts on access
+    (`.raw` gives the stored uint16 bits). Nothing but the header is read here.
+    `channels` selects amplifier channels as in read_data.
+    """
+
+    fid = open(filename, 'rb')
+    filesize = os.path.getsize(filename)
+    header = read_header(fid, verbose=False)
+    header_size = fid.tell()
+    fid.close()
+
+    bytes_per_block = get_bytes_per_data_block(header)
+    bytes_remaining = filesize - header_size
+    if bytes_remaining % bytes_per_block != 0:
+        raise Exception('Something is wrong with file size : should have a whole number of data blocks')
+    num_data_blocks = int(bytes_remaining / bytes_per_block)
+
+    block_dtype = get_data_block_dtype(header)
+    if num_data_blocks > 0:
+        blocks = np.memmap(filename, dtype=block_dtype, mode='r', offset=header_size, shape=(num_data_blocks,))
+    else:
+        blocks = np.zeros(0, dtype=block_dtype)
+
+    amplifier_ch_indices = get_amplifier_channel_indices(header, channels)
+
+    result = data_to_result(subset_header_channels(header, amplifier_ch_indices), {}, False)
+    result['sample_rate'] = header['sample_rate']
+    result['header'] = header
+    result['num_data_blocks'] = num_data_blocks
+    result['num_amplifier_samples'] = header['num_samples_per_data_block'] * num_data_blocks
+
+    result['t_amplifier'] = LazyBlockSignal(blocks, 'timestamps', scale=1.0/header['sample_rate'])
+    if header['num_amplifier_channels'] > 0:
+        result['amplifier_data'] = LazyBlockSignal(blocks, 'amplifier', scale=0.195, offset=-32768, ch_indices=amplifier_ch_indices)   # units = microvolts
+    if header['num_aux_input_channels'] > 0:
+        result['aux_input_data'] = LazyBlockSignal(blocks, 'aux_input', scale=37.4e-6)                # units = volts
+    if header['num_supply_voltage_channels'] > 0:
+        result['supply_voltage_data'] = LazyBlockSignal(blocks, 'supply_voltage', scale=74.8e-6)      # units = volts
+    if header['num_temp_sensor_channels'] > 0:
+        result['temp_sensor_data'] = LazyBlockSignal(blocks, 'temp_sensor', scale=0.01)               # units = deg C
+    if header['num_board_adc_channels'] > 0:
+        if header['eval_board_mode'] == 1:
+            result['board_adc_data'] = LazyBlockSignal(blocks, 'board_adc', scale=152.59e-6, offset=-32768)
+        elif header['eval_board_mode'] == 13:
+            result['board_adc_data'] = LazyBlockSignal(blocks, 'board_adc', scale=312.5e-6, offset=-32768)
+        else:
+            result['board_adc_data'] = LazyBlockSignal(blocks, 'board_adc', scale=50.354e-6)         # units = volts
+    if header['num_board_dig_in_channels'] > 0:
+        result['board_dig_in_raw'] = LazyBlockSignal(blocks, 'board_dig_in', scale=None)
+    if header['num_board_dig_out_channels'] > 0:
+        result['board_dig_out_raw'] = LazyBlockSignal(blocks, 'board_dig_out', scale=None)
+
+    return result
+
 def plural(n):
     """Utility function to optionally pluralize words based on the value of n.
     """
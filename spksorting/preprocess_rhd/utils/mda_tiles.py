@@ -0,0 +1,211 @@
+'''
+Channel-major tiled sidecar for 2D (n_ch, n_samples) .mda recordings.
+
+MDA stores all channels of one sample next to each other, so reading one
+channel over a long time range touches every byte of the file. The sidecar
+(<name>.mda.tiles) stores the same data cut into time tiles of `tile_samples`
+samples; inside a tile each channel is contiguous. Reading a channel trace or
+spike-aligned windows of one channel then only reads the bytes needed.
+Optionally an extra track with the common average of all channels is stored
+after the tiles (see `with_car`), so that common-average-referenced
+waveforms of one channel can be read without touching the other channels.
+The average is stored as float32 whatever the data dtype, so it is not
+truncated for integer recordings.
+
+Layout: 56-byte header (magic, dt code, bytes per entry, n_ch, n_samples,
+tile_samples, n_tracks, dt code and bytes per entry of the average track, 0
+if there is none) followed by the tiles; tile t holds n_ch runs of len_t
+entries (len_t = tile_samples except for the last tile). The average track,
+if any, follows as one run of n_samples entries.
+'''
+import os
+import struct
+
+import numpy as np
+
+from .mdaio import DiskReadMda, _dt_from_dt_code, _dt_code_from_dt, get_num_bytes_per_entry_from_dt
+
+MDA_TILES_MAGIC = b"MDATILE2" # MDATILES sidecars stored the average in the data dtype
+MDA_TILES_HEADER_FORMAT = "<8siiqqqqii"
+MDA_TILES_HEADER_SIZE = struct.calcsize(MDA_TILES_HEADER_FORMAT)
+DEFAULT_TILE_SAMPLES = 1<<20 # ~35 seconds at 30 kHz
+CAR_TRACK_DT = "float32"
+
+def get_tiles_path(mda_path):
+    return mda_path + ".tiles"
+
+def build_mda_tiles(mda_path, tiles_path=None, tile_samples=DEFAULT_TILE_SAMPLES, with_car=False):
+    """
+    Build the sidecar of a 2D .mda file in one streaming pass (one tile of all
+    channels in memory at a time). Written to a temporary file and renamed,
+    so a sidecar is either complete or absent.
+    `with_car`: also store the mean across channels (float32) as an extra track
+    """
+    if tiles_path is None:
+        tiles_path = get_tiles_path(mda_path)
+    reader = DiskReadMda(mda_path)
+    dims = reader.dims()
+    if len(dims) != 2:
+        raise ValueError("Tiled sidecar only supports 2D .mda files; got dims %s" % (dims,))
+    n_ch, n_samples = int(dims[0]), int(dims[1])
+    dt = reader.dt()
+    n_tracks = n_ch + 1 if with_car else n_ch
+    tmp_path = tiles_path + ".tmp"
+    car_dt_code, car_bytes_per_entry = (_dt_code_from_dt(CAR_TRACK_DT), get_num_bytes_per_entry_from_dt(CAR_TRACK_DT)) if with_car else (0, 0)
+    car_offset = MDA_TILES_HEADER_SIZE + get_num_bytes_per_entry_from_dt(dt)*n_ch*n_samples
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(
+            MDA_TILES_HEADER_FORMAT, MDA_TILES_MAGIC, _dt_code_from_dt(dt),
+            get_num_bytes_per_entry_from_dt(dt), n_ch, n_samples, tile_samples, n_tracks,
+            car_dt_code, car_bytes_per_entry
+        ))
+        for beg in range(0, n_samples, tile_samples):
+            n = min(tile_samples, n_samples-beg)
+            tile = reader.readChunk(i1=0, i2=beg, N1=n_ch, N2=n)
+            np.ascontiguousarray(tile, dtype=dt).tofile(f) # C order: one contiguous run per channel
+            if with_car:
+                pos = f.tell()
+                f.seek(car_offset + car_bytes_per_entry*beg)
+                np.mean(tile, axis=0, dtype=np.float32).tofile(f) # same as common_reference.get_reference
+                f.seek(pos)
+    reader.close()
+    os.replace(tmp_path, tiles_path)
+    return tiles_path
+
+def open_mda_tiles(mda_path, tiles_path=None):
+    """
+    Reader of the sidecar of `mda_path` if it exists and is not older than
+    the .mda file; None otherwise (callers then fall back to the .mda file).
+    """
+    if tiles_path is None:
+        tiles_path = get_tiles_path(mda_path)
+    if not os.path.exists(tiles_path):
+        return None
+    if os.path.exists(mda_path) and os.path.getmtime(tiles_path) < os.path.getmtime(mda_path):
+        print("Ignoring outdated sidecar: %s" % (tiles_path))
+        return None
+    try:
+        return MdaTilesReader(tiles_path)
+    except IOError as e:
+        print("Ignoring sidecar (rebuild it with build_mda_tiles):", e)
+        return None
+
+class MdaTilesReader:
+    """
+    Positioned reads from a channel-major tiled sidecar. Methods mirror
+    DiskReadMda; `track` arguments are channel indices, or `car_track` for
+    the common average if the sidecar was built with `with_car`.
+    """
+    def __init__(self, tiles_path):
+        self._path = tiles_path
+        with open(tiles_path, "rb") as f:
+            header = f.read(MDA_TILES_HEADER_SIZE)
+        if header[:8] != MDA_TILES_MAGIC or len(header) < MDA_TILES_HEADER_SIZE:
+            raise IOError("Not an mda tiles file (or one of an older version): %s" % (tiles_path))
+        _, dt_code, self._bytes_per_entry, self._n_ch, self._n_samples, self._tile_samples, self._n_tracks, \
+            car_dt_code, self._car_bytes_per_entry = struct.unpack(MDA_TILES_HEADER_FORMAT, header)
+        self._dt = _dt_from_dt_code(dt_code)
+        self._car_dt = _dt_from_dt_code(car_dt_code) if self._n_tracks > self._n_ch else None
+        self._car_offset = MDA_TILES_HEADER_SIZE + self._bytes_per_entry*self._n_ch*self._n_samples
+        self._fd = os.open(tiles_path, os.O_RDONLY)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def __del__(self):
+        self.close()
+    def close(self):
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+            self._fd = None
+    def dims(self):
+        return [self._n_ch, self._n_samples]
+    def N1(self):
+        return self._n_ch
+    def N2(self):
+        return self._n_samples
+    def dt(self):
+        return self._dt
+    @property
+    def car_track(self):
+        return self._n_ch if self._car_dt is not None else None
+    def track_dt(self, track):
+        """dtype of a track: the data dtype for channels, float32 for `car_track`."""
+        return self._car_dt if track == self.car_track else self._dt
+    def _pread_into(self, buf, offset):
+        n_done = 0
+        while n_done < len(buf):
+            n_read = os.preadv(self._fd, [buf[n_done:]], offset+n_done)
+            if n_read == 0:
+                raise IOError("Unexpected end of file %s" % (self._path))
+            n_done += n_read
+    def _read_track_range(self, track, i2, N2, out):
+        """Read samples [i2, i2+N2) of one track into `out`, one read per tile touched."""
+        if track == self.car_track:
+            self._pread_into(memoryview(out.view(np.uint8)), self._car_offset + self._car_bytes_per_entry*i2)
+            return out
+        pos = i2
+        while pos < i2+N2:
+            i_tile = pos // self._tile_samples
+            tile_beg = i_tile*self._tile_samples
+            tile_len = min(self._tile_samples, self._n_samples-tile_beg)
+            seg_end = min(i2+N2, tile_beg+tile_len)
+            offset = MDA_TILES_HEADER_SIZE + self._bytes_per_entry*(
+                tile_beg*self._n_ch + track*tile_len + (pos-tile_beg))
+            self._pread_into(memoryview(out[pos-i2:seg_end-i2].view(np.uint8)), offset)
+            pos = seg_end
+        return out
+    def _check_range(self, track, i2, N2):
+        if track < 0 or track >= self._n_tracks:
+            raise IndexError("Track %d out of range [0, %d)" % (track, self._n_tracks))
+        if i2 < 0 or N2 < 0 or i2+N2 > self._n_samples:
+            raise IndexError("Samples [%d, %d) out of range [0, %d)" % (i2, i2+N2, self._n_samples))
+    def readChannel(self, track, i2=0, N2=None):
+        """Samples [i2, i2+N2) of one channel (or of `car_track`) as a 1D array."""
+        if N2 is None:
+            N2 = self._n_samples - i2
+        self._check_range(track, i2, N2)
+        return self._read_track_range(track, i2, N2, np.empty(N2, dtype=self.track_dt(track)))
+    def readChunk(self, i1=0, i2=0, N1=1, N2=1):
+        """Same as DiskReadMda.readChunk for a 2D file: channels [i1, i1+N1) x samples [i2, i2+N2) (not `car_track`)."""
+        if i1 < 0 or i1+N1 > self._n_ch:
+            raise IndexError("Channels [%d, %d) out of range [0, %d)" % (i1, i1+N1, self._n_ch))
+        ret = np.empty((N1, N2), dtype=self._dt)
+        for j in range(N1):
+            self._check_range(i1+j, i2, N2)
+            self._read_track_range(i1+j, i2, N2, ret[j])
+        return ret
+    def readWindows(self, track, i2_starts, N2):
+        """
+        Windows [t, t+N2) of one channel for every t in `i2_starts`
+        (e.g. spike-aligned waveforms); windows in the same tile are served
+        by one read of the part of that tile they span. Returns (n_windows, N2)
+        in the dtype of the track (see track_dt).
+        """
+        i2_starts = np.asarray(i2_starts, dtype=np.int64)
+        dt = self.track_dt(track)
+        ret = np.empty((i2_starts.shape[0], N2), dtype=dt)
+        if i2_starts.shape[0] == 0:
+            return ret
+        self._check_range(track, int(i2_starts.min()), N2)
+        self._check_range(track, int(i2_starts.max()), N2)
+        order = np.argsort(i2_starts, kind='stable')
+        sorted_starts = i2_starts[order]
+        tile_ids = sorted_starts // self._tile_samples
+        for run in np.split(np.arange(sorted_starts.shape[0]), np.flatnonzero(np.diff(tile_ids))+1):
+            run_beg = int(sorted_starts[run[0]])
+            run_end = int(sorted_starts[run[-1]]) + N2
+            X = self._read_track_range(track, run_beg, run_end-run_beg, np.empty(run_end-run_beg, dtype=dt))
+            ret[order[run]] = X[(sorted_starts[run]-run_beg)[:,None]+np.arange(N2)]
+        return ret
+
+
+if __name__ == '__main__':
+    # e.g. `python -m utils.mda_tiles /path/to/filt.mda --car`
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the channel-major tiled sidecar of a 2D .mda file")
+    parser.add_argument("mda_path")
+    parser.add_argument("--tile_samples", type=int, default=DEFAULT_TILE_SAMPLES)
+    parser.add_argument("--car", action="store_true", help="also store the common average track")
+    args = parser.parse_args()
+    print("Written:", build_mda_tiles(args.mda_path, tile_samples=args.tile_samples, with_car=args.car))
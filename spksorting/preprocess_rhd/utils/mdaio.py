@@ -2,9 +2,15 @@
 https://github.com/flatironinstitute/mountainsort/blob/master/packages/pyms/mlpy/mdaio.py
 Modified by jiaaoZ 01/20/2022
 '''
+import os
+import queue
+import threading
+
 import numpy as np
 import struct
 
+from .prv import is_prv, resolve_prv
+
 class MdaHeader:
     def __init__(self, dt0, dims0):
         uses64bitdims=(max(dims0)>2e9)            
@@ -21,13 +27,43 @@ class MdaHeader:
             self.header_size=(3+self.num_dims)*4
 
 class DiskReadMda:
+    """
+    Reader for (possibly very large) .mda files. One file handle is kept open
+    for the lifetime of the object (call close() or use it as a context
+    manager) and all reads are positioned reads (os.pread) into preallocated
+    arrays, so a reader can be shared by many small reads.
+    """
+    # windows closer than this (in bytes) are fetched with one read in readWindows
+    MERGE_GAP_BYTES=1<<16
+    # upper bound of a single read in readSlab when outer dims are read in full
+    MAX_READ_BYTES=1<<26
+    def __new__(cls,path=None,header=None):
+        # compressed .mdaz files are served by MdazReader with the same interface
+        if header is None and isinstance(path,str) and path.endswith('.mdaz'):
+            from .mdaz import MdazReader
+            return MdazReader(path)
+        return super().__new__(cls)
     def __init__(self,path,header=None):
+        if is_prv(path):
+            # MountainLab pointer file: read the .mda it points to (opened on first read)
+            path=resolve_prv(path)
         self._path=path
         if header:
             self._header=header
             self._header.header_size=0
         else:
-            self._header=_read_header(self._path)            
+            self._header=_read_header(self._path)
+        self._fd=None
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        self.close()
+    def __del__(self):
+        self.close()
+    def close(self):
+        if getattr(self,'_fd',None) is not None:
+            os.close(self._fd)
+            self._fd=None
     def dims(self):
         return self._header.dims
     def N1(self):
@@ -43,37 +79,131 @@ class DiskReadMda:
         if (i2<0):
             return self._read_chunk_1d(i1,N1)
         elif (i3<0):
-            if N1 != self._header.dims[0]:
-                print ("Unable to support N1 {} != {}".format(N1,self._header.dims[0]))
-                return None
-            X=self._read_chunk_1d(i1+N1*i2,N1*N2)
-            return np.reshape(X,(N1,N2),order='F')
+            return self.readSlab((i1,i2),(N1,N2))
         else:
-            if N1 != self._header.dims[0]:
-                print ("Unable to support N1 {} != {}".format(N1,self._header.dims[0]))
-                return None
-            if N2 != self._header.dims[1]:
-                print ("Unable to support N2 {} != {}".format(N2,self._header.dims[1]))
-                return None
-            X=self._read_chunk_1d(i1+N1*i2+N1*N2*i3,N1*N2*N3)
-            return np.reshape(X,(N1,N2,N3),order='F')
-    def _read_chunk_1d(self,i,N):
-        f=open(self._path,"rb")
-        try:
-            f.seek(self._header.header_size+self._header.num_bytes_per_entry*i)
-            ret=np.fromfile(f,dtype=self._header.dt,count=N)
-            f.close()
+            return self.readSlab((i1,i2,i3),(N1,N2,N3))
+    def readSlab(self,starts,counts,steps=None):
+        """
+        Read the hyperslab X[starts[0]:starts[0]+counts[0]*steps[0]:steps[0], ...]
+        of an array with any number of dims (given indices are per dim and
+        trailing dims default to the full extent), e.g. channels 3-7 of samples
+        [t0, t0+30000): readSlab((3,t0),(5,30000)).
+        Only the range spanned along the last partially selected dim is read from disk.
+        """
+        dims=[int(d) for d in self._header.dims]
+        nd=len(starts)
+        if steps is None:
+            steps=[1]*nd
+        starts=[int(s) for s in starts]+[0]*(len(dims)-nd)
+        counts=[int(c) for c in counts]+dims[nd:]
+        steps=[int(s) for s in steps]+[1]*(len(dims)-nd)
+        for j in range(len(dims)):
+            if counts[j]<0 or steps[j]<1 or starts[j]<0 or (counts[j]>0 and starts[j]+(counts[j]-1)*steps[j]>=dims[j]):
+                raise IndexError("Slab out of range in dim {}: start={} count={} step={} size={}".format(j,starts[j],counts[j],steps[j],dims[j]))
+        # last dim that is not read in full; dims after it are full, so the slab
+        # lies in consecutive blocks of inner*dims[k] entries, one per outer index
+        k=len(dims)-1
+        while k>0 and counts[k]==dims[k] and starts[k]==0 and steps[k]==1:
+            k-=1
+        if any(c==0 for c in counts):
+            return np.zeros(counts,dtype=self._header.dt,order='F')
+        inner=int(np.prod(dims[:k]))
+        n_outer=int(np.prod(dims[k+1:]))
+        sel=tuple(slice(starts[j],starts[j]+(counts[j]-1)*steps[j]+1,steps[j]) for j in range(k+1))
+        ret=np.empty(counts,dtype=self._header.dt,order='F')
+        if n_outer==1:
+            # only the range spanned along dim k is read
+            span=(counts[k]-1)*steps[k]+1
+            X=self._read_chunk_1d(inner*starts[k],inner*span)
+            X=np.reshape(X,dims[:k]+[span],order='F')
+            ret[...]=X[sel[:k]+(slice(None,None,steps[k]),)]
             return ret
-        except Exception as e: # catch *all* exceptions
-            print (e)
-            f.close()
-            return None
+        block=inner*dims[k]
+        n_per_read=max(1,self.MAX_READ_BYTES//(block*self._header.num_bytes_per_entry))
+        ret_flat=np.reshape(ret,counts[:k+1]+[n_outer],order='F') # view, ret is Fortran-ordered
+        for o in range(0,n_outer,n_per_read):
+            n=min(n_per_read,n_outer-o)
+            X=np.reshape(self._read_chunk_1d(block*o,block*n),dims[:k+1]+[n],order='F')
+            ret_flat[...,o:o+n]=X[sel]
+        return ret
+    def readWindows(self,i2_starts,N2,i1=0,N1=None):
+        """
+        Batched read of many windows X[i1:i1+N1, t:t+N2] of a 2D array, one per
+        t in `i2_starts` (e.g. spike-aligned waveform snippets).
+        Nearby windows are fetched with a single positioned read.
+        Returns an array of shape (len(i2_starts), N1, N2).
+        """
+        D1=self.N1()
+        if N1 is None:
+            N1=D1-i1
+        i2_starts=np.asarray(i2_starts,dtype=np.int64)
+        ret=np.empty((i2_starts.shape[0],N1,N2),dtype=self._header.dt)
+        if i2_starts.shape[0]==0:
+            return ret
+        if np.any(i2_starts<0) or np.any(i2_starts+N2>self.N2()):
+            raise IndexError("Window out of range [0, {})".format(self.N2()))
+        order=np.argsort(i2_starts,kind='stable')
+        sorted_starts=i2_starts[order]
+        max_gap=max(1,self.MERGE_GAP_BYTES//(D1*self._header.num_bytes_per_entry))
+        # group sorted windows into runs whose gaps are small enough to read through
+        breaks=np.flatnonzero(sorted_starts[1:]-(sorted_starts[:-1]+N2)>max_gap)+1
+        for run in np.split(np.arange(sorted_starts.shape[0]),breaks):
+            run_beg=int(sorted_starts[run[0]])
+            run_end=int(sorted_starts[run].max())+N2
+            X=self._read_chunk_1d(D1*run_beg,D1*(run_end-run_beg))
+            X=np.reshape(X,(D1,run_end-run_beg),order='F')
+            local=sorted_starts[run]-run_beg
+            ret[order[run]]=X[i1:i1+N1,local[:,None]+np.arange(N2)].transpose(1,0,2)
+        return ret
+    def _read_chunk_1d(self,i,N):
+        if self._fd is None:
+            self._fd=os.open(self._path,os.O_RDONLY)
+        ret=np.empty(int(N),dtype=self._header.dt)
+        buf=memoryview(ret.view(np.uint8))
+        offset=self._header.header_size+self._header.num_bytes_per_entry*int(i)
+        n_done=0
+        while n_done<len(buf):
+            if hasattr(os,'preadv'):
+                n_read=os.preadv(self._fd,[buf[n_done:]],offset+n_done)
+            else:
+                tmp=os.pread(self._fd,len(buf)-n_done,offset+n_done)
+                n_read=len(tmp)
+                buf[n_done:n_done+n_read]=tmp
+            if n_read==0:
+                raise IOError("Unexpected end of file {} reading {} bytes at {}".format(self._path,len(buf),offset))
+            n_done+=n_read
+        return ret
 
 class DiskWriteMda:
+    """
+    Writer for (possibly very large) .mda files. The header is written and the
+    file is preallocated to its final size on construction; one handle is kept
+    open (call close() or use it as a context manager) and every chunk is
+    written at its own position with os.pwrite, so chunks may arrive in any
+    order. For 2D/3D arrays i2/i3 are indices along dims 2/3 (e.g. the first
+    sample of the chunk), i1 must be 0 and the chunk spans the full leading dims.
+    """
     def __init__(self,path,dims,dt='float64'):
         self._path=path
         self._header=MdaHeader(dt,dims)
         _write_header(path, self._header)
+        self._fd=os.open(path,os.O_WRONLY)
+        total_size=self._header.header_size+self._header.num_bytes_per_entry*int(self._header.dimprod)
+        try:
+            os.posix_fallocate(self._fd,0,total_size)
+        except (AttributeError,OSError):
+            # not supported by the platform or the file system: just set the size
+            os.ftruncate(self._fd,total_size)
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        self.close()
+    def __del__(self):
+        self.close()
+    def close(self):
+        if getattr(self,'_fd',None) is not None:
+            os.close(self._fd)
+            self._fd=None
     def N1(self):
         return self._header.dims[0]
     def N2(self):
@@ -82,6 +212,11 @@ class DiskWriteMda:
         return self._header.dims[2]
     def writeChunk(self,X,i1=-1,i2=-1,i3=-1):
         #print("Writing chunk {} {} {} {}".format(i1,i2,i3,X[0]))
+        i_entry=self._get_entry_offset(X,i1,i2,i3)
+        if i_entry is None:
+            return None
+        return self._write_chunk_1d(self._as_entries(X),i_entry)
+    def _get_entry_offset(self,X,i1,i2,i3):
         if (len(X.shape)>=2):
             N1=X.shape[0]
         else:
@@ -95,12 +230,12 @@ class DiskWriteMda:
         else:
             N3=1
         if (i2<0):
-            return self._write_chunk_1d(X,i1)
+            return i1
         elif (i3<0):
             if N1 != self._header.dims[0]:
                 print ("Unable to support DiskWriteMda N1 {} != {}".format(N1,self._header.dims[0]))
                 return None
-            return self._write_chunk_1d(X.ravel(order='F'),i1+N1*i2)
+            return i1+N1*i2
         else:
             if N1 != self._header.dims[0]:
                 print ("Unable to support DiskWriteMda N1 {} != {}".format(N1,self._header.dims[0]))
@@ -108,20 +243,63 @@ class DiskWriteMda:
             if N2 != self._header.dims[1]:
                 print ("Unable to support DiskWriteMda N2 {} != {}".format(N2,self._header.dims[1]))
                 return None
-            return self._write_chunk_1d(X.ravel(order='F'),i1+N1*i2+N1*N2*i3)
+            return i1+N1*i2+N1*N2*i3
+    def _as_entries(self,X):
+        """X in file order and dtype as a 1D array; no copy if X already is Fortran-contiguous with the right dtype."""
+        X=np.asfortranarray(X,dtype=self._header.dt)
+        return np.reshape(X,X.size,order='F')
     def _write_chunk_1d(self,X,i):
-        N=X.size
-        f=open(self._path,"ab")
-        try:
-            #print('Writing data to file at position {} values: {}'.format(self._header.header_size+self._header.num_bytes_per_entry*i,X))
-            f.seek(self._header.header_size+self._header.num_bytes_per_entry*i)
-            X.astype(self._header.dt).tofile(f)
-            f.close()
-            return True
-        except Exception as e: # catch *all* exceptions
-            print (e)
-            f.close()
-            return False
+        X=np.ascontiguousarray(X,dtype=self._header.dt)
+        buf=memoryview(X.view(np.uint8))
+        offset=self._header.header_size+self._header.num_bytes_per_entry*int(i)
+        n_done=0
+        while n_done<len(buf):
+            n_done+=os.pwrite(self._fd,buf[n_done:],offset+n_done)
+        return True
+
+class StreamingMdaWriter(DiskWriteMda):
+    """
+    DiskWriteMda whose writes happen in a background thread: writeChunk only
+    converts the chunk to file order and queues it, so that producing the
+    next chunk (e.g. decoding .rhd files) overlaps with the disk write.
+    At most `max_queued_chunks` chunks wait in memory; writeChunk blocks
+    when the queue is full. Do not modify X after passing it to writeChunk.
+    close() (or leaving the `with` block) waits for all pending writes and
+    re-raises an error of the writer thread if any.
+    """
+    def __init__(self,path,dims,dt='float64',max_queued_chunks=4):
+        super().__init__(path,dims,dt)
+        self._queue=queue.Queue(maxsize=max(1,max_queued_chunks))
+        self._error=None
+        self._thread=threading.Thread(target=self._write_loop,daemon=True)
+        self._thread.start()
+    def _write_loop(self):
+        while True:
+            item=self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    DiskWriteMda._write_chunk_1d(self,*item)
+                except Exception as e: # reported by the next writeChunk/close
+                    self._error=e
+    def _check_error(self):
+        if self._error is not None:
+            raise IOError("Background write to {} failed: {}".format(self._path,self._error))
+    def _write_chunk_1d(self,X,i):
+        self._check_error()
+        if self._thread is None:
+            raise IOError("Writer of {} is already closed".format(self._path))
+        self._queue.put((X,i))
+        return True
+    def close(self):
+        if getattr(self,'_thread',None) is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread=None
+        super().close()
+        if getattr(self,'_error',None) is not None:
+            self._check_error()
 
 def _dt_from_dt_code(dt_code):
     if dt_code == -2:
@@ -236,11 +414,23 @@ def _write_header(path,H):
         f.close()
         return False
 
-def readmda(path):
+def readmda(path,mmap=False):
+    """
+    `mmap`: if True, return a read-only np.memmap (Fortran order) over the
+        data instead of reading everything into memory (ignored for .mdaz,
+        which is always decompressed in full; use DiskReadMda for ranges)
+    """
+    if path.endswith('.mdaz'):
+        from .mdaz import read_mdaz
+        return read_mdaz(path)
+    if is_prv(path):
+        path=resolve_prv(path)
     H=_read_header(path)
     if (H is None):
         print ("Problem reading header of: {}".format(path))
         return None
+    if mmap:
+        return np.memmap(path,dtype=H.dt,mode='r',offset=H.header_size,shape=tuple(H.dims),order='F')
     ret=np.array([])
     f=open(path,"rb")
     try:
@@ -255,28 +445,34 @@ def readmda(path):
         f.close()
         return None
 
-def writemda32(X,fname):
-    return _writemda(X,fname,'float32')
+def writemda32(X,fname,append=False):
+    return _writemda(X,fname,'float32',append)
 
-def writemda64(X,fname):
-    return _writemda(X,fname,'float64')
+def writemda64(X,fname,append=False):
+    return _writemda(X,fname,'float64',append)
 
-def writemda8(X,fname):
-    return _writemda(X,fname,'uint8')
+def writemda8(X,fname,append=False):
+    return _writemda(X,fname,'uint8',append)
 
-def writemda32i(X,fname):
-    return _writemda(X,fname,'int32')
+def writemda32i(X,fname,append=False):
+    return _writemda(X,fname,'int32',append)
 
-def writemda32ui(X,fname):
-    return _writemda(X,fname,'uint32')    
+def writemda32ui(X,fname,append=False):
+    return _writemda(X,fname,'uint32',append)    
 
-def writemda16i(X,fname):
-    return _writemda(X,fname,'int16')    
+def writemda16i(X,fname,append=False):
+    return _writemda(X,fname,'int16',append)    
 
-def writemda16ui(X,fname):
-    return _writemda(X,fname,'uint16')    
+def writemda16ui(X,fname,append=False):
+    return _writemda(X,fname,'uint16',append)    
 
-def _writemda(X,fname,dt):
+def _writemda(X,fname,dt,append=False):
+    """
+    `append`: if True and fname exists, X is appended along the last dim
+        (e.g. more spikes of a firings file); the other dims and dt must match
+    """
+    if append and os.path.exists(fname):
+        return _appendmda(X,fname,dt)
     dt_code=0
     num_bytes_per_entry=get_num_bytes_per_entry_from_dt(dt)
     dt_code=_dt_code_from_dt(dt)
@@ -291,15 +487,68 @@ def _writemda(X,fname,dt):
         _write_int32(f,X.ndim)
         for j in range(0,X.ndim):
             _write_int32(f,X.shape[j])
-        #This is how I do column-major order
-        A=np.reshape(X,X.size,order='F').astype(dt)
-        A.tofile(f)
+        _write_entries(f,X,dt)
     except Exception as e: # catch *all* exceptions
         print (e)
     finally:
         f.close()
         return True
 
+# upper bound of the temporary copy when X has to be cast or reordered before writing
+WRITE_BLOCK_BYTES=1<<26
+
+def _write_entries(f,X,dt):
+    """
+    Write X to f in column-major order as dt. If X already is Fortran-contiguous
+    with dtype dt the bytes are written straight from its buffer; otherwise X is
+    converted in blocks along the last dim, never as a whole.
+    """
+    dt=np.dtype(dt)
+    X=np.asanyarray(X)
+    if X.ndim==0:
+        X=np.reshape(X,1)
+    if X.dtype==dt and X.flags.f_contiguous:
+        f.write(memoryview(np.reshape(X,X.size,order='F').view(np.uint8)))
+        return
+    inner=max(1,int(np.prod(X.shape[:-1])))
+    n_per_block=max(1,WRITE_BLOCK_BYTES//(inner*dt.itemsize))
+    for j in range(0,X.shape[-1],n_per_block):
+        B=np.asfortranarray(X[...,j:j+n_per_block],dtype=dt)
+        f.write(memoryview(np.reshape(B,B.size,order='F').view(np.uint8)))
+
+def _appendmda(X,fname,dt):
+    H=_read_header(fname)
+    if H is None:
+        print ("Problem reading header of: {}".format(fname))
+        return False
+    if H.dt!=dt or X.ndim!=H.num_dims or list(X.shape[:-1])!=list(H.dims[:-1]):
+        print ("Cannot append {} array of shape {} to {} with dims {} and type {}".format(dt,X.shape,fname,H.dims,H.dt))
+        return False
+    n_last=int(H.dims[-1])+X.shape[-1]
+    if not H.uses64bitdims and n_last>=2**31:
+        print ("Cannot append to {}: last dim would exceed the 32-bit dims of its header".format(fname))
+        return False
+    f=open(fname,'r+b')
+    try:
+        # anything past the data of the header's dims (e.g. an interrupted append) is dropped
+        f.seek(H.header_size+int(H.dimprod)*H.num_bytes_per_entry)
+        f.truncate()
+        _write_entries(f,X,dt)
+        f.flush()
+        # the last dim is updated only after the data is written
+        if H.uses64bitdims:
+            f.seek(3*4+(H.num_dims-1)*8)
+            _write_int64(f,n_last)
+        else:
+            f.seek(3*4+(H.num_dims-1)*4)
+            _write_int32(f,n_last)
+        return True
+    except Exception as e: # catch *all* exceptions
+        print (e)
+        return False
+    finally:
+        f.close()
+
 def _read_int32(f):
     return struct.unpack('<i',f.read(4))[0]
     
@@ -324,13 +573,13 @@ def writemda16i_large(X, fname, n_samples_per_chunk=56000000):
     writer = DiskWriteMda(fname, dims, dt="int16") # header is already written as it is constructed
     n_complete_writes = int(X.shape[1]/n_samples_per_chunk)
     last_write_count = X.shape[1] - n_samples_per_chunk*n_complete_writes
-    last_write_entry_offset = n_complete_writes*n_samples_per_chunk*X.shape[0]
     for i in range(n_complete_writes):
         sample_offset = i*n_samples_per_chunk
-        entry_offset = sample_offset*X.shape[0]
-        writer.writeChunk(X[:, sample_offset:(sample_offset+n_samples_per_chunk)], i1=0, i2=entry_offset)
+        writer.writeChunk(X[:, sample_offset:(sample_offset+n_samples_per_chunk)], i1=0, i2=sample_offset)
     # write final residual chunk
-    writer.writeChunk(X[:, (-1*last_write_count):], i1=0, i2=last_write_entry_offset)
+    if last_write_count > 0:
+        writer.writeChunk(X[:, (-1*last_write_count):], i1=0, i2=n_complete_writes*n_samples_per_chunk)
+    writer.close()
     
 
 
@@ -0,0 +1,87 @@
+'''
+Resolution of MountainLab .prv pointer files.
+
+A .prv file (e.g. pre.mda.prv written by ephys.whiten) is a small JSON
+description of an .mda file kept elsewhere, usually in
+$ML_TEMPORARY_DIRECTORY:
+    {"original_checksum": <sha1 of the file>, "original_fcs": "head1000-<sha1 of the first 1000 bytes>",
+     "original_path": <path when it was written>, "original_size": <bytes>, "prv_version": ...}
+`resolve_prv` finds the file it points to, so readers can open it directly.
+'''
+import os
+import json
+import hashlib
+
+def is_prv(path):
+    return isinstance(path, str) and path.endswith(".prv")
+
+def read_prv(prv_path):
+    with open(prv_path, "r") as f:
+        return json.load(f)
+
+def _sha1_of_file(path, n_bytes=None, chunk_size=1<<24):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        if n_bytes is not None:
+            h.update(f.read(n_bytes))
+            return h.hexdigest()
+        for buf in iter(lambda: f.read(chunk_size), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+def _matches(path, prv, verify_checksum):
+    """Cheap checks (size, then hash of the first 1000 bytes) and optionally the full sha1."""
+    if not os.path.isfile(path):
+        return False
+    if "original_size" in prv and os.path.getsize(path) != int(prv["original_size"]):
+        return False
+    fcs = prv.get("original_fcs", "")
+    if fcs.startswith("head1000-") and _sha1_of_file(path, 1000) != fcs[len("head1000-"):]:
+        return False
+    if verify_checksum and "original_checksum" in prv:
+        return _sha1_of_file(path) == prv["original_checksum"]
+    return True
+
+def get_prv_search_dirs(prv_path):
+    """$ML_TEMPORARY_DIRECTORY (if set), then the folder of the .prv file (the output dir)."""
+    search_dirs = []
+    if os.environ.get("ML_TEMPORARY_DIRECTORY"):
+        search_dirs.append(os.environ["ML_TEMPORARY_DIRECTORY"])
+    search_dirs.append(os.path.dirname(os.path.abspath(prv_path)))
+    return search_dirs
+
+def resolve_prv(prv_path, search_dirs=None, verify_checksum=False):
+    """
+    Path of the file described by `prv_path`. Tried in order:
+    (1) "original_path";
+    (2) a file with the same name, then (3) any file of the same size and
+        first-1000-byte hash, directly in one of `search_dirs` or one
+        folder below (default: get_prv_search_dirs).
+    `verify_checksum`: also compare the sha1 of the whole file (slow for big files)
+    Raises IOError if nothing matches.
+    """
+    prv = read_prv(prv_path)
+    if search_dirs is None:
+        search_dirs = get_prv_search_dirs(prv_path)
+    original_path = prv.get("original_path")
+    if original_path and _matches(original_path, prv, verify_checksum):
+        return original_path
+    candidates = []
+    for search_dir in search_dirs:
+        if not os.path.isdir(search_dir):
+            continue
+        for entry in os.scandir(search_dir):
+            if entry.is_dir():
+                candidates += [os.path.join(entry.path, name) for name in sorted(os.listdir(entry.path))]
+            else:
+                candidates.append(entry.path)
+    if original_path:
+        name = os.path.basename(original_path)
+        for path in candidates:
+            if os.path.basename(path) == name and _matches(path, prv, verify_checksum):
+                return path
+    if "original_size" in prv:
+        for path in candidates:
+            if not path.endswith(".prv") and _matches(path, prv, verify_checksum):
+                return path
+    raise IOError("Could not locate the file pointed to by %s (searched %s)" % (prv_path, search_dirs))
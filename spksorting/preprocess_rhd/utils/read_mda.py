@@ -1,7 +1,34 @@
 import numpy as np
 import struct
 
-def readmda(fname):
+# mda data type code -> numpy dtype of the stored entries
+_MDA_DTYPES = {
+    -1: np.complex64,
+    -2: np.uint8,
+    -3: np.float32,
+    -4: np.int16,
+    -5: np.int32,
+    -6: np.uint16,
+    -7: np.float64,
+    -8: np.uint32,
+}
+
+def readmda(fname, mmap=False):
+    """
+    Read an .mda file into a numpy array of shape `dims` (column-major on disk).
+    `mmap`: if True only the header is read and a read-only np.memmap
+        (Fortran order) over the data is returned, so that memory use is
+        proportional to what is accessed; use it for big files such as filt.mda.
+        Complex data are then complex64 instead of complex128.
+    A compressed .mdaz file is always decompressed in full (`mmap` ignored).
+    A MountainLab .prv pointer file is resolved to the .mda it points to.
+    """
+    if fname.endswith(".prv"):
+        from .prv import resolve_prv
+        fname = resolve_prv(fname)
+    if fname.endswith(".mdaz"):
+        from .mdaz import read_mdaz
+        return read_mdaz(fname)
     f = open(fname, "rb")
     try:
         code=struct.unpack('i', f.read(4))[0]
@@ -26,6 +53,13 @@ def readmda(fname):
             S[j] = struct.unpack('i', f.read(4))[0]
     S = S.astype(np.int64)
     N = np.prod(S)
+    if mmap:
+        if code not in _MDA_DTYPES:
+            f.close()
+            raise IOError("Unsupported data type code: %d" % (code))
+        header_size = f.tell()
+        f.close()
+        return np.memmap(fname, dtype=_MDA_DTYPES[code], mode="r", offset=header_size, shape=tuple(S), order="F")
     # A = np.zeros(S)
     # print("read_mda dtype code:", code)
     if code==-1:
@@ -0,0 +1,176 @@
+"""
+Sparse TTL event extraction from the Intan digital inputs.
+
+Instead of expanding the packed 16-bit digital-input words into a dense
+(n_dig_channels, n_samples) boolean matrix, only the samples where the word
+changes are looked at; each changed bit becomes one row of a compact event
+table (sample, channel, rising). Sample indices are global within a session
+(see the folder index), so events line up with the converted .mda/NWB data.
+"""
+import os
+
+import numpy as np
+
+from .load_intan_rhd_format_updated import memmap_data
+from .rhd_index import get_rhd_folder_index
+
+TTL_EVENTS_FILENAME = "ttl_events.npz"
+
+# `channel` is the native order of the digital input; `rising` is False for falling edges
+TTL_EVENT_DTYPE = np.dtype([("sample", np.int64), ("channel", np.int16), ("rising", np.bool_)])
+
+
+def extract_ttl_edges(dig_raw, native_orders, sample_offset=0, prev_word=None):
+    """
+    Find the edges of the digital inputs packed in `dig_raw` (uint16 words, one per sample).
+    `native_orders` : bit positions of the enabled digital input channels
+    `sample_offset` : added to the returned sample indices (global offset of this file)
+    `prev_word` : digital word of the sample right before dig_raw[0] (e.g. last sample
+        of the previous file); if None no edge is reported at dig_raw[0]
+    Returns a TTL_EVENT_DTYPE array sorted by sample, then channel.
+    """
+    dig_raw = np.asarray(dig_raw, dtype=np.uint16)
+    native_orders = np.asarray(native_orders, dtype=np.int16)
+    if dig_raw.shape[0] == 0 or native_orders.shape[0] == 0:
+        return np.zeros(0, dtype=TTL_EVENT_DTYPE)
+    if prev_word is None:
+        prev_word = dig_raw[0]
+    prev = np.empty_like(dig_raw)
+    prev[0] = prev_word
+    prev[1:] = dig_raw[:-1]
+    # only the (few) samples where the word changes are expanded into bits
+    i_changed = np.flatnonzero(dig_raw != prev)
+    bitmask = np.left_shift(np.uint16(1), native_orders.astype(np.uint16))
+    toggled = (np.bitwise_xor(dig_raw[i_changed], prev[i_changed])[:, None] & bitmask[None, :]) != 0
+    i_row, i_ch = np.nonzero(toggled) # row-major: sorted by sample, then channel
+    events = np.empty(i_row.shape[0], dtype=TTL_EVENT_DTYPE)
+    events["sample"] = i_changed[i_row].astype(np.int64) + sample_offset
+    events["channel"] = native_orders[i_ch]
+    events["rising"] = (dig_raw[i_changed[i_row]] & bitmask[i_ch]) != 0
+    return events
+
+
+def get_session_dig_in_native_orders(rhd_index):
+    """Native orders of the digital inputs of an indexed session; they must not change between files."""
+    native_orders = None
+    for entry in rhd_index["files"]:
+        tmp_orders = [ch["native_order"] for ch in entry["header"]["board_dig_in_channels"]]
+        if native_orders is None:
+            native_orders = np.array(tmp_orders, dtype=np.int16)
+        elif not np.array_equal(native_orders, tmp_orders):
+            raise ValueError("Digital input channels differ within session: %s" % (entry["filename"]))
+    return np.zeros(0, dtype=np.int16) if native_orders is None else native_orders
+
+
+def extract_block_ttl_edges(dig_raw, native_orders):
+    """
+    Edges within one block of digital words (e.g. one file decoded by itself,
+    possibly in another process), to be joined in order by `TtlEventCollector`.
+    Returns None for an empty block.
+    """
+    dig_raw = np.asarray(dig_raw, dtype=np.uint16)
+    if dig_raw.shape[0] == 0:
+        return None
+    return {
+        "events": extract_ttl_edges(dig_raw, native_orders), # samples relative to the block
+        "first_word": dig_raw[0],
+        "last_word": dig_raw[-1],
+    }
+
+
+class TtlEventCollector:
+    """
+    Joins the edges of consecutive blocks of a session (see
+    `extract_block_ttl_edges`), added in sample order, into the result of
+    `extract_session_ttl_events`. Edges at block boundaries are found from
+    the last word of a block and the first word of the next one.
+    """
+    def __init__(self, native_orders, sample_rate=None):
+        self.native_orders = np.asarray(native_orders, dtype=np.int16)
+        self.sample_rate = sample_rate
+        self.initial_state = None
+        self._events = []
+        self._prev_word = None
+    def add(self, sample_offset, block_edges):
+        """`block_edges` of the block starting at session sample `sample_offset`."""
+        if block_edges is None:
+            return
+        first_word = np.array([block_edges["first_word"]], dtype=np.uint16)
+        if self.initial_state is None:
+            self.initial_state = (first_word[0] & np.left_shift(np.uint16(1), self.native_orders.astype(np.uint16))) != 0
+        else:
+            self._events.append(extract_ttl_edges(first_word, self.native_orders, sample_offset, self._prev_word))
+        events = block_edges["events"].copy()
+        events["sample"] += sample_offset
+        self._events.append(events)
+        self._prev_word = block_edges["last_word"]
+    def result(self, n_samples):
+        """Same dict as `extract_session_ttl_events`."""
+        return {
+            "events": np.concatenate(self._events) if len(self._events) > 0 else np.zeros(0, dtype=TTL_EVENT_DTYPE),
+            "native_orders": self.native_orders,
+            "initial_state": np.zeros(self.native_orders.shape[0], dtype=bool) if self.initial_state is None else self.initial_state,
+            "sample_rate": self.sample_rate,
+            "n_samples": n_samples,
+        }
+
+
+def extract_session_ttl_events(rhd_foldername, rhd_index=None):
+    """
+    Extract the digital-input edges of all .rhd files of a session, with sample
+    indices counted from the start of the session. Edges across file
+    boundaries are detected as well. This reads the files again; when the
+    amplifier data are decoded anyway, collect the edges of each file on the
+    way instead (`extract_block_ttl_edges`, `TtlEventCollector`).
+    Returns a dict with keys:
+        "events" : TTL_EVENT_DTYPE array
+        "native_orders" : native orders of the digital input channels
+        "initial_state" : bool level of each channel at the first sample
+        "sample_rate" : sampling rate of the session
+        "n_samples" : total number of samples in the session
+    """
+    if rhd_index is None:
+        rhd_index = get_rhd_folder_index(rhd_foldername)
+    n_samples_cumsum = rhd_index["n_samples_cumsum"]
+    collector = TtlEventCollector(
+        get_session_dig_in_native_orders(rhd_index),
+        rhd_index["files"][0]["sample_rate"] if len(rhd_index["files"]) > 0 else None
+    )
+    for i_file, entry in enumerate(rhd_index["files"]):
+        if collector.native_orders.shape[0] == 0 or entry["n_samples"] == 0:
+            continue
+        parsed = memmap_data(os.path.join(rhd_foldername, entry["filename"]))
+        collector.add(n_samples_cumsum[i_file], extract_block_ttl_edges(parsed["board_dig_in_raw"][:], collector.native_orders))
+        del parsed
+    return collector.result(n_samples_cumsum[-1])
+
+
+def save_ttl_events(path, ttl_events):
+    """Save the result of `extract_session_ttl_events` as .npz."""
+    np.savez(
+        path,
+        sample=ttl_events["events"]["sample"],
+        channel=ttl_events["events"]["channel"],
+        rising=ttl_events["events"]["rising"],
+        native_orders=ttl_events["native_orders"],
+        initial_state=ttl_events["initial_state"],
+        sample_rate=np.nan if ttl_events["sample_rate"] is None else ttl_events["sample_rate"],
+        n_samples=ttl_events["n_samples"],
+    )
+
+
+def load_ttl_events(path):
+    """Load a .npz written by `save_ttl_events` back into the same dict."""
+    with np.load(path) as f:
+        events = np.empty(f["sample"].shape[0], dtype=TTL_EVENT_DTYPE)
+        events["sample"] = f["sample"]
+        events["channel"] = f["channel"]
+        events["rising"] = f["rising"]
+        sample_rate = float(f["sample_rate"])
+        return {
+            "events": events,
+            "native_orders": f["native_orders"],
+            "initial_state": f["initial_state"],
+            "sample_rate": None if np.isnan(sample_rate) else sample_rate,
+            "n_samples": int(f["n_samples"]),
+        }
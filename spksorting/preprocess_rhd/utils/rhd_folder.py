@@ -10,6 +10,7 @@ import sys
 import re
 import datetime
 import gc
+import warnings
 from collections import OrderedDict
 import xml.etree.ElementTree as ET
 
@@ -21,20 +22,35 @@ import pynwb
 
 from .load_intan_rhd_format_updated import read_data, read_header
 from . import rhd_io_utils as rhdio
+from .rhd_index import get_rhd_folder_index
+from .rhd_events import extract_session_ttl_events, get_session_dig_in_native_orders, extract_block_ttl_edges, \
+    TtlEventCollector
+from .rhd_timestamps import get_session_timestamp_segments, save_timestamp_segments, describe_timestamp_gaps, \
+    slice_segments, TIMESTAMP_SEGMENTS_FILENAME
+from .rhd_stream import iter_rhd_session_chunks
+from .rhd_parallel import decode_files_ordered
 
 class NoStdOut():
     def write(self, x): pass
     def flush(self, x=None): pass
 NOSTDOUT = NoStdOut()
 
-def load_rhd_file_silently(filename, amplifier_rawbits):
+def load_rhd_file_silently(filename, amplifier_rawbits, channels=None, amplifier_int16=False, dig_in_native_orders=None):
     """
     Load RHD file without printing anything to stdout.
+    `channels` : optional amplifier channel mask/native orders passed to `read_data`
+    `amplifier_int16` : load amplifier data as int16 counts, see `read_data`
+    `dig_in_native_orders` : if given, the digital-input edges of the file are
+        found while it is decoded and returned as "ttl_edges" (see `extract_block_ttl_edges`)
     """
+    streams = ('amplifier',) if dig_in_native_orders is None else ('amplifier', 'board_dig_in')
     save_stdout = sys.stdout
     sys.stdout = NOSTDOUT
-    rhs_readout_parsed = read_data(filename, amplifier_rawbits=amplifier_rawbits)
+    rhs_readout_parsed = read_data(filename, amplifier_rawbits=amplifier_rawbits, channels=channels, amplifier_int16=amplifier_int16, streams=streams, time_vectors=False)
     sys.stdout = save_stdout
+    if dig_in_native_orders is not None:
+        rhs_readout_parsed.pop("board_dig_in_data", None)
+        rhs_readout_parsed["ttl_edges"] = extract_block_ttl_edges(rhs_readout_parsed.pop("board_dig_in_raw"), dig_in_native_orders)
     return rhs_readout_parsed
 
 
@@ -43,6 +59,43 @@ RHD_CONV_FACTOR = {
     "offset": -32768*0.195
 }
 
+# for int16 amplifier data (raw bits - 32768); see `read_data(amplifier_int16=True)`
+RHD_INT16_CONV_FACTOR = {
+    "conversion": 0.195,
+    "offset": 0.0
+}
+
+# samples per chunk when int16 sessions are streamed across files (one minute at 30 kHz)
+RHD_STREAM_CHUNK_SAMPLES = 1800000
+
+def iter_rhd_append_chunks(rhd_foldername, rhd_index, chunk_samples=RHD_STREAM_CHUNK_SAMPLES,
+        channels=None, beg_sample=0, ts_segments=None, dig_in_native_orders=None):
+    """
+    Yield the int16 amplifier data of a session from `beg_sample` on in chunks of
+    `chunk_samples` that cross file boundaries (see `rhd_stream`), as dicts that
+    `rhdio.append_temp_hdf5` / `rhdio.append_nwb` accept in place of a parsed file.
+    `ts_segments`: session timestamp segments; if given each dict also carries
+        the "timestamp_segments" of its chunk (needed by the temp HDF5)
+    `dig_in_native_orders`: if given each dict also carries the "ttl_edges" of its
+        chunk (see `extract_block_ttl_edges`)
+    """
+    for chunk in iter_rhd_session_chunks(rhd_foldername, chunk_samples, channels=channels,
+            beg_sample=beg_sample, rhd_index=rhd_index, with_dig_in=dig_in_native_orders is not None):
+        parsed = {"amplifier_data": chunk.data}
+        if ts_segments is not None:
+            parsed["timestamp_segments"] = slice_segments(ts_segments, chunk.beg_sample, chunk.end_sample)
+        if dig_in_native_orders is not None:
+            parsed["ttl_edges"] = extract_block_ttl_edges(chunk.dig_in[chunk.core], dig_in_native_orders)
+        yield parsed
+
+def get_rhd_data_conv(amplifier_rawbits, amplifier_int16):
+    """NWB conversion factors matching how the amplifier data were loaded."""
+    if amplifier_int16:
+        return RHD_INT16_CONV_FACTOR
+    if amplifier_rawbits:
+        return RHD_CONV_FACTOR
+    return None
+
 def is_ephys_folder(foldername):
     return re.match(r"([a-zA-Z0-9_\-]+)_(\d{6}_\d{6})", foldername) is not None
 
@@ -71,7 +124,11 @@ def read_rhd_folder(
         channel_map: dict | None = None,
         metadata = None,
         channel_mask: np.ndarray | None = None,
-        amplifier_rawbits: bool = False):
+        amplifier_rawbits: bool = False,
+        amplifier_int16: bool = False,
+        chunk_samples: int = RHD_STREAM_CHUNK_SAMPLES,
+        n_workers: int = 1,
+        max_inflight: int | None = None):
     """
         `rhd_foldername` should include a series of rhd files and 
         one `settings.xml`
@@ -81,15 +138,27 @@ def read_rhd_folder(
             `map_path`: str, path to the map file (csv)
         `channel_mask` : np.ndarray of bool, shape (n_chs,), True for channels to be kept
         `amplifier_rawbits`: whether the parsed amplifier data are in float64 or raw bits in Intan
+        `amplifier_int16`: keep amplifier data as int16 counts end-to-end (never float64);
+            the microvolt conversion is stored as NWB metadata. Takes precedence over `amplifier_rawbits`.
+            The files after the first one are then streamed in chunks of `chunk_samples`
+            across file boundaries instead of being decoded one whole file at a time.
+        `n_workers`: otherwise the files are decoded in a pool of that many processes and
+            appended in file order, see `rhd_parallel.decode_files_ordered`
+        `max_inflight`: maximum number of decoded files held in memory (default 2*n_workers)
+        Timestamp gaps (dropped or repeated samples) are warned about; when exporting to NWB the
+        timestamp segments are then saved next to the NWB file (see `rhd_timestamps`).
+        When exporting to NWB the digital-input edges are also collected while the files are
+        decoded and returned as "ttl_events" (see `rhd_events.extract_session_ttl_events`).
     """
     
-    rhd_filenames = sorted(
-        list(filter(lambda x: x.endswith(".rhd"), os.listdir(rhd_foldername))),
-        key=get_rhd_timestamp
-    )
+    rhd_index = get_rhd_folder_index(rhd_foldername)
+    rhd_filenames = [e["filename"] for e in rhd_index["files"]]
     rhd_fullfilenames = list(map(
         lambda x: os.path.join(rhd_foldername, x), rhd_filenames
     ))
+    ts_segments = get_session_timestamp_segments(rhd_foldername, rhd_index)
+    if ts_segments["gaps"].shape[0] > 0:
+        warnings.warn("%s has %s" % (rhd_foldername, describe_timestamp_gaps(ts_segments["gaps"], ts_segments["sample_rate"])))
     
     session_start_time = get_rhd_timestamp(rhd_filenames[0])
 
@@ -100,15 +169,31 @@ def read_rhd_folder(
     else:
         mode = "conversion_only"
     
+    # decide which channels to keep before decoding, so that dropped channels are never loaded
+    if channel_mask is None and mode=="conversion_only":
+        channel_mask = rhdio.get_hotfix_32on64_mask(rhd_index["files"][0]["header"]["amplifier_channels"])
+
+    # find the digital-input edges on the way when exporting, instead of reading the session again
+    dig_in_native_orders = None
+    ttl_collector = None
+    if mode=="conversion_only":
+        dig_in_native_orders = get_session_dig_in_native_orders(rhd_index)
+        ttl_collector = TtlEventCollector(dig_in_native_orders, ts_segments["sample_rate"])
+        if dig_in_native_orders.shape[0] == 0:
+            dig_in_native_orders = None
+
     # initialize the data structure with the first read rhd data
-    rhd_readout_parsed = load_rhd_file_silently(rhd_fullfilenames[0], amplifier_rawbits=amplifier_rawbits)
+    rhd_readout_parsed = load_rhd_file_silently(rhd_fullfilenames[0], amplifier_rawbits=amplifier_rawbits, channels=channel_mask, amplifier_int16=amplifier_int16, dig_in_native_orders=dig_in_native_orders)
+    if ttl_collector is not None:
+        ttl_collector.add(0, rhd_readout_parsed.get("ttl_edges"))
+    n_samples_appended = rhd_readout_parsed["amplifier_data"].shape[1]
     if mode=="load_memmap":
         assert TEMP_FOLDER is not None
         # create numpy memmaps with HDF5
         h5_tmpfilename = os.path.join(TEMP_FOLDER, "temp_rhd_data.h5")
         # store data as parsed since we are reading it instantly
         print("Creating temporary HDF5 file for rhd data")
-        rhd_hdf5 = rhdio.initiate_temp_hdf5(h5_tmpfilename, rhd_readout_parsed, channel_mask)
+        rhd_hdf5 = rhdio.initiate_temp_hdf5(h5_tmpfilename, rhd_readout_parsed)
     elif mode=="load_ram":
         # Everything is in RAM without memmap
         # just create a list for concantenation later on
@@ -135,11 +220,8 @@ def read_rhd_folder(
             
         if not os.path.exists(os.path.dirname(export_nwb_path)):
             os.makedirs(os.path.dirname(export_nwb_path))
-        if amplifier_rawbits:
-            data_conv = RHD_CONV_FACTOR
-        else:
-            data_conv = None
-        rhd_nwb = rhdio.initiate_nwb(export_nwb_path, rhd_readout_parsed, channel_map, metadata, channel_mask, data_conv) # should return None
+        data_conv = get_rhd_data_conv(amplifier_rawbits, amplifier_int16)
+        rhd_nwb = rhdio.initiate_nwb(export_nwb_path, rhd_readout_parsed, channel_map, metadata, None, data_conv) # should return None
         # rhd_nwb.close()
         # save data to disk with small RAM usage
         # TODO Consider whether to store data AS-IS or parsed
@@ -150,21 +232,41 @@ def read_rhd_folder(
     # important to delete unused data and free up memory
     del rhd_readout_parsed
     gc.collect()
-    # read and append the rest of the files
-    for i_rhd in tqdm.tqdm(range(1, len(rhd_fullfilenames))):
-        rhdpath = rhd_fullfilenames[i_rhd]
-        rhd_readout_parsed = load_rhd_file_silently(rhdpath, amplifier_rawbits=amplifier_rawbits)
+    def _append(parsed):
+        nonlocal n_samples_appended
+        if ttl_collector is not None:
+            ttl_collector.add(n_samples_appended, parsed.get("ttl_edges"))
+        n_samples_appended += parsed["amplifier_data"].shape[1]
         if mode=="load_memmap":
-            rhdio.append_temp_hdf5(rhd_hdf5, h5_tmpfilename, rhd_readout_parsed, channel_mask)
+            rhdio.append_temp_hdf5(rhd_hdf5, h5_tmpfilename, parsed)
         elif mode=="load_ram":
             raise NotImplementedError
         elif mode=="conversion_only":
-            rhdio.append_nwb(rhd_nwb, export_nwb_path, rhd_readout_parsed, channel_mask)
+            rhdio.append_nwb(rhd_nwb, export_nwb_path, parsed)
         else:
             raise ValueError("Mode did not match any supported candidates")
-        # important to delete unused data and free up memory
-        del rhd_readout_parsed
-        gc.collect()
+    # read and append the rest of the session
+    n_samples_cumsum = rhd_index["n_samples_cumsum"]
+    if amplifier_int16:
+        # int16 counts are what the session reader returns: memory only depends on `chunk_samples`
+        for parsed in tqdm.tqdm(iter_rhd_append_chunks(
+                rhd_foldername, rhd_index, chunk_samples, channel_mask, beg_sample=n_samples_cumsum[1],
+                ts_segments=ts_segments["segments"] if mode=="load_memmap" else None,
+                dig_in_native_orders=dig_in_native_orders),
+                total=-(-(n_samples_cumsum[-1]-n_samples_cumsum[1])//chunk_samples)):
+            _append(parsed)
+            del parsed
+    else:
+        progress = tqdm.tqdm(total=len(rhd_fullfilenames)-1)
+        def _append_file(i_task, parsed):
+            _append(parsed)
+            progress.update(1)
+        decode_files_ordered(
+            load_rhd_file_silently,
+            [(rhdpath, amplifier_rawbits, channel_mask, amplifier_int16, dig_in_native_orders) for rhdpath in rhd_fullfilenames[1:]],
+            _append_file, n_workers=n_workers, max_inflight=max_inflight
+        )
+        progress.close()
     
     # finally
     if mode=="load_memmap":
@@ -172,10 +274,16 @@ def read_rhd_folder(
     elif mode=="load_ram":
         raise NotImplementedError
     elif mode=="conversion_only":
+        ts_segments_path = None
+        if ts_segments["gaps"].shape[0] > 0:
+            ts_segments_path = os.path.join(os.path.dirname(export_nwb_path), TIMESTAMP_SEGMENTS_FILENAME)
+            save_timestamp_segments(ts_segments_path, ts_segments)
         ret_dict = {
             "session_start_time": session_start_time,
             "rhd_filenames": rhd_filenames,
             "rhd_fullfilenames": rhd_fullfilenames,
+            "timestamp_segments_path": ts_segments_path,
+            "ttl_events": ttl_collector.result(n_samples_cumsum[-1]),
         }
         return ret_dict
     else:
@@ -201,13 +309,18 @@ def read_rhd_folder(
 
 
 def intans2nwb_cat(ephys_dnames, proc_dname, channel_map, metadata, nwb_fname, 
-    sort_by_time=True, amplifier_rawbits=False, channel_masks=None):
+    sort_by_time=True, amplifier_rawbits=False, channel_masks=None, amplifier_int16=False,
+    chunk_samples=RHD_STREAM_CHUNK_SAMPLES, n_workers=1, max_inflight=None):
     """
     Given a list `ephys_dnames` of ephys folders; read their rhd files and
     concatenate them into one NWB file. This is useful for broken-into-pieces
     sessions recorded on one day.
     Returns a dict of which raw rhd folder starts from which index.
     TODO test the added option to store raw uint16 bits from Intan
+    `amplifier_int16`: store int16 counts with the microvolt conversion as NWB metadata;
+        each session is then streamed in chunks of `chunk_samples` across its files
+    `n_workers`, `max_inflight`: otherwise the files of each session are decoded in
+        parallel and appended in order, see `read_rhd_folder`
     """
     if not os.path.exists(proc_dname):
         os.makedirs(proc_dname)
@@ -219,14 +332,13 @@ def intans2nwb_cat(ephys_dnames, proc_dname, channel_map, metadata, nwb_fname,
             channel_map["map_path"], header=None
             ).values.squeeze().astype(int)
     
-    # count ephys files
+    # count ephys files; file lists, headers and sample counts come from each folder's index
     ephys_files_tuples = [] # rhd filenames for each session (rhd folder)
     session_start_stamps_dict = OrderedDict()
+    rhd_indices_dict = OrderedDict()
     for ephys_dname in ephys_dnames:
-        rhd_filenames = sorted(
-            list(filter(lambda x: x.endswith(".rhd"), os.listdir(ephys_dname))),
-            key=get_rhd_timestamp
-        )
+        rhd_indices_dict[ephys_dname] = get_rhd_folder_index(ephys_dname)
+        rhd_filenames = [e["filename"] for e in rhd_indices_dict[ephys_dname]["files"]]
         ephys_files_tuples.append((ephys_dname, rhd_filenames))
         session_start_stamps_dict[ephys_dname] = get_rhd_timestamp(rhd_filenames[0])
     if sort_by_time:
@@ -239,26 +351,38 @@ def intans2nwb_cat(ephys_dnames, proc_dname, channel_map, metadata, nwb_fname,
     for i_session, (ephys_dname, rhd_filenames) in tqdm.tqdm(enumerate(ephys_files_tuples), total=len(ephys_files_tuples)):
         # keep track of total samples (which index each session starts from)
         beg_samples_dict[ephys_dname] = total_samples_cnter
-        ch_mask = channel_masks[i_session]
-        for i_rhd in range(len(rhd_filenames)):
-            rhdpath = os.path.join(ephys_dname, rhd_filenames[i_rhd])
-            rhd_readout_parsed = load_rhd_file_silently(rhdpath, amplifier_rawbits=amplifier_rawbits)
-            # NWB file manuvering
-            if i_session==0 and i_rhd==0:
-                # first rhd file in first session is different because of metadata
-                session_start_time = session_start_stamps_dict[ephys_dname]
-                metadata["start_time"] = session_start_time
-                if amplifier_rawbits:
-                    data_conv = RHD_CONV_FACTOR
-                else:
-                    data_conv = None
-                rhdio.initiate_nwb(nwbpath, rhd_readout_parsed, channel_map, metadata, mask=ch_mask, data_conv=data_conv)
-            else:
-                rhdio.append_nwb(rhd_nwb, nwbpath, rhd_readout_parsed, mask=ch_mask)
-            # keep track of total samples
-            total_samples_cnter = total_samples_cnter + rhd_readout_parsed["amplifier_data"].shape[1]
+        ch_mask = channel_masks[i_session] if channel_masks is not None else None
+        if ch_mask is None:
+            ch_mask = rhdio.get_hotfix_32on64_mask(rhd_indices_dict[ephys_dname]["files"][0]["header"]["amplifier_channels"])
+        rhd_index = rhd_indices_dict[ephys_dname]
+        i_rhd_first = 0
+        if i_session==0:
+            # first rhd file in first session is different because of metadata
+            rhdpath = os.path.join(ephys_dname, rhd_filenames[0])
+            rhd_readout_parsed = load_rhd_file_silently(rhdpath, amplifier_rawbits=amplifier_rawbits, channels=ch_mask, amplifier_int16=amplifier_int16)
+            session_start_time = session_start_stamps_dict[ephys_dname]
+            metadata["start_time"] = session_start_time
+            data_conv = get_rhd_data_conv(amplifier_rawbits, amplifier_int16)
+            rhdio.initiate_nwb(nwbpath, rhd_readout_parsed, channel_map, metadata, data_conv=data_conv)
             del rhd_readout_parsed
             gc.collect()
+            i_rhd_first = 1
+        if amplifier_int16:
+            # unwanted channels are dropped while reading; memory only depends on `chunk_samples`
+            for parsed in iter_rhd_append_chunks(ephys_dname, rhd_index, chunk_samples, ch_mask,
+                    beg_sample=rhd_index["n_samples_cumsum"][i_rhd_first]):
+                rhdio.append_nwb(rhd_nwb, nwbpath, parsed)
+                del parsed
+        else:
+            # unwanted channels are dropped while decoding
+            decode_files_ordered(
+                load_rhd_file_silently,
+                [(os.path.join(ephys_dname, f), amplifier_rawbits, ch_mask, amplifier_int16) for f in rhd_filenames[i_rhd_first:]],
+                lambda i_task, parsed: rhdio.append_nwb(rhd_nwb, nwbpath, parsed),
+                n_workers=n_workers, max_inflight=max_inflight
+            )
+        # keep track of total samples
+        total_samples_cnter = total_samples_cnter + rhd_indices_dict[ephys_dname]["n_samples_cumsum"][-1]
     return beg_samples_dict, total_samples_cnter
 
 
@@ -316,3 +440,37 @@ def add_imp_to_nwb(intan_imp_obj, nwbpath, verbose=False):
         nwb2 = mwb_io2.read()
         print(nwb2.electrodes.to_dataframe())
         mwb_io2.close()
+
+def add_ttl_events_to_nwb(rhd_foldername, nwbpath, verbose=False, ttl_events=None):
+    """
+    Add the digital input edges of a rhd folder to NWB file as a TimeSeries
+    "TTLEvents" in acquisition; data[:, 0] is the native order of the digital
+    input and data[:, 1] is +1 for rising and -1 for falling edges.
+    Sessions without digital inputs are left untouched.
+    `ttl_events`: edges already collected while converting (the "ttl_events" returned by
+        `read_rhd_folder`); only if None are the rhd files read again for them
+    """
+    if ttl_events is None:
+        ttl_events = extract_session_ttl_events(rhd_foldername)
+    if ttl_events["native_orders"].shape[0] == 0:
+        if verbose:
+            print("No digital input channels; no TTL events added")
+        return
+    events = ttl_events["events"]
+    ttl_data = np.stack([events["channel"], np.where(events["rising"], 1, -1)], axis=1).astype(np.int16)
+    ttl_series = pynwb.TimeSeries(
+        name="TTLEvents",
+        data=ttl_data,
+        timestamps=events["sample"] / ttl_events["sample_rate"],
+        unit="n.a.",
+        description="Intan digital input edges; columns: native order, +1 rising/-1 falling",
+        comments="initial state per native order %s: %s" % (
+            ttl_events["native_orders"].tolist(), ttl_events["initial_state"].astype(int).tolist()),
+    )
+    nwb_io = pynwb.NWBHDF5IO(nwbpath, "a")
+    nwb = nwb_io.read()
+    nwb.add_acquisition(ttl_series)
+    nwb_io.write(nwb)
+    nwb_io.close()
+    if verbose:
+        print("Added %d TTL events to %s" % (events.shape[0], nwbpath))
@@ -0,0 +1,127 @@
+"""
+Folder-level index of a session of .rhd files.
+
+For every .rhd file the index keeps the parsed header, the number of data
+blocks / samples and the first and last timestamps, so that callers can plan
+allocations and sample offsets for a whole session without re-parsing headers
+or touching the data payload. The index is persisted as a JSON sidecar in the
+session folder; entries are reused as long as the file size and mtime match.
+"""
+import os
+import json
+import struct
+import warnings
+
+import numpy as np
+
+from .load_intan_rhd_format_updated import read_header
+from .load_intan_rhd_format_updated.intanutil.get_bytes_per_data_block import get_bytes_per_data_block
+
+RHD_INDEX_FILENAME = "rhd_index.json"
+RHD_INDEX_VERSION = 1
+
+
+def get_datetimestr_from_rhd_filename(filename):
+    """
+    Sort key for ParentPath/Animalname(_moredescriptions)_YYMMDD_HHMMSS.rhd
+    """
+    tmp = os.path.basename(filename).split("_")
+    return tmp[-2]+'_'+tmp[-1].split('.')[0]
+
+
+def _read_timestamp(fid, offset, signed):
+    fid.seek(offset)
+    return struct.unpack('<i' if signed else '<I', fid.read(4))[0]
+
+
+def index_rhd_file(rhd_path):
+    """
+    Parse the header of one .rhd file and compute its index entry.
+    Only the header and two timestamps are read from the file.
+    """
+    st = os.stat(rhd_path)
+    with open(rhd_path, "rb") as fid:
+        header = read_header(fid, verbose=False)
+        header_size = fid.tell()
+        bytes_per_block = get_bytes_per_data_block(header)
+        bytes_remaining = st.st_size - header_size
+        if bytes_remaining % bytes_per_block != 0:
+            raise Exception('Something is wrong with file size : should have a whole number of data blocks: %s' % (rhd_path))
+        n_blocks = int(bytes_remaining // bytes_per_block)
+        n_spb = header['num_samples_per_data_block']
+        signed = (header['version']['major'] == 1 and header['version']['minor'] >= 2) or (header['version']['major'] > 1)
+        if n_blocks > 0:
+            first_timestamp = _read_timestamp(fid, header_size, signed)
+            last_timestamp = _read_timestamp(fid, header_size + (n_blocks-1)*int(bytes_per_block) + (n_spb-1)*4, signed)
+        else:
+            first_timestamp = None
+            last_timestamp = None
+    return {
+        "filename": os.path.basename(rhd_path),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "header": header,
+        "header_size": header_size,
+        "bytes_per_block": int(bytes_per_block),
+        "n_blocks": n_blocks,
+        "n_samples": n_blocks*n_spb,
+        "n_channels": header['num_amplifier_channels'],
+        "sample_rate": header['sample_rate'],
+        "notch_filter_frequency": header['notch_filter_frequency'],
+        "first_timestamp": first_timestamp,
+        "last_timestamp": last_timestamp,
+    }
+
+
+def get_rhd_folder_index(rhd_foldername, index_path=None, save_sidecar=True, verbose=False):
+    """
+    Return the index of all .rhd files in `rhd_foldername`, sorted by recording time.
+    `index_path`: where the JSON sidecar is read from/written to;
+        defaults to `rhd_foldername`/rhd_index.json
+    `save_sidecar`: whether to (re)write the sidecar when entries changed.
+    Returned dict has keys:
+        "folder": the folder name
+        "files": list of per-file entries (see `index_rhd_file`)
+        "n_samples_cumsum": list of len(files)+1; sample offset of each file in the session
+    """
+    if index_path is None:
+        index_path = os.path.join(rhd_foldername, RHD_INDEX_FILENAME)
+    cached_entries = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r") as f:
+                cached = json.load(f)
+            if cached.get("version") == RHD_INDEX_VERSION:
+                cached_entries = {e["filename"]: e for e in cached["files"]}
+        except (OSError, ValueError, KeyError) as e:
+            warnings.warn("Ignoring unreadable RHD index %s: %s" % (index_path, e))
+    rhd_filenames = sorted(
+        filter(lambda x: x.endswith(".rhd"), os.listdir(rhd_foldername)),
+        key=get_datetimestr_from_rhd_filename
+    )
+    entries = []
+    n_reindexed = 0
+    for rhd_filename in rhd_filenames:
+        rhd_path = os.path.join(rhd_foldername, rhd_filename)
+        entry = cached_entries.get(rhd_filename)
+        st = os.stat(rhd_path)
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            entry = index_rhd_file(rhd_path)
+            n_reindexed += 1
+        entries.append(entry)
+    if verbose:
+        print("RHD index for %s: %d files, %d (re)indexed" % (rhd_foldername, len(entries), n_reindexed))
+    if save_sidecar and (n_reindexed > 0 or len(cached_entries) != len(entries)):
+        try:
+            tmp_path = index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"version": RHD_INDEX_VERSION, "files": entries}, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            warnings.warn("Could not save RHD index to %s: %s" % (index_path, e))
+    n_samples_cumsum = [0] + list(np.cumsum([e["n_samples"] for e in entries]).astype(int))
+    return {
+        "folder": rhd_foldername,
+        "files": entries,
+        "n_samples_cumsum": [int(x) for x in n_samples_cumsum],
+    }
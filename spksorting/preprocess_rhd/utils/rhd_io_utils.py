@@ -5,8 +5,22 @@ from pynwb import NWBFile, NWBHDF5IO
 from pynwb.ecephys import ElectricalSeries, TimeSeries
 from hdmf.backends.hdf5.h5_utils import H5DataIO
 
+from .rhd_timestamps import concatenate_segments
+
 HOTFIX_YW_32ON64 = True
 
+def get_hotfix_32on64_mask(amplifier_channels: list):
+    """
+    Channel mask for the pre-2023 experiments with 32ch probes recorded with
+    64ch Intan boards: only native channels 16-47 are kept.
+    Returns None if the hotfix does not apply to this channel table.
+    """
+    n_chs = len(amplifier_channels)
+    if not (HOTFIX_YW_32ON64 and n_chs > 32 and n_chs <= 64):
+        return None
+    ch_native_orders_tmp = np.array([k["native_order"] for k in amplifier_channels])
+    return (ch_native_orders_tmp>=16) & (ch_native_orders_tmp<48)
+
 def initiate_temp_hdf5(h5_tmpfilename: str, parsed_rhd: dict, mask=None):
     """
     read and parse one chunked rhd file; use the parsed data to create and 
@@ -49,10 +63,10 @@ def initiate_temp_hdf5(h5_tmpfilename: str, parsed_rhd: dict, mask=None):
         name="amplifier_data", data=tmp_data,
         maxshape=(tmp_data.shape[0], None)
     )
-    # create dataset for timestamp
-    tmp_data = parsed_rhd["t"]
+    # create dataset for timestamps, run-length encoded as (start_sample, start_timestamp, length)
+    tmp_data = parsed_rhd["timestamp_segments"]
     h5dset_t = h5_file_obj.create_dataset(
-        name="t", data=tmp_data,
+        name="timestamp_segments", data=tmp_data,
         maxshape=(None,)
     )
     # # create dataset for dc_amplifier_data
@@ -93,7 +107,14 @@ def append_temp_hdf5(h5_file_obj, h5_tmpfilename: str, parsed_rhd: dict, mask=No
     # TODO decide whether or not it should close and reopen HDF5 file object
     # TODO assert that constant parameters like sampling rate are consistent
     _append_hdf5_dataset(h5_file_obj, "amplifier_data", parsed_rhd["amplifier_data"][mask, :], 1)
-    _append_hdf5_dataset(h5_file_obj, "t", parsed_rhd["t"], 0)
+    # shift the new segments to session sample indices; merge with the last stored segment if contiguous
+    dset_segments = h5_file_obj["timestamp_segments"]
+    new_segments = parsed_rhd["timestamp_segments"].copy()
+    new_segments["start_sample"] += h5_file_obj["amplifier_data"].shape[1] - parsed_rhd["amplifier_data"].shape[1]
+    i_last = max(0, dset_segments.shape[0]-1)
+    merged = concatenate_segments(dset_segments[i_last:], new_segments)
+    dset_segments.resize(i_last+merged.shape[0], axis=0)
+    dset_segments[i_last:] = merged
     # _append_hdf5_dataset(h5_file_obj, "dc_amplifier_data", parsed_rhd["dc_amplifier_data"], 1)
     # _append_hdf5_dataset(h5_file_obj, "board_dig_in_data", parsed_rhd["board_dig_in_data"], 1)
 
@@ -176,12 +197,11 @@ def initiate_nwb(
         conversion*stored_data + offset ONLY WHEN you call `nwb.TimeSeries.get_data_in_units`
     """
     if mask is None:
-        mask = np.ones(parsed_rhd["amplifier_data"].shape[0], dtype=bool)
         # following is for the pre-2023 experiments with 32ch probes recorded with 64ch Intan boards
-        if HOTFIX_YW_32ON64 and parsed_rhd["amplifier_data"].shape[0] > 32 and parsed_rhd["amplifier_data"].shape[0] <= 64:
-            # this is a hack to make it work with the old data
-            ch_native_orders_tmp = np.array([k["native_order"] for k in parsed_rhd["amplifier_channels"]])
-            mask[(ch_native_orders_tmp<16)|(ch_native_orders_tmp>=48)] = False
+        # (callers may already have dropped the extra channels when reading the rhd file)
+        mask = get_hotfix_32on64_mask(parsed_rhd["amplifier_channels"])
+        if mask is None:
+            mask = np.ones(parsed_rhd["amplifier_data"].shape[0], dtype=bool)
     else:
         print(mask.shape, parsed_rhd["amplifier_data"].shape, len(parsed_rhd["amplifier_channels"]))
         if not(mask.dtype==bool and mask.shape[0]==parsed_rhd["amplifier_data"].shape[0]):
@@ -0,0 +1,107 @@
+"""
+Parallel decoding of the .rhd files of a session with one ordered writer.
+
+Files are decoded (and optionally filtered) in a process pool while the
+calling process writes the results strictly in file order, at the sample
+offsets planned from the folder index. At most `max_inflight` decoded files
+are held in memory at any time.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .load_intan_rhd_format_updated import memmap_data
+from .rhd_stream import rawbits_to_int16
+from .rhd_events import extract_block_ttl_edges
+
+
+def decode_rhd_file_int16(rhd_path, channels=None, dig_in_native_orders=None):
+    """
+    Decode the amplifier data of one .rhd file as int16 counts (raw bits - 32768).
+    `dig_in_native_orders`: if given, the TTL edges of the file are found in the
+        same pass and (data, edges) is returned, see rhd_events.extract_block_ttl_edges
+    """
+    parsed = memmap_data(rhd_path, channels=channels)
+    data = rawbits_to_int16(parsed["amplifier_data"].raw[:, :])
+    if dig_in_native_orders is None:
+        return data
+    return data, extract_block_ttl_edges(parsed["board_dig_in_raw"][:], dig_in_native_orders)
+
+
+def decode_files_ordered(decode_fn, tasks, write_fn, n_workers=1, max_inflight=None):
+    """
+    Run `decode_fn(*task)` for every task in `tasks` and pass the results to
+    `write_fn(i_task, result)` in task order.
+    `decode_fn` must be a picklable (module-level) function when n_workers>1.
+    `max_inflight`: maximum number of submitted-but-not-yet-written tasks;
+        caps peak memory at that many decoded files. Defaults to 2*n_workers.
+    With n_workers<=1 everything runs in the calling process.
+    """
+    tasks = list(tasks)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if n_workers <= 1:
+        for i_task, task in enumerate(tasks):
+            write_fn(i_task, decode_fn(*task))
+        return
+    if max_inflight is None:
+        max_inflight = 2*n_workers
+    max_inflight = max(1, max_inflight)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        inflight = deque()
+        i_next = 0
+        while i_next < len(tasks) or len(inflight) > 0:
+            while i_next < len(tasks) and len(inflight) < max_inflight:
+                inflight.append(executor.submit(decode_fn, *tasks[i_next]))
+                i_next += 1
+            # the oldest task is always written first, which keeps the writer ordered
+            i_task = i_next - len(inflight)
+            result = inflight.popleft().result()
+            write_fn(i_task, result)
+            del result
+
+
+def decode_session_to_writer(rhd_foldername, rhd_index, writer, n_workers=1, max_inflight=None,
+        channels_by_file=None, decode_fn=None, stream_filter=None, prefilter_fn=None, ttl_collector=None):
+    """
+    Decode all files of an indexed session and write each of them into
+    `writer` (e.g. a `DiskWriteMda` of shape (n_ch, n_samples)) at its
+    precomputed sample offset.
+    `channels_by_file`: optional list with one channel selection per file.
+    `decode_fn(rhd_path, channels)`: defaults to `decode_rhd_file_int16`.
+    `stream_filter`: optional filter applied across file boundaries in this
+        process, in file order (e.g. `filtering.StreamingSosFiltFilt`); its
+        `process(data)` and `flush()` return (beg_sample, filtered block).
+    `prefilter_fn`: optional function applied to each decoded file in this process
+        before `stream_filter` (e.g. scaling int16 counts to float32 microvolts)
+    `ttl_collector`: optional rhd_events.TtlEventCollector; `decode_fn` then returns
+        (data, TTL edges of the file) and the edges are added in file order
+        at the file's sample offset, so the digital inputs need no second pass
+    """
+    if decode_fn is None:
+        decode_fn = decode_rhd_file_int16
+    n_files = len(rhd_index["files"])
+    if channels_by_file is None:
+        channels_by_file = [None]*n_files
+    tasks = [
+        (os.path.join(rhd_foldername, rhd_index["files"][i]["filename"]), channels_by_file[i])
+        for i in range(n_files)
+    ]
+    n_samples_cumsum = rhd_index["n_samples_cumsum"]
+    def _write(i_file, data):
+        if ttl_collector is not None:
+            data, file_edges = data
+            ttl_collector.add(n_samples_cumsum[i_file], file_edges)
+        if stream_filter is None:
+            writer.writeChunk(np.asarray(data), i1=0, i2=n_samples_cumsum[i_file])
+        else:
+            beg, out = stream_filter.process(data if prefilter_fn is None else prefilter_fn(data))
+            if out.shape[1] > 0:
+                writer.writeChunk(out, i1=0, i2=beg)
+    decode_files_ordered(decode_fn, tasks, _write, n_workers=n_workers, max_inflight=max_inflight)
+    if stream_filter is not None:
+        beg, out = stream_filter.flush()
+        if out.shape[1] > 0:
+            writer.writeChunk(out, i1=0, i2=beg)
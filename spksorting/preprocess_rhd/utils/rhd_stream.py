@@ -0,0 +1,118 @@
+"""
+Streaming access to a whole session (folder) of .rhd files.
+
+The session is treated as one continuous (n_ch, n_samples) recording; chunks
+are cut from the memory-mapped files (see `memmap_data`) and may span file
+boundaries. Memory usage only depends on the chunk size, not on the session
+length. Samples are returned as int16 ADC counts (raw uint16 bits - 32768);
+multiply by RHD_AMPLIFIER_UV_PER_BIT to get microvolts.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .load_intan_rhd_format_updated import memmap_data
+from .load_intan_rhd_format_updated.intanutil.read_all_data_blocks import rawbits_to_int16
+from .rhd_index import get_rhd_folder_index
+
+RHD_AMPLIFIER_UV_PER_BIT = 0.195
+
+# `data` covers session samples [beg_sample-margin_left, end_sample+margin_right);
+# data[:, core] covers exactly [beg_sample, end_sample); `dig_in` (packed digital-input
+# words of the same samples as `data`) is None unless requested
+RhdChunk = namedtuple("RhdChunk", ["beg_sample", "end_sample", "data", "core", "dig_in"], defaults=[None])
+
+
+class RhdSessionReader:
+    """
+    Random access to the amplifier data of a session folder as one recording.
+    `channels` : amplifier channel mask or native orders, see `read_data`.
+        Use native orders if the channel count differs across files.
+    """
+    def __init__(self, rhd_foldername, channels=None, rhd_index=None):
+        if rhd_index is None:
+            rhd_index = get_rhd_folder_index(rhd_foldername)
+        self.rhd_foldername = rhd_foldername
+        self.rhd_index = rhd_index
+        self.channels = channels
+        self.n_samples_cumsum = np.array(rhd_index["n_samples_cumsum"], dtype=np.int64)
+        self.n_samples = int(self.n_samples_cumsum[-1])
+        self.sample_rate = rhd_index["files"][0]["sample_rate"] if len(rhd_index["files"])>0 else None
+        self._mapped = {} # i_file -> memmap_data() result; only the most recent files are kept
+        self._n_ch = None
+
+    @property
+    def n_ch(self):
+        if self._n_ch is None:
+            self._n_ch = self._get_file(0)["amplifier_data"].shape[0]
+        return self._n_ch
+
+    def _get_file(self, i_file):
+        if i_file not in self._mapped:
+            if len(self._mapped) >= 2:
+                self._mapped.pop(next(iter(self._mapped)))
+            rhd_path = os.path.join(self.rhd_foldername, self.rhd_index["files"][i_file]["filename"])
+            self._mapped[i_file] = memmap_data(rhd_path, channels=self.channels)
+        return self._mapped[i_file]
+
+    def read(self, beg_sample, end_sample, out=None):
+        """Read session samples [beg_sample, end_sample) as an int16 (n_ch, n) array."""
+        beg_sample = max(0, int(beg_sample))
+        end_sample = min(self.n_samples, int(end_sample))
+        n = max(0, end_sample-beg_sample)
+        if out is None:
+            out = np.empty((self.n_ch, n), dtype=np.int16)
+        if n == 0:
+            return out
+        for i_file, src, dst in self._file_segments(beg_sample, end_sample):
+            out[:, dst] = rawbits_to_int16(self._get_file(i_file)["amplifier_data"].raw[:, src])
+        return out
+
+    def read_dig_in(self, beg_sample, end_sample):
+        """Packed uint16 digital-input words of session samples [beg_sample, end_sample)."""
+        beg_sample = max(0, int(beg_sample))
+        end_sample = min(self.n_samples, int(end_sample))
+        out = np.empty(max(0, end_sample-beg_sample), dtype=np.uint16)
+        for i_file, src, dst in self._file_segments(beg_sample, end_sample):
+            out[dst] = self._get_file(i_file)["board_dig_in_raw"][src]
+        return out
+
+    def _file_segments(self, beg_sample, end_sample):
+        # (i_file, samples within the file, samples within [beg_sample, end_sample)) covering the range
+        if end_sample <= beg_sample:
+            return
+        i_file = int(np.searchsorted(self.n_samples_cumsum, beg_sample, side="right")) - 1
+        pos = beg_sample
+        while pos < end_sample:
+            file_beg = int(self.n_samples_cumsum[i_file])
+            file_end = int(self.n_samples_cumsum[i_file+1])
+            seg_end = min(end_sample, file_end)
+            if seg_end > pos:
+                yield i_file, slice(pos-file_beg, seg_end-file_beg), slice(pos-beg_sample, seg_end-beg_sample)
+                pos = seg_end
+            i_file += 1
+
+
+def iter_rhd_session_chunks(
+        rhd_foldername, chunk_samples, overlap=0, channels=None,
+        beg_sample=0, end_sample=None, rhd_index=None, with_dig_in=False):
+    """
+    Yield RhdChunk tuples of int16 amplifier data over session samples
+    [beg_sample, end_sample) in steps of `chunk_samples`, seamlessly crossing
+    .rhd file boundaries. Each chunk also carries up to `overlap` samples of
+    margin on either side (less at the session edges) for filtering;
+    `chunk.data[:, chunk.core]` is the non-overlapping part.
+    `with_dig_in`: also read the digital-input words of each chunk (`chunk.dig_in`).
+    """
+    reader = RhdSessionReader(rhd_foldername, channels=channels, rhd_index=rhd_index)
+    if end_sample is None:
+        end_sample = reader.n_samples
+    end_sample = min(end_sample, reader.n_samples)
+    for chunk_beg in range(beg_sample, end_sample, chunk_samples):
+        chunk_end = min(chunk_beg+chunk_samples, end_sample)
+        data_beg = max(0, chunk_beg-overlap)
+        data_end = min(reader.n_samples, chunk_end+overlap)
+        data = reader.read(data_beg, data_end)
+        dig_in = reader.read_dig_in(data_beg, data_end) if with_dig_in else None
+        yield RhdChunk(chunk_beg, chunk_end, data, slice(chunk_beg-data_beg, chunk_end-data_beg), dig_in)
@@ -0,0 +1,168 @@
+"""
+Run-length timestamp index for Intan recordings.
+
+Intan timestamps are almost always a contiguous integer ramp, so instead of a
+float64 time value per sample they are stored as segments
+(start_sample, start_timestamp, length): within a segment the timestamp
+increases by exactly 1 per sample. Every segment boundary is a gap (missing,
+repeated or out-of-order timestamps), either within one file or across two
+consecutive files of a session. Conversions between sample indices and
+timestamps are vectorized binary searches over the segments.
+"""
+import os
+
+import numpy as np
+
+from .load_intan_rhd_format_updated import memmap_data
+from .load_intan_rhd_format_updated.intanutil.timestamp_segments import TIMESTAMP_SEGMENT_DTYPE, timestamps_to_segments
+from .rhd_index import get_rhd_folder_index
+
+TIMESTAMP_SEGMENTS_FILENAME = "timestamp_segments.npz"
+
+# `n_missing` = number of timestamps skipped at the gap (<=0 for repeated/backward timestamps)
+TIMESTAMP_GAP_DTYPE = np.dtype([("sample", np.int64), ("n_missing", np.int64), ("at_file_boundary", np.bool_)])
+
+
+def concatenate_segments(segments_a, segments_b):
+    """
+    Concatenate two segment tables where `segments_b` directly follows
+    `segments_a` in sample order; the boundary segments are merged when the
+    timestamps continue without a gap.
+    """
+    if segments_a.shape[0] == 0:
+        return segments_b.copy()
+    if segments_b.shape[0] == 0:
+        return segments_a.copy()
+    last = segments_a[-1]
+    first = segments_b[0]
+    if last["start_sample"]+last["length"] != first["start_sample"]:
+        raise ValueError("Segments are not adjacent in sample index")
+    if last["start_timestamp"]+last["length"] == first["start_timestamp"]:
+        merged = np.concatenate([segments_a, segments_b[1:]])
+        merged["length"][segments_a.shape[0]-1] += first["length"]
+        return merged
+    return np.concatenate([segments_a, segments_b])
+
+
+def slice_segments(segments, beg_sample, end_sample):
+    """
+    Segments covering samples [beg_sample, end_sample) only, with
+    `start_sample` counted from `beg_sample` (e.g. for one chunk of a session).
+    """
+    seg_beg = segments["start_sample"]
+    seg_end = seg_beg + segments["length"]
+    keep = (seg_end > beg_sample) & (seg_beg < end_sample)
+    sliced = segments[keep].copy()
+    new_beg = np.maximum(seg_beg[keep], beg_sample)
+    sliced["start_timestamp"] += new_beg - seg_beg[keep]
+    sliced["length"] = np.minimum(seg_end[keep], end_sample) - new_beg
+    sliced["start_sample"] = new_beg - beg_sample
+    return sliced
+
+
+def find_timestamp_gaps(segments, file_boundaries=None):
+    """
+    List the gaps between consecutive segments as a TIMESTAMP_GAP_DTYPE array.
+    `file_boundaries`: session sample indices where a new file starts
+        (e.g. rhd_index["n_samples_cumsum"]); used to set `at_file_boundary`.
+    """
+    gaps = np.zeros(max(0, segments.shape[0]-1), dtype=TIMESTAMP_GAP_DTYPE)
+    if gaps.shape[0] == 0:
+        return gaps
+    gaps["sample"] = segments["start_sample"][1:]
+    gaps["n_missing"] = segments["start_timestamp"][1:] - (segments["start_timestamp"][:-1] + segments["length"][:-1])
+    if file_boundaries is not None:
+        gaps["at_file_boundary"] = np.isin(gaps["sample"], file_boundaries)
+    return gaps
+
+
+def sample_to_timestamp(segments, samples):
+    """Intan timestamps at the given sample indices (vectorized)."""
+    samples = np.asarray(samples, dtype=np.int64)
+    i_seg = np.searchsorted(segments["start_sample"], samples, side="right") - 1
+    if segments.shape[0] == 0 or np.any(i_seg < 0) or np.any(samples >= segments["start_sample"][-1] + segments["length"][-1]):
+        raise IndexError("sample index out of the range covered by the segments")
+    return segments["start_timestamp"][i_seg] + (samples - segments["start_sample"][i_seg])
+
+
+def sample_to_time(segments, samples, sample_rate):
+    """Time in seconds (timestamp/sample_rate) at the given sample indices."""
+    return sample_to_timestamp(segments, samples) / sample_rate
+
+
+def timestamp_to_sample(segments, timestamps):
+    """
+    Sample indices of the given Intan timestamps (vectorized); -1 where the
+    timestamp was not recorded. Assumes timestamps increase across segments.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    i_seg = np.searchsorted(segments["start_timestamp"], timestamps, side="right") - 1
+    i_seg_valid = np.maximum(i_seg, 0)
+    offset = timestamps - segments["start_timestamp"][i_seg_valid]
+    inside = (i_seg >= 0) & (offset < segments["length"][i_seg_valid])
+    return np.where(inside, segments["start_sample"][i_seg_valid] + offset, -1)
+
+
+def get_session_timestamp_segments(rhd_foldername, rhd_index=None):
+    """
+    Timestamp segments of a whole session (sample indices counted from the
+    start of the session) and the gaps between them, within and across files.
+    Returns a dict with keys "segments", "gaps" and "sample_rate".
+    """
+    if rhd_index is None:
+        rhd_index = get_rhd_folder_index(rhd_foldername)
+    n_samples_cumsum = rhd_index["n_samples_cumsum"]
+    segments = np.zeros(0, dtype=TIMESTAMP_SEGMENT_DTYPE)
+    for i_file, entry in enumerate(rhd_index["files"]):
+        if entry["n_samples"] == 0:
+            continue
+        # Intan timestamps only ever skip forward (dropped data), so a file whose
+        # first and last timestamps span exactly n_samples has no gap and is
+        # described by the two timestamps kept in the index
+        if entry["last_timestamp"] - entry["first_timestamp"] == entry["n_samples"] - 1:
+            file_segments = np.array(
+                [(n_samples_cumsum[i_file], entry["first_timestamp"], entry["n_samples"])],
+                dtype=TIMESTAMP_SEGMENT_DTYPE
+            )
+        else:
+            parsed = memmap_data(os.path.join(rhd_foldername, entry["filename"]))
+            file_segments = timestamps_to_segments(parsed["t_amplifier"].raw[:], n_samples_cumsum[i_file])
+            del parsed
+        segments = concatenate_segments(segments, file_segments)
+    return {
+        "segments": segments,
+        "gaps": find_timestamp_gaps(segments, n_samples_cumsum[1:-1]),
+        "sample_rate": rhd_index["files"][0]["sample_rate"] if len(rhd_index["files"]) > 0 else None,
+    }
+
+
+def describe_timestamp_gaps(gaps, sample_rate=None, max_listed=5):
+    """One-line summary of a TIMESTAMP_GAP_DTYPE array for warnings and logs."""
+    n_missing = gaps["n_missing"]
+    msg = "%d timestamp gap(s) (%d at file boundaries), %d timestamps missing, %d repeated/backward" % (
+        gaps.shape[0], np.sum(gaps["at_file_boundary"]), np.sum(n_missing[n_missing > 0]), np.sum(n_missing <= 0))
+    listed = ["sample %d: %+d" % (g["sample"], g["n_missing"]) for g in gaps[:max_listed]]
+    if sample_rate:
+        listed = ["%s (%.3f s)" % (x, g["sample"]/sample_rate) for x, g in zip(listed, gaps[:max_listed])]
+    return msg + "; " + ", ".join(listed) + (", ..." if gaps.shape[0] > max_listed else "")
+
+
+def save_timestamp_segments(path, session_segments):
+    """Save the result of `get_session_timestamp_segments` as .npz."""
+    np.savez(
+        path,
+        segments=session_segments["segments"],
+        gaps=session_segments["gaps"],
+        sample_rate=np.nan if session_segments["sample_rate"] is None else session_segments["sample_rate"],
+    )
+
+
+def load_timestamp_segments(path):
+    """Load a .npz written by `save_timestamp_segments` back into the same dict."""
+    with np.load(path) as f:
+        sample_rate = float(f["sample_rate"])
+        return {
+            "segments": f["segments"],
+            "gaps": f["gaps"],
+            "sample_rate": None if np.isnan(sample_rate) else sample_rate,
+        }
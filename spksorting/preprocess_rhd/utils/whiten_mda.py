@@ -0,0 +1,267 @@
+"""
+In-process replacement of the `ephys.whiten` stage of MountainSort.
+
+Like ml_ephys the whitening matrix is W = U S^(-1/2) U^T from the SVD of
+the channel covariance (X X^T / n_samples, no mean subtraction since the
+data is bandpass filtered) and the output is W X in float32. Instead of a
+full pass over the recording, the covariance is accumulated from a strided
+sample of `n_cov_chunks` chunks spread over the whole session; W is then
+applied chunk by chunk. `bandpass_whiten_mda` does bandpass filtering and
+whitening in one read of the raw recording, writing filt.mda and the
+whitened data side by side, optionally common average (or median)
+referenced before whitening (`reference`). W is saved as an .mda file next to the output
+so that post-processing can reuse it (see `read_whitening_matrix`).
+Artifacts of the whitened data can be detected in the same pass (the
+ephys.mask_out_artifacts stage, see artifact_mask.py): the intervals are
+saved with the output and zeroed in place afterwards.
+"""
+import os
+from time import time
+
+import numpy as np
+
+from .mdaio import DiskReadMda, StreamingMdaWriter, writemda64, readmda
+from .filter_engine import FilterEngine
+from .artifact_mask import IntervalNormAccumulator, detect_artifacts, get_artifact_intervals, \
+    get_artifact_intervals_path, save_artifact_intervals, mask_mda_in_place, detect_artifacts_mda, \
+    DEFAULT_THRESHOLD, DEFAULT_INTERVAL_SIZE
+from .bandpass_mda import get_chunk_bounds, iter_chunks, iter_bandpass_chunks, \
+    DEFAULT_FREQ_MIN, DEFAULT_FREQ_MAX, DEFAULT_FREQ_WID, DEFAULT_PADDING, DEFAULT_CHUNK_SIZE
+from .common_reference import REFERENCE_METHODS
+
+WHITENING_MATRIX_FNAME = "whitening_matrix.mda"
+DEFAULT_N_COV_CHUNKS = 100 # 100 seconds of data at 30 kHz with the default chunk size
+
+
+class CovarianceAccumulator:
+    """Streaming estimate of the (n_ch, n_ch) channel covariance X X^T / n_samples."""
+    def __init__(self, n_ch):
+        self.AAt = np.zeros((n_ch, n_ch), dtype=np.float64)
+        self.n_samples = 0
+    def add(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        self.AAt += chunk @ chunk.T
+        self.n_samples += chunk.shape[1]
+    def covariance(self):
+        if self.n_samples == 0:
+            raise ValueError("No samples to estimate the covariance from")
+        return self.AAt / self.n_samples
+    def whitening_matrix(self):
+        return compute_whitening_matrix(self.covariance())
+
+
+def compute_whitening_matrix(cov, rcond=1e-10):
+    """
+    ZCA whitening matrix of the covariance `cov`, as computed by ml_ephys.
+    Directions with a variance below `rcond` times the largest one (e.g. the
+    sum of the channels after a common average reference) are zeroed
+    instead of amplified.
+    """
+    U, S, _ = np.linalg.svd(cov, full_matrices=True)
+    keep = S > rcond*S[0]
+    S_inv_sqrt = np.zeros(S.shape)
+    S_inv_sqrt[keep] = 1/np.sqrt(S[keep])
+    return (U @ np.diag(S_inv_sqrt)) @ U.T
+
+
+def get_cov_chunk_indices(n_chunks, n_cov_chunks=DEFAULT_N_COV_CHUNKS):
+    """Indices of `n_cov_chunks` chunks evenly spread over `n_chunks` (all if None or fewer)."""
+    if n_cov_chunks is None or n_cov_chunks >= n_chunks:
+        return np.arange(n_chunks)
+    return np.unique(np.linspace(0, n_chunks-1, n_cov_chunks).round().astype(int))
+
+
+def get_whitening_matrix_path(timeseries_out):
+    return os.path.join(os.path.dirname(os.path.abspath(timeseries_out)), WHITENING_MATRIX_FNAME)
+
+
+def read_whitening_matrix(session_folder):
+    """Whitening matrix saved by this module in a sorting result folder."""
+    return readmda(os.path.join(session_folder, WHITENING_MATRIX_FNAME))
+
+
+def apply_whitening(W, chunk, dtype=np.float32):
+    return (W @ np.asarray(chunk, dtype=np.float64)).astype(dtype)
+
+
+def _mask_artifacts(norm_acc, timeseries_out, threshold):
+    intervals = get_artifact_intervals(detect_artifacts(norm_acc.norms(), threshold), norm_acc.interval_size, norm_acc.n_samples)
+    save_artifact_intervals(get_artifact_intervals_path(os.path.dirname(os.path.abspath(timeseries_out))),
+        intervals, norm_acc.n_samples, threshold, norm_acc.interval_size)
+    mask_mda_in_place(timeseries_out, intervals)
+    print("Masked %d artifact intervals (%d of %d samples)" % (
+        len(intervals), np.sum(intervals[:, 1]-intervals[:, 0]), norm_acc.n_samples
+    ))
+
+
+def whiten_mda(timeseries, timeseries_out, chunk_size=DEFAULT_CHUNK_SIZE, n_cov_chunks=DEFAULT_N_COV_CHUNKS,
+        whitening_matrix_out=None, artifact_threshold=None, artifact_interval_size=DEFAULT_INTERVAL_SIZE):
+    """
+    Whiten the (bandpass filtered) .mda file `timeseries` into `timeseries_out`.
+    `n_cov_chunks`: number of chunks the covariance is estimated from (None: all).
+    `whitening_matrix_out`: defaults to whitening_matrix.mda next to `timeseries_out`.
+    `artifact_threshold`: if not None, also mask artifacts of the whitened data
+        (like ephys.mask_out_artifacts; the intervals go to artifact_intervals.json).
+    Returns the whitening matrix.
+    """
+    ts = time()
+    reader = DiskReadMda(timeseries)
+    n_ch, n_samples = reader.N1(), reader.N2()
+    bounds = get_chunk_bounds(n_samples, chunk_size, 0)
+    acc = CovarianceAccumulator(n_ch)
+    for _, chunk in iter_chunks(reader, bounds, get_cov_chunk_indices(len(bounds), n_cov_chunks)):
+        acc.add(chunk)
+    W = acc.whitening_matrix()
+    if whitening_matrix_out is None:
+        whitening_matrix_out = get_whitening_matrix_path(timeseries_out)
+    writemda64(W, whitening_matrix_out)
+    norm_acc = None if artifact_threshold is None else IntervalNormAccumulator(n_ch, n_samples, artifact_interval_size)
+    with StreamingMdaWriter(timeseries_out, (n_ch, n_samples), dt="float32") as writer:
+        for (t1, _, _, _), chunk in iter_chunks(reader, bounds):
+            whitened = apply_whitening(W, chunk)
+            if norm_acc is not None:
+                norm_acc.add(t1, whitened)
+            writer.writeChunk(whitened, i1=0, i2=t1)
+    reader.close()
+    if norm_acc is not None:
+        _mask_artifacts(norm_acc, timeseries_out, artifact_threshold)
+    print("Whitened %s (covariance from %d samples) in %.2f seconds" % (timeseries, acc.n_samples, time()-ts))
+    return W
+
+
+def bandpass_whiten_mda(timeseries, filt_out, pre_out, samplerate, freq_min=DEFAULT_FREQ_MIN,
+        freq_max=DEFAULT_FREQ_MAX, freq_wid=DEFAULT_FREQ_WID, padding=DEFAULT_PADDING,
+        chunk_size=DEFAULT_CHUNK_SIZE, n_cov_chunks=DEFAULT_N_COV_CHUNKS, n_threads=None,
+        whitening_matrix_out=None, artifact_threshold=None, artifact_interval_size=DEFAULT_INTERVAL_SIZE,
+        reference=None, ref_channels=None):
+    """
+    Bandpass filter the raw .mda file `timeseries` into `filt_out` and whiten it
+    into `pre_out` in one pass over the recording (`filt_out` may be None if
+    only the whitened data is needed). The covariance is estimated first from
+    `n_cov_chunks` bandpass filtered chunks, which only reads those chunks.
+    `artifact_threshold`: see whiten_mda.
+    `reference`, `ref_channels`: optional CAR/CMR of the filtered data (written
+        to `filt_out` and whitened), see bandpass_mda.iter_bandpass_chunks.
+    Returns the whitening matrix.
+    """
+    ts = time()
+    reader = DiskReadMda(timeseries)
+    n_ch, n_samples = reader.N1(), reader.N2()
+    n_chunks = len(get_chunk_bounds(n_samples, chunk_size, padding))
+    filt_params = dict(freq_min=freq_min, freq_max=freq_max, freq_wid=freq_wid, padding=padding, chunk_size=chunk_size,
+        reference=reference, ref_channels=ref_channels)
+    with FilterEngine(n_threads=n_threads) as engine:
+        acc = CovarianceAccumulator(n_ch)
+        cov_chunk_inds = get_cov_chunk_indices(n_chunks, n_cov_chunks)
+        for _, _, filtered in iter_bandpass_chunks(reader, samplerate, chunk_inds=cov_chunk_inds, engine=engine, **filt_params):
+            acc.add(filtered)
+        W = acc.whitening_matrix()
+        if whitening_matrix_out is None:
+            whitening_matrix_out = get_whitening_matrix_path(pre_out)
+        writemda64(W, whitening_matrix_out)
+        t_cov = time()
+        norm_acc = None if artifact_threshold is None else IntervalNormAccumulator(n_ch, n_samples, artifact_interval_size)
+        filt_writer = None if filt_out is None else StreamingMdaWriter(filt_out, (n_ch, n_samples), dt="float32")
+        with StreamingMdaWriter(pre_out, (n_ch, n_samples), dt="float32") as pre_writer:
+            for t1, _, filtered in iter_bandpass_chunks(reader, samplerate, engine=engine, **filt_params):
+                if filt_writer is not None:
+                    filt_writer.writeChunk(filtered, i1=0, i2=t1)
+                whitened = apply_whitening(W, filtered)
+                if norm_acc is not None:
+                    norm_acc.add(t1, whitened)
+                pre_writer.writeChunk(whitened, i1=0, i2=t1)
+        if filt_writer is not None:
+            filt_writer.close()
+    reader.close()
+    if norm_acc is not None:
+        _mask_artifacts(norm_acc, pre_out, artifact_threshold)
+    print("Bandpass filtered and whitened %s in %.2f seconds (covariance from %d samples in %.2f seconds); filtering: %s" % (
+        timeseries, time()-ts, acc.n_samples, t_cov-ts, engine.report(samplerate)
+    ))
+    return W
+
+
+def check_equivalence(samplerate=30000, n_ch=8, n_samples=1000003, n_threads=4, tol=1e-4):
+    """
+    Compare the fused bandpass+whitening+masking pass on a synthetic recording
+    with the separate stages, and with whitening by the covariance of the whole
+    filtered recording. Returns the max errors relative to the RMS (1 after whitening).
+    """
+    import tempfile
+    from .mdaio import writemda16i
+    from .artifact_mask import load_artifact_intervals, times_in_intervals
+    from .bandpass_mda import bandpass_filter_mda
+    rng = np.random.default_rng(0)
+    mixing = rng.normal(0, 1, (n_ch, n_ch)) + 3*np.eye(n_ch) # correlated channels
+    x = mixing @ rng.normal(0, 20, (n_ch, n_samples))
+    x += 500*np.sin(2*np.pi*np.arange(n_samples)/samplerate) # drift
+    x[:, 400000:400100] += 3000 # an artifact
+    x = x.astype(np.int16)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        raw_path = os.path.join(tmpdir, "converted_data.mda")
+        writemda16i(x, raw_path)
+        # separate stages with the covariance of the whole recording
+        bandpass_filter_mda(raw_path, os.path.join(tmpdir, "filt_ref.mda"), samplerate, n_threads=n_threads)
+        W_full = whiten_mda(os.path.join(tmpdir, "filt_ref.mda"), os.path.join(tmpdir, "pre_ref.mda"), n_cov_chunks=None)
+        detect_artifacts_mda(os.path.join(tmpdir, "pre_ref.mda"), intervals_out=os.path.join(tmpdir, "intervals_ref.json"))
+        mask_mda_in_place(os.path.join(tmpdir, "pre_ref.mda"), load_artifact_intervals(os.path.join(tmpdir, "intervals_ref.json")))
+        pre_ref = readmda(os.path.join(tmpdir, "pre_ref.mda"))
+        # fused pass with artifact masking, whole-recording covariance: must match the separate stages
+        bandpass_whiten_mda(raw_path, os.path.join(tmpdir, "filt.mda"), os.path.join(tmpdir, "pre.mda"), samplerate,
+            n_cov_chunks=None, n_threads=n_threads, whitening_matrix_out=os.path.join(tmpdir, "W.mda"),
+            artifact_threshold=DEFAULT_THRESHOLD)
+        err_fused = np.max(np.abs(readmda(os.path.join(tmpdir, "pre.mda"))-pre_ref))
+        n_masked = np.sum(np.all(pre_ref == 0, axis=0))
+        assert np.array_equal(load_artifact_intervals(tmpdir), load_artifact_intervals(os.path.join(tmpdir, "intervals_ref.json")))
+        err_filt = np.max(np.abs(readmda(os.path.join(tmpdir, "filt.mda"))-readmda(os.path.join(tmpdir, "filt_ref.mda"))))
+        # fused pass with the strided covariance estimate
+        W = bandpass_whiten_mda(raw_path, None, os.path.join(tmpdir, "pre.mda"), samplerate,
+            n_cov_chunks=10, n_threads=n_threads, whitening_matrix_out=os.path.join(tmpdir, "W.mda"))
+        pre = readmda(os.path.join(tmpdir, "pre.mda"))
+        clean = ~times_in_intervals(np.arange(n_samples), load_artifact_intervals(tmpdir)) # the artifact is not white
+        err_strided = np.max(np.abs(np.cov(pre[:, clean].astype(np.float64), bias=True)-np.eye(n_ch)))
+    print("fused vs separate stages: max diff %.2e (filt.mda %.2e, %d samples masked); strided (10 chunks) vs full covariance: |W-W_full| %.2e, max |cov(pre)-I| %.2e" % (
+        err_fused, err_filt, n_masked, np.max(np.abs(W-W_full)), err_strided
+    ))
+    assert n_masked > 0 and err_fused < tol and err_filt == 0, "Fused bandpass+whitening differs from the separate stages"
+    assert err_strided < 0.1, "Whitening from the strided covariance estimate is off"
+    return err_fused, err_strided
+
+
+if __name__ == '__main__':
+    # e.g. `python -m utils.whiten_mda converted_data.mda pre.mda --filt_out filt.mda --samplerate 30000 --mask_artifacts`
+    # (bandpass + whitening + artifact masking), `python -m utils.whiten_mda filt.mda pre1.mda --no_bandpass` (whitening only)
+    # or `python -m utils.whiten_mda --check`
+    import argparse
+    parser = argparse.ArgumentParser(description="Whiten a .mda recording like ephys.whiten, optionally bandpass filtering it in the same pass")
+    parser.add_argument("timeseries", nargs="?")
+    parser.add_argument("timeseries_out", nargs="?")
+    parser.add_argument("--filt_out", default=None, help="also write the bandpass filtered data here")
+    parser.add_argument("--no_bandpass", action="store_true", help="input is already bandpass filtered")
+    parser.add_argument("--samplerate", type=float, default=30000)
+    parser.add_argument("--freq_min", type=float, default=DEFAULT_FREQ_MIN)
+    parser.add_argument("--freq_max", type=float, default=DEFAULT_FREQ_MAX)
+    parser.add_argument("--n_cov_chunks", type=int, default=DEFAULT_N_COV_CHUNKS, help="0 to use all chunks")
+    parser.add_argument("--n_threads", type=int, default=None)
+    parser.add_argument("--reference", default=None, choices=REFERENCE_METHODS, help="common average (mean) or median reference of the filtered data")
+    parser.add_argument("--whitening_matrix_out", default=None)
+    parser.add_argument("--mask_artifacts", action="store_true", help="also mask artifacts like ephys.mask_out_artifacts")
+    parser.add_argument("--artifact_threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--artifact_interval_size", type=int, default=DEFAULT_INTERVAL_SIZE)
+    parser.add_argument("--check", action="store_true", help="run the equivalence check on synthetic data")
+    args = parser.parse_args()
+    n_cov_chunks = None if args.n_cov_chunks <= 0 else args.n_cov_chunks
+    artifact_threshold = args.artifact_threshold if args.mask_artifacts else None
+    if args.check:
+        check_equivalence(samplerate=args.samplerate, n_threads=args.n_threads)
+    elif args.timeseries is None or args.timeseries_out is None:
+        parser.error("timeseries and timeseries_out are required")
+    elif args.no_bandpass:
+        whiten_mda(args.timeseries, args.timeseries_out, n_cov_chunks=n_cov_chunks, whitening_matrix_out=args.whitening_matrix_out,
+            artifact_threshold=artifact_threshold, artifact_interval_size=args.artifact_interval_size)
+    else:
+        bandpass_whiten_mda(args.timeseries, args.filt_out, args.timeseries_out, args.samplerate,
+            freq_min=args.freq_min, freq_max=args.freq_max, n_cov_chunks=n_cov_chunks,
+            n_threads=args.n_threads, whitening_matrix_out=args.whitening_matrix_out,
+            artifact_threshold=artifact_threshold, artifact_interval_size=args.artifact_interval_size,
+            reference=args.reference)
@@ -1,35 +1,72 @@
+import os
+
 import numpy as np
 import struct
 
 
-def writemda(X, fname, dtype="int16"):
+# upper bound of the temporary copy when X has to be cast or reordered before writing
+WRITE_BLOCK_BYTES = 1<<26
+
+def _write_int16_entries(f, X):
+    """
+    Write X in column-major order as int16; straight from the array buffer if X
+    already is Fortran-contiguous int16, otherwise in converted blocks along the last dim.
+    """
+    dt = np.dtype(np.int16)
+    if X.dtype == dt and X.flags.f_contiguous:
+        f.write(memoryview(np.reshape(X, X.size, order='F').view(np.uint8)))
+        return
+    inner = max(1, int(np.prod(X.shape[:-1])))
+    n_per_block = max(1, WRITE_BLOCK_BYTES // (inner*dt.itemsize))
+    for j in range(0, X.shape[-1], n_per_block):
+        B = np.asfortranarray(X[..., j:j+n_per_block], dtype=dt)
+        f.write(memoryview(np.reshape(B, B.size, order='F').view(np.uint8)))
+
+def writemda(X, fname, dtype="int16", append=False):
     '''Python implementation of .mda file write function
     About MDA files: http://magland.github.io//articles/mda-format/
     Currently only supporsts <int16> format export
+    `append`: if True and fname exists, X is appended along the last dim of
+        the file; the other dims must match
     '''
     
     # confirm number of dimensions of array
     # TODO handle case of, eg, 10x10x0
+    X = np.asanyarray(X)
     num_dims = len(X.shape)
-
-    f = open(fname, "wb")
+    if dtype != "int16":
+        raise ValueError("Only int16 export is supported; got %s" % (dtype))
     
-    if dtype=="int16":
+    if append and os.path.exists(fname):
+        with open(fname, "r+b") as f:
+            code, _, file_num_dims = struct.unpack('<iii', f.read(12))
+            if code != -4 or file_num_dims != num_dims:
+                raise ValueError("Cannot append int16 array of shape %s to %s" % (X.shape, fname))
+            dims = list(struct.unpack('<%di' % (num_dims), f.read(4*num_dims)))
+            if dims[:-1] != list(X.shape[:-1]):
+                raise ValueError("Cannot append array of shape %s to %s with dims %s" % (X.shape, fname, dims))
+            # drop anything past the data of the header's dims (e.g. an interrupted append)
+            f.seek(4*(3+num_dims) + 2*int(np.prod(dims)))
+            f.truncate()
+            _write_int16_entries(f, X)
+            f.flush()
+            # update the last dim only after the data is written
+            f.seek(4*(3+num_dims-1))
+            f.write(struct.pack('<i', dims[-1]+X.shape[-1]))
+        return
+
+    with open(fname, "wb") as f:
         # first write a 4-byte word (dtype code)
         code = -4
         f.write(struct.pack('<i', code))
         f.write(struct.pack('<i', 2))
         f.write(struct.pack('<i', num_dims))
-        dimprod = 1
         for dd in range(num_dims):
             f.write(struct.pack('<i', X.shape[dd]))
-            dimprod *= X.shape[dd]
-        Y = X.flatten(order='F')
-        Y = Y.astype(np.int16)
-        f.write(Y.tobytes())
+        _write_int16_entries(f, X)
 
-def writemda16i(X, fname):
-    writemda(X, fname, dtype='int16')
+def writemda16i(X, fname, append=False):
+    writemda(X, fname, dtype='int16', append=append)
 
 
 ########### generate testbench to compare against matlab ground truth write_mda